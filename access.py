@@ -0,0 +1,178 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import bulk
+import db
+from graph import copy_query
+from scoring import ntile
+
+# how a travel time turns into a weight: a hard cutoff (the SQL views) or a decay, parameter in minutes
+decay_functions = {
+    "cutoff": lambda minutes, p: (minutes <= p).astype(np.float64),
+    "linear": lambda minutes, p: np.clip(1 - minutes / p, 0, None),
+    "exponential": lambda minutes, p: np.exp(-minutes / p),
+}
+
+
+class Zones:
+    """
+    TAZ-level inputs to accessibility: the reachable-pair structure shared by
+    every measure and the per-destination opportunity vectors.
+    """
+
+    def __init__(self, taz_ids, origins, destinations, minutes, es, jobs, has_jobs, bg_ids, bg_weights):
+        self.taz_ids = taz_ids
+        self.origins = origins
+        self.destinations = destinations
+        self.minutes = minutes
+        self.es = es
+        self.jobs = jobs
+        self.has_jobs = has_jobs
+        self.bg_ids = bg_ids
+        self.bg_weights = bg_weights
+
+    @property
+    def n_zones(self):
+        return len(self.taz_ids)
+
+    def reach(self, weights):
+        """
+        Origin x destination CSR matrix of pair weights, pairs with no weight dropped.
+        """
+        keep = weights > 0
+        return sparse.csr_matrix(
+            (weights[keep], (self.origins[keep], self.destinations[keep])),
+            shape=(self.n_zones, self.n_zones),
+        )
+
+
+def load_zones(dbname, limit=None):
+    """
+    Pulls the matrix pairs, ES counted once per TAZ, jobs spread to TAZ by the
+    bg_to_taz area weights, and those weights as a block group x TAZ matrix.
+    """
+    where = f"WHERE total_time <= {limit}" if limit is not None else ""
+    pairs = copy_query(dbname, f"SELECT o_taz, d_taz, total_time FROM input.matrix {where}")
+    taz = copy_query(dbname, "SELECT DISTINCT taz FROM input.taz WHERE taz IS NOT NULL")
+    es = copy_query(dbname, """
+        SELECT taz, COUNT(*) AS es_cnt
+        FROM output.es_assignment
+        WHERE taz IS NOT NULL
+        GROUP BY taz
+    """)
+    bg_to_taz = copy_query(dbname, """
+        SELECT DISTINCT bg.taz, bg.geoid, bg.intersection_percent, lj.sum_jobs
+        FROM output.bg_to_taz bg
+        LEFT JOIN output.lodes_jobs lj ON lj.geoid = bg.geoid
+        WHERE bg.taz IS NOT NULL
+    """, dtype={"geoid": str})
+
+    taz_ids = np.unique(np.concatenate([
+        pairs["o_taz"].to_numpy(), pairs["d_taz"].to_numpy(), taz["taz"].to_numpy(), bg_to_taz["taz"].to_numpy(),
+    ]).astype(np.int64))
+    index = lambda ids: np.searchsorted(taz_ids, np.asarray(ids, dtype=np.int64))
+    n_zones = len(taz_ids)
+
+    es_per_taz = np.zeros(n_zones)
+    es_per_taz[index(es["taz"])] = es["es_cnt"].to_numpy()
+
+    with_jobs = bg_to_taz[bg_to_taz["sum_jobs"].notna()]
+    jobs_per_taz = np.bincount(
+        index(with_jobs["taz"]), weights=with_jobs["sum_jobs"] * with_jobs["intersection_percent"], minlength=n_zones
+    )
+    has_jobs = np.bincount(index(with_jobs["taz"]), minlength=n_zones) > 0
+
+    bg_ids, bg_rows = np.unique(bg_to_taz["geoid"].to_numpy(), return_inverse=True)
+    bg_weights = sparse.csr_matrix(
+        (bg_to_taz["intersection_percent"].to_numpy(), (bg_rows, index(bg_to_taz["taz"]))),
+        shape=(len(bg_ids), n_zones),
+    )
+
+    # destinations missing from input.taz drop out of the ES/jobs joins but still count as zones
+    return Zones(
+        taz_ids, index(pairs["o_taz"]), index(pairs["d_taz"]), pairs["total_time"].to_numpy(dtype=np.float64),
+        es_per_taz, jobs_per_taz, has_jobs, bg_ids, bg_weights,
+    )
+
+
+def accessibility(zones, kind, parameter):
+    """
+    Zone, ES and job accessibility per block group for one measure.
+
+    Origin values are sparse matrix-vector products over the reachable pairs,
+    block group values a second product with the bg_to_taz weights. An origin
+    only counts toward a block group when it reaches something, the same as
+    the inner joins in sql/accessibility.sql.
+    """
+    weights = decay_functions[kind](zones.minutes, parameter)
+    reach = zones.reach(weights)
+    reached = reach.copy()
+    reached.data[:] = 1
+
+    opportunities = np.column_stack([np.ones(zones.n_zones), zones.es, zones.jobs])
+    present = np.column_stack([np.ones(zones.n_zones), zones.es > 0, zones.has_jobs])
+    origin_values = reach @ opportunities
+    origin_present = (reached @ present) > 0
+    origin_values[:, 2] = np.round(origin_values[:, 2])
+
+    bg_values = zones.bg_weights @ (origin_values * origin_present)
+    links = zones.bg_weights.copy()
+    links.data[:] = 1  # a zero-area overlap is still a bg_to_taz row
+    bg_present = (links @ origin_present.astype(np.float64)) > 0
+    bg_values[:, 0] = np.round(bg_values[:, 0])
+    bg_values[:, 1] = np.round(bg_values[:, 1])
+    return bg_values, bg_present
+
+
+def write_measure(dbname, label, geoids, values, present, output="output"):
+    """
+    Writes the {output}.transit_{label}* tables with the columns of the SQL views.
+    """
+    tables = [f"transit_{label}min", f"transit_{label}_es", f"transit_{label}_jobs", f"transit_{label}_es_job"]
+    db.drop_relations(dbname, [f"{output}.{table}" for table in tables])  # the sql engine leaves views here
+
+    frames = []
+    for column, (value_name, quantile_name) in enumerate([
+        (f"t_{label}min_zone_cnt", "t_zone_quantile"),
+        ("es_cnt", "t_es_quantile"),
+        ("jobs", "t_jobs_quantile"),
+    ]):
+        rows = present[:, column]
+        frame = pd.DataFrame({"geoid": geoids[rows], value_name: values[rows, column]})
+        frame[quantile_name] = ntile(frame[value_name].to_numpy(), 10, descending=True)
+        frames.append(frame)
+
+    zone_frame, es_frame, jobs_frame = frames
+    es_job = jobs_frame.merge(es_frame, on="geoid")
+    es_job[f"t_{label}_es_job_avg"] = (es_job["t_jobs_quantile"] + es_job["t_es_quantile"]) // 2
+
+    conn = bulk.connect(dbname)
+    bulk.copy_frame(dbname, zone_frame, tables[0], output, indexes=["geoid"], conn=conn)
+    bulk.copy_frame(dbname, es_frame, tables[1], output, indexes=["geoid"], conn=conn)
+    bulk.copy_frame(dbname, jobs_frame, tables[2], output, indexes=["geoid"], conn=conn)
+    bulk.copy_frame(dbname, es_job[["geoid", f"t_{label}_es_job_avg"]], tables[3], output, indexes=["geoid"], conn=conn)
+    with conn.cursor() as cur:
+        cur.execute(f"ALTER TABLE {output}.{tables[2]} ADD COLUMN geometry geometry;")
+        cur.execute(f"""
+            UPDATE {output}.{tables[2]} j SET geometry = cb.geometry
+            FROM input.census_blockgroups cb WHERE cb.geoid = j.geoid;
+        """)
+    conn.commit()
+    conn.close()
+
+
+def transit_access(dbname, measures=(("45", "cutoff", 45),), output="output"):
+    """
+    Transit accessibility for several measures in one pass over the matrix.
+    Each measure is (label, decay, minutes) and writes {output}.transit_{label}min,
+    transit_{label}_es, transit_{label}_jobs and transit_{label}_es_job.
+    """
+    print("\t -> Computing transit accessibility...")
+    cutoffs = [parameter for _, kind, parameter in measures if kind == "cutoff"]
+    limit = max(cutoffs) if len(cutoffs) == len(measures) else None
+    zones = load_zones(dbname, limit)
+
+    for label, kind, parameter in measures:
+        values, present = accessibility(zones, kind, parameter)
+        write_measure(dbname, label, zones.bg_ids, values, present, output)
+        print(f"\t \t -> {label}: {present[:, 0].sum()} block groups")
@@ -0,0 +1,476 @@
+import os
+import io
+import sys
+import json
+import math
+import shutil
+import zipfile
+import argparse
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from pyproj import Transformer
+import db
+import bulk
+import census
+import gtfs
+import load
+import snap
+import tiles
+import access
+import scoring
+import pipeline
+import topology
+import walkshed
+import departures
+import instrument
+import materialize
+
+# every synthetic layer sits on a grid of square block groups starting here (EPSG:26918, around Philadelphia)
+ORIGIN = (480000.0, 4410000.0)
+SRID = 26918
+BLOCK_SIZE = 500  # meters, one block group
+STREET_SPACING = 100  # meters between sidewalk lines
+BLOCK_GROUPS_PER_SIDE = 10  # at scale 1, the grid grows with sqrt(scale) so the area grows with scale
+
+# essential services per block group, by input layer
+es_density = {
+    "senior_srv": 0.3, "grocery_store": 0.5, "health_care": 1.0,
+    "schools_post_secondary": 0.1, "schools_private": 0.2, "schools_public": 0.4,
+}
+
+# (archive path inside the feed zip or None, schema, route_type, street lines between routes, stop spacing m, headway min)
+agency_feeds = {
+    "septa": [("google_bus.zip", "septa_bus", 3, 4, 400, 15), ("google_rail.zip", "septa_rail", 2, 25, 1600, 30)],
+    "nj_transit": [("bus_data.zip", "njtransit_bus", 3, 7, 400, 20), ("rail_data.zip", "njtransit_rail", 2, 35, 2000, 45)],
+    "patco": [("PortAuthorityTransitCorporation.zip", "patco", 1, 50, 1000, 10)],
+}
+
+BENCH_DATE = 20240911  # the service day the bench feeds are counted on
+
+# the ACS columns sql/analysis.sql reads, as in run.py
+acs_variables = [
+    "B11001_001E", "B01003_001E", "B22010_006E", "B22010_003E", "B17017_002E",
+    "B01001_020E", "B01001_021E", "B01001_022E", "B01001_023E", "B01001_024E", "B01001_025E",
+    "B01001_044E", "B01001_045E", "B01001_046E", "B01001_047E", "B01001_048E", "B01001_049E",
+]
+
+
+def grid_side(scale):
+    return max(2, int(round(BLOCK_GROUPS_PER_SIDE * math.sqrt(scale))))
+
+
+def boxes(nx, ny, size, x0, y0):
+    """
+    nx * ny square polygons, row by row.
+    """
+    ix, iy = np.meshgrid(np.arange(nx), np.arange(ny))
+    left, bottom = x0 + ix.ravel() * size, y0 + iy.ravel() * size
+    return shapely.box(left, bottom, left + size, bottom + size)
+
+
+def frame(columns, geometry):
+    return gpd.GeoDataFrame(columns, geometry=geometry, crs=f"EPSG:{SRID}")
+
+
+def random_points(rng, n, extent):
+    x0, y0, x1, y1 = extent
+    return shapely.points(rng.uniform(x0, x1, n), rng.uniform(y0, y1, n))
+
+
+def block_groups(side):
+    n = side * side
+    index = np.arange(n)
+    tract = np.char.zfill((index // 4 + 100).astype(str), 4)
+    geoid = np.char.add(np.char.add(np.char.add("42101", tract), "00"), (index % 4 + 1).astype(str))
+    return frame({"geoid": geoid}, boxes(side, side, BLOCK_SIZE, *ORIGIN))
+
+
+def gis_layers(rng, side):
+    """
+    The GIS layers run.py pulls from the DVRPC portal, with the columns the
+    analysis reads.
+    """
+    extent = (ORIGIN[0], ORIGIN[1], ORIGIN[0] + side * BLOCK_SIZE, ORIGIN[1] + side * BLOCK_SIZE)
+    n_bg = side * side
+    layers = {"census_blockgroups": block_groups(side)}
+
+    # tazs are twice the size of a block group and offset by half of one, so most block groups split between two
+    taz_side = side // 2 + 1
+    taz_geoms = boxes(taz_side, taz_side, 2 * BLOCK_SIZE, ORIGIN[0] - BLOCK_SIZE / 2, ORIGIN[1] - BLOCK_SIZE / 2)
+    layers["taz"] = frame({"taz": np.arange(1, len(taz_geoms) + 1, dtype=np.int32)}, taz_geoms)
+
+    muni_side = max(1, side // 5)
+    muni_geoms = boxes(muni_side, muni_side, side * BLOCK_SIZE / muni_side, *ORIGIN)
+    layers["census_munis"] = frame({
+        "geoid": [f"42101{i:05d}" for i in range(len(muni_geoms))],
+        "namelsad": [f"synthetic {i} township" for i in range(len(muni_geoms))],
+    }, muni_geoms)
+
+    for name, density in es_density.items():
+        n = max(1, int(n_bg * density))
+        points = random_points(rng, n, extent)
+        if name.startswith("schools"):
+            layers[name] = frame({"name": [f"{name} {i}" for i in range(n)]}, points)
+        else:
+            layers[name] = frame({
+                "primary_name": [f"{name} {i}" for i in range(n)],
+                "confidence": rng.uniform(0.3, 1.0, n),
+            }, points)
+
+    n_os = max(1, n_bg // 4)
+    corners = random_points(rng, n_os, extent)
+    sizes = rng.uniform(50, 200, n_os)
+    x, y = shapely.get_x(corners), shapely.get_y(corners)
+    layers["open_space"] = frame({"os_type": rng.choice(["park", "preserve", "farmland"], n_os)},
+                                 shapely.box(x, y, x + sizes, y + sizes))
+
+    n_trails = max(1, side // 2)
+    trails = [shapely.LineString(np.column_stack([
+        rng.uniform(extent[0], extent[2], 4), rng.uniform(extent[1], extent[3], 4)
+    ])) for _ in range(n_trails)]
+    layers["trails"] = frame({
+        "circuit": rng.choice(["Existing", "In Progress"], n_trails),
+        "name": [f"trail {i}" for i in range(n_trails)],
+    }, trails)
+
+    layers["pedestrian_network"] = sidewalks(rng, side)
+    return layers
+
+
+def sidewalks(rng, side, missing=0.05):
+    """
+    A street grid every STREET_SPACING meters, one line per block face, with a
+    share of the segments dropped so the network has dead ends and detours.
+    """
+    n = side * BLOCK_SIZE // STREET_SPACING
+    steps = ORIGIN[0] + np.arange(n + 1) * STREET_SPACING, ORIGIN[1] + np.arange(n + 1) * STREET_SPACING
+    i, j = np.meshgrid(np.arange(n), np.arange(n + 1))
+    i, j = i.ravel(), j.ravel()
+    horizontal = np.stack([
+        np.column_stack([steps[0][i], steps[1][j]]), np.column_stack([steps[0][i + 1], steps[1][j]])
+    ], axis=1)
+    vertical = np.stack([
+        np.column_stack([steps[0][j], steps[1][i]]), np.column_stack([steps[0][j], steps[1][i + 1]])
+    ], axis=1)
+    segments = np.concatenate([horizontal, vertical])
+    segments = segments[rng.random(len(segments)) >= missing]
+    return frame({}, shapely.linestrings(segments))
+
+
+def acs_table(layers, rng, variables):
+    """
+    ACS rows as the census api returns them: every value a string.
+    """
+    geoid = layers["census_blockgroups"]["geoid"].to_numpy().astype(str)
+    table = pd.DataFrame({
+        variable.lower(): rng.integers(0, 800, len(geoid)).astype(str) for variable in variables
+    })
+    table["state"] = [g[:2] for g in geoid]
+    table["county"] = [g[2:5] for g in geoid]
+    table["tract"] = [g[5:11] for g in geoid]
+    table["block group"] = [g[11:] for g in geoid]
+    return table
+
+
+def write_lodes(path, layers, rng, blocks_per_group=3):
+    """
+    A gzipped LODES wac file with a few blocks per block group, plus as many
+    again in a county outside the region for the reader to filter out.
+    """
+    geoid = np.repeat(layers["census_blockgroups"]["geoid"].to_numpy().astype(str), blocks_per_group)
+    block = np.tile([f"{100 + k}" for k in range(blocks_per_group)], len(geoid) // blocks_per_group)
+    w_geocode = np.char.add(geoid, block)
+    w_geocode = np.concatenate([w_geocode, [f"42003{g[5:]}" for g in w_geocode]])
+    pd.DataFrame({
+        "w_geocode": w_geocode,
+        "C000": rng.integers(0, 300, len(w_geocode)),
+        "CA01": rng.integers(0, 100, len(w_geocode)),
+    }).to_csv(path, index=False, compression="gzip")
+    return path
+
+
+def write_matrix(path_i, path_o, layers, rng, block_rows=500):
+    """
+    AM_matrix_i_put.csv / o_put.csv for every taz pair: in-vehicle time grows
+    with the distance between the zones, out-of-vehicle time is noise.
+    """
+    taz = layers["taz"]
+    ids = taz["taz"].to_numpy()
+    centroids = shapely.get_coordinates(taz.geometry.centroid.to_numpy())
+    header = pd.Index(ids.astype(str))
+    for path in (path_i, path_o):
+        pd.DataFrame(columns=header).rename_axis("taz").to_csv(path)
+    with open(path_i, "a") as f_i, open(path_o, "a") as f_o:
+        for start in range(0, len(ids), block_rows):
+            rows = slice(start, start + block_rows)
+            distance = np.hypot(*(centroids[rows, None, :] - centroids[None, :, :]).transpose(2, 0, 1))
+            ivt = (distance / 1000 * 3 + rng.uniform(0, 5, distance.shape)).astype(np.float32)
+            ovt = rng.uniform(5, 20, distance.shape).astype(np.float32)
+            for values, f in ((ivt, f_i), (ovt, f_o)):
+                pd.DataFrame(values, index=ids[rows], columns=header).to_csv(f, header=False, float_format="%.2f")
+
+
+def hms(seconds):
+    return [f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in seconds]
+
+
+def gtfs_tables(side, prefix, route_type, every, stop_spacing, headway, to_lonlat):
+    """
+    One agency's feed: straight routes along every `every`th street line in
+    both directions, a stop every stop_spacing meters, and weekday trips every
+    headway minutes from 5am to 11pm.
+    """
+    length = side * BLOCK_SIZE
+    lines = np.arange(0, length + 1, STREET_SPACING * every)
+    along = np.arange(0, length + 1, stop_spacing)
+
+    stops, routes, trips, stop_times = [], [], [], []
+    for axis in (0, 1):
+        for k, offset in enumerate(lines):
+            route_id = f"{prefix}{axis}{k}"
+            x = ORIGIN[0] + (along if axis == 0 else np.full(len(along), offset))
+            y = ORIGIN[1] + (np.full(len(along), offset) if axis == 0 else along)
+            lon, lat = to_lonlat(x, y)
+            stop_ids = [f"{route_id}s{i}" for i in range(len(along))]
+            stops.append(pd.DataFrame({"stop_id": stop_ids, "stop_name": stop_ids, "stop_lat": lat, "stop_lon": lon}))
+            routes.append({"route_id": route_id, "route_short_name": route_id, "route_long_name": route_id,
+                           "route_type": route_type})
+
+            starts = np.arange(5 * 3600, 23 * 3600, headway * 60)
+            travel = int(stop_spacing / (8 if route_type == 3 else 15))  # bus ~30km/h, rail ~55km/h
+            trip_ids = [f"{route_id}t{i}" for i in range(len(starts))]
+            trips.append(pd.DataFrame({"route_id": route_id, "service_id": "wkdy", "trip_id": trip_ids}))
+            times = (starts[:, None] + np.arange(len(along))[None, :] * travel).ravel()
+            stop_times.append(pd.DataFrame({
+                "trip_id": np.repeat(trip_ids, len(along)),
+                "stop_id": np.tile(stop_ids, len(starts)),
+                "arrival_time": hms(times),
+                "departure_time": hms(times),
+                "stop_sequence": np.tile(np.arange(1, len(along) + 1), len(starts)),
+            }))
+
+    return {
+        "stops": pd.concat(stops, ignore_index=True),
+        "routes": pd.DataFrame(routes),
+        "trips": pd.concat(trips, ignore_index=True),
+        "stop_times": pd.concat(stop_times, ignore_index=True),
+        "calendar": pd.DataFrame([{
+            "service_id": "wkdy", "monday": 1, "tuesday": 1, "wednesday": 1, "thursday": 1, "friday": 1,
+            "saturday": 0, "sunday": 0, "start_date": 20240101, "end_date": 20241231,
+        }]),
+        "calendar_dates": pd.DataFrame([{"service_id": "wkdy", "date": 20241128, "exception_type": 2}]),
+        "feed_info": pd.DataFrame([{"feed_publisher_name": prefix, "feed_version": "bench",
+                                    "feed_start_date": "20240101", "feed_end_date": "20241231"}]),
+    }
+
+
+def zip_tables(tables):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, table in tables.items():
+            archive.writestr(f"{name}.txt", table.to_csv(index=False))
+    return buffer.getvalue()
+
+
+def write_feeds(directory, side):
+    """
+    Feed zips in each agency's layout (septa's nested bus/rail zips, one zip
+    per nj transit mode, patco's single zip) and the gtfs_urls pointing at them.
+    """
+    transformer = Transformer.from_crs(SRID, 4326, always_xy=True)
+    urls = {}
+    for agency, feeds in agency_feeds.items():
+        members = {
+            archive: zip_tables(gtfs_tables(side, schema, route_type, every, spacing, headway, transformer.transform))
+            for archive, schema, route_type, every, spacing, headway in feeds
+        }
+        if agency == "septa":
+            path = os.path.join(directory, "gtfs_public.zip")
+            with zipfile.ZipFile(path, "w") as outer:
+                for archive, content in members.items():
+                    outer.writestr(archive, content)
+            paths = [path]
+        else:
+            paths = []
+            for archive, content in members.items():
+                paths.append(os.path.join(directory, archive))
+                with open(paths[-1], "wb") as f:
+                    f.write(content)
+        urls[agency] = ["file://" + os.path.abspath(path) for path in paths]
+    return urls
+
+
+def generate(directory, scale=1, seed=0, acs_variables=()):
+    """
+    Writes the synthetic inputs for one scale into directory: matrix csvs and
+    gtfs zips and the LODES file on disk, GIS layers and ACS rows returned as frames.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    side = grid_side(scale)
+    layers = gis_layers(rng, side)
+    data = {
+        "layers": layers,
+        "acs": acs_table(layers, rng, acs_variables),
+        "lodes": write_lodes(os.path.join(directory, "pa_wac_S000_JT00.csv.gz"), layers, rng),
+        "matrix": [os.path.join(directory, "AM_matrix_i_put.csv"), os.path.join(directory, "AM_matrix_o_put.csv")],
+        "gtfs_urls": write_feeds(directory, side),
+    }
+    write_matrix(*data["matrix"], layers, rng)
+    data["sizes"] = {
+        "block_groups": len(layers["census_blockgroups"]),
+        "taz": len(layers["taz"]),
+        "sidewalk_segments": len(layers["pedestrian_network"]),
+        "essential_services": sum(len(layers[name]) for name in es_density),
+        "matrix_pairs": len(layers["taz"]) ** 2,
+    }
+    return data
+
+
+def sql_stage(dbname, sql):
+    def run():
+        db.reset_analysis(dbname, sql)
+        db.do_analysis(dbname, sql)
+        materialize.built(dbname, db.created_relations(sql))
+    return run
+
+
+def bench_stages(dbname, data, out, pgrouting=False):
+    """
+    The run.py stages on the synthetic inputs, with the default engines. The
+    GIS layers are COPYed straight in (their loaders only differ in where the
+    bytes come from); ACS and LODES go through the census typing and streaming
+    reader, GTFS and the matrix through their loaders.
+    """
+    stages = [
+        pipeline.Stage("acs", lambda: bulk.copy_frame(dbname, census.typed_acs(data["acs"].copy()), "acs_data", "input")),
+        pipeline.Stage("lodes", lambda: bulk.copy_frame(dbname, census.lodes_jobs(data["lodes"], ["42101"]), "lodes_data",
+                                                        "input", indexes=["geoid"])),
+    ]
+    for name, layer in data["layers"].items():
+        stages.append(pipeline.Stage(
+            f"gis:{name}", lambda name=name, layer=layer: bulk.copy_frame(dbname, layer, name, "input"),
+        ))
+    for name, url, feed_schemas in gtfs.resolve_feeds(data["gtfs_urls"]):
+        stages.append(pipeline.Stage(
+            "gtfs:" + "+".join(feed_schemas.values()),
+            lambda name=name, url=url, feed_schemas=feed_schemas: gtfs.load_feed(dbname, name, url, feed_schemas),
+        ))
+    stages.append(pipeline.Stage("matrix", lambda: load.load_matrix(*data["matrix"], dbname, "input", "matrix")))
+    feed_loaders = [stage.name for stage in stages if stage.name.startswith("gtfs:")]
+    loaders = [stage.name for stage in stages if stage.name not in feed_loaders]
+
+    if pgrouting:
+        def route():
+            walkshed.route_parallel(dbname, resume=False, paths=True)
+            walkshed.polys(dbname)
+    else:
+        route = lambda: walkshed.route_all(dbname, contract=True)
+
+    def network():
+        sql_stage(dbname, './sql/network.sql')()
+        topology.build_topology(dbname)
+
+    def count_departures():
+        departures.departures(dbname, [str(BENCH_DATE)])
+        sql_stage(dbname, './sql/transit_departs.sql')()
+
+    stages += [
+        pipeline.Stage("analysis", sql_stage(dbname, './sql/analysis.sql'), deps=loaders),
+        pipeline.Stage("accessibility", lambda: access.transit_access(dbname), deps=["analysis"]),
+        pipeline.Stage("stops", sql_stage(dbname, './sql/stops.sql'), deps=["analysis"] + feed_loaders),
+        pipeline.Stage("departures", count_departures, deps=["stops"]),
+        pipeline.Stage("network", network, deps=["gis:pedestrian_network"]),
+        pipeline.Stage("transit_poi", lambda: snap.snap_points(dbname), deps=["network", "stops"]),
+        pipeline.Stage("es_walk", lambda: snap.es_walk_time(dbname), deps=["transit_poi"]),
+        pipeline.Stage("walksheds", route, deps=["transit_poi"]),
+        pipeline.Stage("coverage", sql_stage(dbname, './sql/coverage.sql'), deps=["walksheds"]),
+        pipeline.Stage("scoring:sql", sql_stage(dbname, './sql/scoring.sql'),
+                       deps=["analysis", "accessibility", "departures", "coverage"]),
+        pipeline.Stage("scoring", lambda: scoring.run_scoring(dbname), deps=["scoring:sql"]),
+        pipeline.Stage("tiles", lambda: tiles.export_layers(dbname, "ndjson", directory=os.path.join(out, "tiles"),
+                                                            tiles=shutil.which("tippecanoe") is not None),
+                       deps=["scoring", "walksheds"]),
+    ]
+    return stages
+
+
+def run_scale(dbname, scale, seed, out, pgrouting=False):
+    """
+    Builds a fresh database from the synthetic inputs at one scale, one stage
+    at a time so timings don't overlap, and returns the run report.
+    """
+    print(f"Benchmark at scale {scale}...")
+    data = generate(os.path.join(out, "data", f"scale-{scale}"), scale, seed, acs_variables)
+    db.ensure_database(dbname, rebuild=True)
+    db.create_schemas(dbname, ["input", "network", "output"])
+    db.create_extensions(dbname)
+
+    instrument.start(dbname, os.path.join(out, "runs"))
+    try:
+        pipeline.run(dbname, bench_stages(dbname, data, out, pgrouting), max_workers=1)
+    finally:
+        report = instrument.finish()
+    report.update({"scale": scale, "seed": seed, "sizes": data["sizes"], "pgrouting": pgrouting})
+    return report
+
+
+def baseline_path(out, scale):
+    return os.path.join(out, f"baseline-scale-{scale}.json")
+
+
+def scaling_table(reports):
+    """
+    {stage: {scale: wall}} across the scales that ran.
+    """
+    curve = {}
+    for report in reports:
+        for stage in report["stages"]:
+            curve.setdefault(stage["name"], {})[report["scale"]] = stage["wall"]
+    return curve
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times every pipeline stage on seeded synthetic data.")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1], help="area multipliers, 1 is 100 block groups")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dbname", default="eta_bench", help="dropped and rebuilt for every scale")
+    parser.add_argument("--out", default="benchmarks", help="baselines, results and the generated inputs")
+    parser.add_argument("--pgrouting", action="store_true", help="route walksheds with route_parallel and polys")
+    parser.add_argument("--save-baseline", action="store_true", help="record these results as the baselines")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown against the baseline that fails the run")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(args.out, "results"), exist_ok=True)
+    stamp = f"{datetime.now():%Y%m%d-%H%M%S}"
+    reports, regressed = [], []
+    for scale in args.scales:
+        scale = int(scale) if float(scale).is_integer() else scale
+        report = run_scale(args.dbname, scale, args.seed, args.out, args.pgrouting)
+        reports.append(report)
+        path = os.path.join(args.out, "results", f"scale-{scale}-{stamp}.json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+        baseline = baseline_path(args.out, scale)
+        if args.save_baseline:
+            shutil.copyfile(path, baseline)
+            print(f"\t -> Baseline saved: {baseline}")
+        elif os.path.exists(baseline):
+            for name, before, after in instrument.compare(baseline, path, args.threshold):
+                regressed.append(name)
+                print(f"\t -> REGRESSION scale {scale} {name}: {before:.1f}s -> {after:.1f}s ({after / before - 1:+.0%})")
+
+    if len(reports) > 1:
+        curve = scaling_table(reports)
+        with open(os.path.join(args.out, "results", f"scaling-{stamp}.json"), "w") as f:
+            json.dump({"sizes": {r["scale"]: r["sizes"] for r in reports}, "stages": curve}, f, indent=2)
+        print("Stage wall time by scale:")
+        for name, walls in curve.items():
+            print(f"\t {name}: " + ", ".join(f"{scale}x {wall:.1f}s" for scale, wall in walls.items()))
+
+    if regressed:
+        sys.exit(1)
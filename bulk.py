@@ -0,0 +1,204 @@
+import os
+import io
+import psycopg2
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from dotenv import load_dotenv
+import instrument
+
+load_dotenv()
+
+host = os.getenv("HOST")
+user = os.getenv("USER")
+password = os.getenv("PASSWORD")
+port = os.getenv("PORT")
+
+# identifier-like columns that must stay text no matter what pandas guesses,
+# so joins across agencies never need ::TEXT casts
+TEXT_COLUMNS = {
+    "agency_id", "route_id", "trip_id", "service_id", "stop_id", "shape_id",
+    "block_id", "parent_station", "zone_id", "stop_code", "geoid", "w_geocode",
+}
+
+COPY_CHUNK_ROWS = 100_000
+
+
+def connect(dbname):
+    """
+    Opens a psycopg2 connection to the db.
+    """
+    return psycopg2.connect(
+        host=host, port=port, database=dbname, user=user, password=password
+    )
+
+
+def quote(identifier):
+    """
+    Double quotes an identifier so names like "block group" survive.
+    """
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def geometry_type(geoseries):
+    """
+    Single geometry type of the column, or the generic type when mixed.
+    """
+    types = geoseries.geom_type.dropna().unique()
+    return types[0] if len(types) == 1 else "Geometry"
+
+
+def srid_of(frame, column, srid=None):
+    """
+    SRID of a geometry column, from the frame's crs unless given.
+    """
+    if srid is None and frame[column].crs is not None:
+        srid = frame[column].crs.to_epsg()
+    return srid or 0
+
+
+def infer_types(frame, dtypes=None, srid=None):
+    """
+    Explicit postgres column types for a DataFrame.
+    """
+    dtypes = dtypes or {}
+    columns = {}
+    for column in frame.columns:
+        series = frame[column]
+        if column in dtypes:
+            columns[column] = dtypes[column]
+        elif isinstance(series.dtype, gpd.array.GeometryDtype):
+            columns[column] = f"geometry({geometry_type(series)}, {srid_of(frame, column, srid)})"
+        elif column in TEXT_COLUMNS:
+            columns[column] = "TEXT"
+        elif pd.api.types.is_bool_dtype(series):
+            columns[column] = "BOOLEAN"
+        elif pd.api.types.is_integer_dtype(series):
+            columns[column] = "INTEGER" if series.dtype.itemsize <= 4 else "BIGINT"
+        elif pd.api.types.is_float_dtype(series):
+            columns[column] = "REAL" if series.dtype.itemsize <= 4 else "DOUBLE PRECISION"
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            columns[column] = "TIMESTAMP"
+        else:
+            columns[column] = "TEXT"
+    return columns
+
+
+def match_types(frame, columns):
+    """
+    Casts columns pandas read as float (because of nulls) back to nullable
+    integers where the target column is an integer type.
+    """
+    frame = frame.copy()
+    for column, pg_type in columns.items():
+        if pg_type in ("INTEGER", "BIGINT") and column in frame and pd.api.types.is_float_dtype(frame[column]):
+            frame[column] = frame[column].astype("Int64")
+    return frame
+
+
+def type_key(pg_type):
+    """
+    Compares a declared column type with format_type's spelling of it.
+    """
+    key = "".join(pg_type.lower().split())
+    return {"timestamp": "timestampwithouttimezone"}.get(key, key)
+
+
+def create_table(conn, schema, table, columns, if_exists="replace"):
+    """
+    Creates the target table from a {column: type} mapping. if_exists="truncate"
+    empties an existing table instead of dropping it, so views built on it
+    survive, unless its columns no longer match and it has to be replaced.
+    """
+    column_sql = ", ".join(f"{quote(name)} {pg_type}" for name, pg_type in columns.items())
+    with conn.cursor() as cur:
+        if if_exists == "truncate":
+            cur.execute("""
+                SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped ORDER BY attnum
+            """, (f"{schema}.{quote(table)}",))
+            existing = [(name, type_key(pg_type)) for name, pg_type in cur.fetchall()]
+            if existing and existing != [(name, type_key(pg_type)) for name, pg_type in columns.items()]:
+                if_exists = "replace"
+        if if_exists == "replace":
+            cur.execute(f"DROP TABLE IF EXISTS {schema}.{quote(table)} CASCADE;")
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{quote(table)} ({column_sql});")
+        if if_exists == "truncate":
+            cur.execute(f"TRUNCATE {schema}.{quote(table)};")
+    conn.commit()
+
+
+def to_copy_frame(frame, srid=None):
+    """
+    Frame ready for CSV COPY: geometries become hex EWKB with their SRID.
+    """
+    rows = pd.DataFrame(frame, copy=False)
+    for column in geometry_columns_of(frame):
+        geoms = shapely.set_srid(np.asarray(frame[column].values, dtype=object), srid_of(frame, column, srid))
+        rows = rows.assign(**{column: shapely.to_wkb(geoms, hex=True, include_srid=True)})
+    return rows
+
+
+def copy_rows(conn, frame, schema, table, srid=None, chunk_rows=COPY_CHUNK_ROWS, commit=True):
+    """
+    Streams the rows of a frame into an existing table with COPY ... FROM STDIN.
+    Pass commit=False to keep the rows in the caller's transaction.
+    """
+    frame = to_copy_frame(frame, srid)
+    column_sql = ", ".join(quote(name) for name in frame.columns)
+    with conn.cursor() as cur:
+        for start in range(0, len(frame), chunk_rows):
+            buffer = io.StringIO()
+            frame.iloc[start:start + chunk_rows].to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            with instrument.db_time():
+                cur.copy_expert(f"COPY {schema}.{quote(table)} ({column_sql}) FROM STDIN WITH CSV", buffer)
+    if commit:
+        conn.commit()
+    instrument.add(rows=len(frame))
+    return len(frame)
+
+
+def create_indexes(conn, schema, table, indexes=None, geometry_columns=None):
+    """
+    Builds btree indexes on the given columns and GiST indexes on geometry
+    columns, after the data is in.
+    """
+    with conn.cursor() as cur:
+        for index in indexes or []:
+            columns = [index] if isinstance(index, str) else list(index)
+            name = f"{table}_{'_'.join(columns)}_idx".replace(" ", "_")
+            column_sql = ", ".join(quote(column) for column in columns)
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {quote(name)} ON {schema}.{quote(table)} ({column_sql});")
+        for column in geometry_columns or []:
+            name = f"{table}_{column}_gist"
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {quote(name)} ON {schema}.{quote(table)} USING GIST ({quote(column)});")
+    conn.commit()
+
+
+def geometry_columns_of(frame):
+    """
+    Names of the geometry columns in a frame.
+    """
+    return [c for c in frame.columns if isinstance(frame[c].dtype, gpd.array.GeometryDtype)]
+
+
+def copy_frame(dbname, frame, table, schema, if_exists="replace", dtypes=None, indexes=None, srid=None, conn=None):
+    """
+    Bulk loads a (Geo)DataFrame with COPY in place of to_sql/to_postgis: explicit
+    column types, geometry as EWKB, indexes built after the load.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = connect(dbname)
+
+    frame = frame.copy()
+    frame.columns = [str(c).lower() for c in frame.columns]
+    create_table(conn, schema, table, infer_types(frame, dtypes, srid), if_exists)
+    rows = copy_rows(conn, frame, schema, table, srid)
+    create_indexes(conn, schema, table, indexes, geometry_columns_of(frame))
+
+    if own_conn:
+        conn.close()
+    return rows
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import requests
+from urllib.parse import urlencode
+from dotenv import load_dotenv
+import instrument
+
+load_dotenv()
+
+# on-disk download cache shared by every loader
+cache_dir = os.getenv("CACHE_DIR", ".cache")
+# seconds a cached response is trusted before it is revalidated with the server
+cache_ttl = int(os.getenv("CACHE_TTL", 24 * 60 * 60))
+# run entirely from the cache, never touching the network
+offline = os.getenv("OFFLINE", "false").lower() in ("1", "true", "yes")
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def cache_key(url, params=None):
+    """
+    Stable key for a request: the url plus its sorted query params.
+    """
+    if params:
+        url = f"{url}?{urlencode(sorted(params.items()))}"
+    return url
+
+
+def _lock_for(key):
+    with _locks_guard:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def _entry_path(key):
+    return os.path.join(cache_dir, "index", hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+
+def _blob_path(digest):
+    return os.path.join(cache_dir, "blobs", digest[:2], digest)
+
+
+def _read_entry(key):
+    path = _entry_path(key)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        entry = json.load(f)
+    return entry if os.path.exists(_blob_path(entry["sha256"])) else None
+
+
+def _write_entry(key, entry):
+    path = _entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False) as f:
+        json.dump(entry, f)
+    os.replace(f.name, path)
+
+
+def _store(response):
+    """
+    Streams a response body into the blob store, named by its sha256.
+    """
+    blob_root = os.path.join(cache_dir, "blobs")
+    os.makedirs(blob_root, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile("wb", dir=blob_root, delete=False) as f:
+        for block in response.iter_content(chunk_size=1024 * 1024):
+            digest.update(block)
+            f.write(block)
+            size += len(block)
+    sha = digest.hexdigest()
+    target = _blob_path(sha)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(f.name, target)
+    return sha, size
+
+
+def fetch(url, params=None, session=None, ttl=None, secret_params=None):
+    """
+    Path to a cached copy of the response for url/params, downloading or
+    revalidating (ETag/Last-Modified) only when the entry is older than the TTL.
+    secret_params (tokens) are sent but not part of the cache key.
+    file:// urls are local files and are read in place, uncached.
+    """
+    if url.startswith("file://"):
+        return url[len("file://"):]
+    key = cache_key(url, params)
+    ttl = cache_ttl if ttl is None else ttl
+
+    with _lock_for(key):
+        entry = _read_entry(key)
+        if entry and (offline or time.time() - entry["fetched_at"] < ttl):
+            return _blob_path(entry["sha256"])
+        if offline:
+            raise FileNotFoundError(f"Offline and not cached: {key}")
+
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        session = session or requests
+        request_params = {**(params or {}), **(secret_params or {})} or None
+        with session.get(url, params=request_params, headers=headers, stream=True, timeout=300) as response:
+            if response.status_code == 304 and entry:
+                entry["fetched_at"] = time.time()
+                _write_entry(key, entry)
+                return _blob_path(entry["sha256"])
+            response.raise_for_status()
+            sha, size = _store(response)
+            instrument.add(bytes=size)
+            _write_entry(key, {
+                "url": key,
+                "sha256": sha,
+                "size": size,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+            })
+        return _blob_path(sha)
+
+
+def evict(url, params=None):
+    """
+    Drops the index entry for a request, e.g. when the server returned an error body.
+    """
+    key = cache_key(url, params)
+    with _lock_for(key):
+        path = _entry_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def read_bytes(url, **kwargs):
+    """
+    Cached response body as bytes.
+    """
+    with open(fetch(url, **kwargs), "rb") as f:
+        return f.read()
+
+
+def get_json(url, **kwargs):
+    """
+    Cached response body parsed as JSON.
+    """
+    with open(fetch(url, **kwargs), "r") as f:
+        return json.load(f)
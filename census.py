@@ -1,9 +1,9 @@
 import os
 import pandas as pd
-import requests
-import zipfile
-import io
-from sqlalchemy import create_engine
+import bulk
+import cache
+import instrument
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -14,54 +14,89 @@ user = os.getenv("USER")
 password = os.getenv("PASSWORD")
 port = os.getenv("PORT")
 
+# geography columns the census api appends to each row, everything else is a count
+acs_geo_columns = ["state", "county", "tract", "block group"]
 
-def load_acs_data(variables, year, state_county_pairs, dbname, schema):
+# LODES files are published per state under the postal code
+lodes_states = {"34": "nj", "42": "pa"}
+
+LODES_CHUNK_ROWS = 100_000
+
+
+def typed_acs(frame):
     """
-    Get census data
+    Lower-cases the columns and makes every ACS estimate an integer, the api
+    returns them all as strings.
     """
-    print("\t -> Loading ACS data table...")
-    base_url = f"https://api.census.gov/data/{year}/acs/acs5"
-    all_data = []
+    frame.columns = [column.lower() for column in frame.columns]
+    for column in frame.columns.difference(acs_geo_columns):
+        frame[column] = pd.to_numeric(frame[column]).astype("Int64")
+    return frame
 
-    for state, counties in state_county_pairs:
-        for county in counties:
-            params = {
-                "get": ",".join(variables),
-                "for": "block group:*",
-                "in": f"state:{state} county:{county}"
-            }
 
-            response = requests.get(base_url, params=params)
-            response.raise_for_status()
+def fetch_acs_county(base_url, variables, state, county):
+    """
+    One county's block groups from the census api, typed.
+    """
+    params = {
+        "get": ",".join(variables),
+        "for": "block group:*",
+        "in": f"state:{state} county:{county}"
+    }
+    with instrument.span(f"acs {state}{county}"):
+        data = cache.get_json(base_url, params=params)
+    return typed_acs(pd.DataFrame(data[1:], columns=data[0]))
+
 
-            data = response.json()
-            df = pd.DataFrame(data[1:], columns=data[0])
-            all_data.append(df)
+def load_acs_data(variables, year, state_county_pairs, dbname, schema, max_workers=4):
+    """
+    Get census data, one concurrent api request per county
+    """
+    print("\t -> Loading ACS data table...")
+    base_url = f"https://api.census.gov/data/{year}/acs/acs5"
 
-    combined_df = pd.concat(all_data, ignore_index=True)
-    combined_df.columns = map(str.lower, combined_df.columns)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(instrument.bind(fetch_acs_county), base_url, variables, state, county)
+            for state, counties in state_county_pairs for county in counties
+        ]
+        combined_df = pd.concat([future.result() for future in futures], ignore_index=True)
 
-    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
-    combined_df.to_sql("acs_data", engine, schema=schema, if_exists='replace', index=False)
+    bulk.copy_frame(dbname, combined_df, "acs_data", schema, if_exists="truncate")
 
 
-def load_lodes_data(dbname, schema):
+def lodes_jobs(path, counties, chunk_rows=LODES_CHUNK_ROWS):
     """
-    Get LODES data for NJ and PA job totals
+    Streams a gzipped LODES wac file in chunks, keeping only the blocks in the
+    given state+county fips codes, and sums their jobs (c000) by block group.
     """
-    print("\t -> Loading LODES job data...")
-    lodes_states = ['nj', 'pa']
-    combined_df = pd.DataFrame()
+    counties = list(counties)
+    totals = pd.Series(dtype="int64")
+    chunks = pd.read_csv(
+        path,
+        compression="gzip",
+        usecols=["w_geocode", "C000"],
+        dtype={"w_geocode": str, "C000": "int64"},
+        chunksize=chunk_rows,
+    )
+    for chunk in chunks:
+        chunk = chunk[chunk["w_geocode"].str[:5].isin(counties)]
+        jobs = chunk.groupby(chunk["w_geocode"].str[:12])["C000"].sum()
+        totals = totals.add(jobs, fill_value=0)
+    return totals.astype("int64").rename_axis("geoid").rename("sum_jobs").reset_index()
 
-    for state in lodes_states:
-        url = f"https://lehd.ces.census.gov/data/lodes/LODES8/{state}/wac/{state}_wac_S000_JT00_2021.csv.gz"
-        response = requests.get(url)
-        zipped_file = io.BytesIO(response.content)
-        state_df = pd.read_csv(zipped_file, compression='gzip')
 
-        combined_df = pd.concat([combined_df, state_df], ignore_index=True)
+def load_lodes_data(dbname, schema, state_county_pairs, year=2021):
+    """
+    Get LODES job totals by block group for the region's counties
+    """
+    print("\t -> Loading LODES job data...")
+    jobs = []
 
-    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
-    combined_df.columns = map(str.lower, combined_df.columns)
-    combined_df.to_sql("lodes_data", engine, schema=schema, if_exists='replace', index=False)
+    for state, counties in state_county_pairs:
+        url = f"https://lehd.ces.census.gov/data/lodes/LODES8/{lodes_states[state]}/wac/{lodes_states[state]}_wac_S000_JT00_{year}.csv.gz"
+        with instrument.span(f"lodes {lodes_states[state]}"):
+            jobs.append(lodes_jobs(cache.fetch(url), [state + county for county in counties]))
 
+    combined_df = pd.concat(jobs, ignore_index=True)
+    bulk.copy_frame(dbname, combined_df, "lodes_data", schema, if_exists="truncate", indexes=["geoid"])
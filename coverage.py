@@ -0,0 +1,206 @@
+import os
+import math
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+import bulk
+import db
+
+load_dotenv()
+
+host = os.getenv("HOST")
+user = os.getenv("USER")
+password = os.getenv("PASSWORD")
+port = os.getenv("PORT")
+
+
+def polygon_edges(geom):
+    """
+    Every ring edge of a (multi)polygon as x0, y0, x1, y1 arrays.
+    """
+    rings = shapely.get_rings(shapely.get_parts(geom))
+    coords, ring_idx = shapely.get_coordinates(rings, return_index=True)
+    same_ring = ring_idx[1:] == ring_idx[:-1]
+    start, end = coords[:-1][same_ring], coords[1:][same_ring]
+    return start[:, 0], start[:, 1], end[:, 0], end[:, 1]
+
+
+def burn(geom, x0, y0, res, width, height):
+    """
+    Even-odd scanline fill of a (multi)polygon onto a grid whose lower-left
+    corner is x0, y0. A cell is burned when its center falls inside the polygon.
+
+    Returns the row/column window the polygon covers and a boolean mask for
+    that window, or None when it misses the grid (or is empty, as a clip of
+    a polygon that only touches the tile is).
+    """
+    if shapely.is_empty(geom):
+        return None
+    minx, miny, maxx, maxy = geom.bounds
+    c0 = min(max(int(math.floor((minx - x0) / res)), 0), width)
+    c1 = min(max(int(math.ceil((maxx - x0) / res)), 0), width)
+    r0 = min(max(int(math.floor((miny - y0) / res)), 0), height)
+    r1 = min(max(int(math.ceil((maxy - y0) / res)), 0), height)
+    if c0 >= c1 or r0 >= r1:
+        return None
+
+    ex0, ey0, ex1, ey1 = polygon_edges(geom)
+    ys = y0 + (np.arange(r0, r1) + 0.5) * res
+
+    # edges crossing each row center, half-open so shared vertices count once
+    crosses = (ey0[None, :] <= ys[:, None]) != (ey1[None, :] <= ys[:, None])
+    rows, edges = np.nonzero(crosses)
+    t = (ys[rows] - ey0[edges]) / (ey1[edges] - ey0[edges])
+    xs = ex0[edges] + t * (ex1[edges] - ex0[edges])
+
+    # every crossing toggles the cells whose centers lie to its right
+    cols = np.floor((xs - x0) / res - 0.5).astype(np.int64) + 1 - c0
+    cols = np.clip(cols, 0, c1 - c0)
+    toggles = np.zeros((r1 - r0, c1 - c0 + 1), dtype=np.int32)
+    np.add.at(toggles, (rows, cols), 1)
+    mask = (np.cumsum(toggles, axis=1)[:, :-1] % 2).astype(bool)
+    return slice(r0, r1), slice(c0, c1), mask
+
+
+def get_layers(dbname, srid=26918):
+    """
+    Block groups and walkshed polygons in the grid crs.
+    """
+    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
+    bg = gpd.read_postgis(
+        f"SELECT geoid, ST_Transform(geometry, {srid}) AS geometry FROM input.census_blockgroups ORDER BY geoid",
+        engine, geom_col="geometry")
+    ws = gpd.read_postgis(
+        f"SELECT ST_Transform(geom, {srid}) AS geom FROM network.transit_poi_isochrones",
+        engine, geom_col="geom")
+    engine.dispose()
+
+    ws = ws[shapely.area(ws.geometry.values) > 0]  # point/line hulls cover nothing
+    return bg.reset_index(drop=True), ws.reset_index(drop=True)
+
+
+def raster_coverage(bg_geoms, ws_geoms, resolution=10, tile_size=2048):
+    """
+    Share of each block group covered by the union of the walksheds, from cell
+    counts on a shared grid. Memory is bounded by the tile size, not the region.
+
+    Returns (covered_cells, total_cells) per block group.
+    """
+    minx, miny, maxx, maxy = shapely.total_bounds(bg_geoms)
+    x_origin = math.floor(minx / resolution) * resolution
+    y_origin = math.floor(miny / resolution) * resolution
+    n_cols = int(math.ceil((maxx - x_origin) / resolution))
+    n_rows = int(math.ceil((maxy - y_origin) / resolution))
+
+    bg_tree = shapely.STRtree(bg_geoms)
+    ws_tree = shapely.STRtree(ws_geoms)
+    total = np.zeros(len(bg_geoms), dtype=np.int64)
+    covered = np.zeros(len(bg_geoms), dtype=np.int64)
+
+    tile_span = tile_size * resolution
+    for tile_row in range(0, n_rows, tile_size):
+        for tile_col in range(0, n_cols, tile_size):
+            x0 = x_origin + tile_col * resolution
+            y0 = y_origin + tile_row * resolution
+            width = min(tile_size, n_cols - tile_col)
+            height = min(tile_size, n_rows - tile_row)
+            tile = shapely.box(x0, y0, x0 + tile_span, y0 + tile_span)
+
+            bg_idx = bg_tree.query(tile, predicate="intersects")
+            if not len(bg_idx):
+                continue
+
+            labels = np.full((height, width), -1, dtype=np.int32)
+            for i in bg_idx:
+                geom = shapely.clip_by_rect(bg_geoms[i], *tile.bounds)
+                burned = burn(geom, x0, y0, resolution, width, height)
+                if burned is not None:
+                    rows, cols, mask = burned
+                    labels[rows, cols][mask] = i
+
+            walked = np.zeros((height, width), dtype=bool)
+            for i in ws_tree.query(tile, predicate="intersects"):
+                geom = shapely.clip_by_rect(ws_geoms[i], *tile.bounds)
+                burned = burn(geom, x0, y0, resolution, width, height)
+                if burned is not None:
+                    rows, cols, mask = burned
+                    walked[rows, cols] |= mask
+
+            inside = labels >= 0
+            total += np.bincount(labels[inside], minlength=len(bg_geoms))
+            covered += np.bincount(labels[inside & walked], minlength=len(bg_geoms))
+
+    return covered, total
+
+
+def exact_coverage(bg_geoms, ws_geoms, indexes):
+    """
+    Vector coverage for the given block groups, the same math as the
+    output.transit_ws view but one block group at a time.
+    """
+    ws_tree = shapely.STRtree(ws_geoms)
+    percents = np.zeros(len(indexes))
+    for n, i in enumerate(indexes):
+        hits = ws_tree.query(bg_geoms[i], predicate="intersects")
+        if len(hits):
+            walked = shapely.union_all(ws_geoms[hits])
+            percents[n] = shapely.area(shapely.intersection(walked, bg_geoms[i])) / shapely.area(bg_geoms[i])
+    return percents
+
+
+def write_transit_ws(dbname, geoids, percents):
+    """
+    Writes output.transit_ws with the same columns as the materialized view in coverage.sql.
+    """
+    frame = pd.DataFrame({"geoid": geoids, "intersection_percent": percents})
+    frame = frame[frame["intersection_percent"] > 0]
+
+    db.drop_relations(dbname, ["output.transit_ws"])  # the vector mode leaves a materialized view here
+    conn = bulk.connect(dbname)
+    bulk.copy_frame(dbname, frame, "transit_ws_coverage", "output", conn=conn)
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE
+                output.transit_ws AS
+            SELECT
+                c.geoid,
+                cb.geometry,
+                c.intersection_percent,
+                NTILE(10) OVER (ORDER BY c.intersection_percent DESC) AS walkshed_quantile
+            FROM
+                output.transit_ws_coverage c
+            JOIN input.census_blockgroups cb ON cb.geoid = c.geoid;
+        """)
+    conn.commit()
+    conn.close()
+
+
+def transit_ws(dbname, resolution=10, tile_size=2048, srid=26918, check_sample=200, seed=0):
+    """
+    Rasterized stand-in for the output.transit_ws view: burns walksheds and block
+    groups onto one grid and reports the error against the exact vector result
+    for a sample of block groups.
+    """
+    print(f"\t -> Rasterizing walkshed coverage at {resolution}m...")
+    bg, ws = get_layers(dbname, srid)
+    bg_geoms = np.asarray(bg.geometry.values, dtype=object)
+    ws_geoms = np.asarray(ws.geometry.values, dtype=object)
+
+    covered, total = raster_coverage(bg_geoms, ws_geoms, resolution, tile_size)
+    percents = np.divide(covered, total, out=np.zeros(len(total)), where=total > 0)
+
+    # block groups smaller than a cell fall back to the exact answer
+    tiny = np.flatnonzero(total == 0)
+    if len(tiny):
+        percents[tiny] = exact_coverage(bg_geoms, ws_geoms, tiny)
+
+    if check_sample:
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(len(bg_geoms), min(check_sample, len(bg_geoms)), replace=False)
+        error = np.abs(percents[sample] - exact_coverage(bg_geoms, ws_geoms, sample))
+        print(f"\t \t -> error vs vector on {len(sample)} block groups: mean {error.mean():.4f}, max {error.max():.4f}")
+
+    write_transit_ws(dbname, bg["geoid"].to_numpy(), percents)
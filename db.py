@@ -1,8 +1,9 @@
 import os
 import psycopg2
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
 import re
+import sqlgraph
+import instrument
 
 load_dotenv()
 
@@ -30,6 +31,28 @@ def create_database(dbname):
     pgconn.close()
 
 
+def ensure_database(dbname, rebuild=False):
+    """
+    Creates the PostgreSQL db if it is missing, dropping it first when rebuild is set.
+    """
+    if rebuild:
+        create_database(dbname)
+        return
+
+    pgconn = psycopg2.connect(
+        host=host, port=port, database=database, user=user, password=password
+    )
+    pgconn.autocommit = True
+    cur = pgconn.cursor()
+
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (dbname,))
+    if not cur.rowcount:
+        print("\t -> Creating database...")
+        cur.execute(f"CREATE DATABASE {dbname};")
+    cur.close()
+    pgconn.close()
+
+
 def create_schemas(dbname, schemas):
     """
     Creates PostgreSQL schemas with the given names in the db.
@@ -77,42 +100,84 @@ def create_extensions(dbname):
     conn.close()
 
 
-def do_analysis(dbname, sql):
+def read_sql(sql, params=None):
     """
-    Executes the analysis sql.  Messy but working....
+    Reads a sql script and fills its {{name}} placeholders, {{output}} being
+    the schema the script writes its scenario-specific relations to.
     """
-    print("\t -> Running SQL...")
-    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
-
     with open(sql, 'r') as sql_file:
         sql_contents = sql_file.read()
+    for name, value in {"output": "output", **(params or {})}.items():
+        sql_contents = sql_contents.replace("{{" + name + "}}", str(value))
+    return sql_contents
+
+
+def created_relations(sql, params=None):
+    """
+    Schema-qualified relations a sql script creates, in script order.
+    """
+    sql_contents = read_sql(sql, params)
+
+    pattern = r'CREATE\s+(?:OR\s+REPLACE\s+)?(?:MATERIALIZED\s+)?(?:VIEW|TABLE)\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+\.\w+)'
+    names = re.findall(pattern, sql_contents, flags=re.IGNORECASE)
+    return list(dict.fromkeys(name.lower() for name in names))
+
+
+def drop_relations(dbname, relations):
+    """
+    Drops tables, views and materialized views by name, whatever kind they turn out to be.
+    """
+    kinds = {"r": "TABLE", "v": "VIEW", "m": "MATERIALIZED VIEW"}
+    conn = psycopg2.connect(
+        host=host, port=port, database=dbname, user=user, password=password
+    )
+    cur = conn.cursor()
+    conn.autocommit = True
+
+    for relation in relations:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (relation,))
+        row = cur.fetchone()
+        if row and row[0] in kinds:
+            cur.execute(f"DROP {kinds[row[0]]} IF EXISTS {relation} CASCADE;")
+    cur.close()
+    conn.close()
+
+
+def refresh_views(dbname, views):
+    """
+    Refreshes materialized views concurrently, so readers keep the old rows
+    until each one is swapped. Every view needs a unique index.
+    """
+    conn = psycopg2.connect(
+        host=host, port=port, database=dbname, user=user, password=password
+    )
+    cur = conn.cursor()
+    conn.autocommit = True
+
+    for view in views:
+        print(f"\t \t -> refreshing {view}...")
+        with instrument.span(f"refresh {view}", "sql"):
+            cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view};")
+    cur.close()
+    conn.close()
+
+
+def reset_analysis(dbname, sql, params=None):
+    """
+    Drops whatever a sql script created last time so it can be rerun as is.
+    """
+    drop_relations(dbname, reversed(created_relations(sql, params)))
+
+
+def do_analysis(dbname, sql, workers=4, timeout=None, params=None):
+    """
+    Executes a sql script, running statements that don't touch the same
+    relations in parallel. Raises on the first failure; timeout is in seconds
+    per statement, params fill the script's {{name}} placeholders.
+    """
+    print("\t -> Running SQL...")
+
+    sql_contents = read_sql(sql, params)
 
-    transaction_blocks = re.split(r'COMMIT;\s*\n', sql_contents)
-
-    with engine.connect() as connection:
-        try:
-            for transaction_block in transaction_blocks:
-                transaction_block = transaction_block.strip()
-                if not transaction_block:
-                    continue
-                
-                comment_matches = re.findall(r'--(.*)', transaction_block)
-                if comment_matches:
-                    for comment in comment_matches:
-                        print(f"\t \t -> {comment.strip()}\n")
-
-                try:
-                    connection.execute(text(transaction_block))
-                except Exception as e:
-                    print("Error message:", str(e))
-                    break
-                try:
-                    connection.execute(text('commit;'))
-                except Exception as e:
-                    print("Error during commit:", str(e))
-                    break
-        except:
-            raise
-        
-    connection.close()
-    engine.dispose()
+    with instrument.span(os.path.basename(sql), "script"):
+        sqlgraph.run_script(dbname, sql_contents, workers=workers, timeout=timeout)
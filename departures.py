@@ -0,0 +1,228 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import bulk
+import db
+from graph import copy_query
+
+# gtfs schema -> the label output.all_stops uses for it
+feed_labels = {
+    "septa_bus": "septa_bus",
+    "septa_rail": "septa_rail",
+    "njtransit_bus": "njt_bus",
+    "njtransit_rail": "njt_rail",
+    "patco": "patco",
+}
+
+weekdays = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def gtfs_seconds(times):
+    """
+    GTFS HH:MM:SS strings to seconds after service-day midnight, hours past 24 kept.
+    """
+    parts = pd.Series(times, dtype="string").str.extract(r'^\s*(\d+):(\d{2}):(\d{2})\s*$')
+    seconds = parts[0].astype(float) * 3600 + parts[1].astype(float) * 60 + parts[2].astype(float)
+    return seconds.to_numpy()
+
+
+def window_seconds(windows):
+    """
+    {name: ("HH:MM:SS", "HH:MM:SS")} to {name: (start, end)} in seconds, end exclusive.
+    """
+    return {name: tuple(gtfs_seconds([start, end])) for name, (start, end) in (windows or {}).items()}
+
+
+def service_day_params(date):
+    """
+    {{service_date}} (yyyymmdd) and {{weekday}} for sql/departures.sql, which counts a single day.
+    """
+    day = pd.Timestamp(date)
+    return {"service_date": day.strftime("%Y%m%d"), "weekday": weekdays[day.weekday()]}
+
+
+def service_days(service_ids, calendar, calendar_dates, dates):
+    """
+    (services x dates) boolean matrix of which services run on which day:
+    calendar weekday flags inside start/end, then calendar_dates adds (1) and removals (2).
+    """
+    dates = pd.to_datetime(pd.Series(dates))
+    yyyymmdd = dates.dt.strftime("%Y%m%d").astype(int).to_numpy()
+    weekday = dates.dt.weekday.to_numpy()
+    index = pd.Index(service_ids)
+    active = np.zeros((len(service_ids), len(dates)), dtype=bool)
+
+    if len(calendar):
+        rows = index.get_indexer(calendar["service_id"])
+        flags = calendar[weekdays].fillna(0).to_numpy(dtype=int)[:, weekday] == 1
+        in_range = (calendar["start_date"].to_numpy()[:, None] <= yyyymmdd) & (yyyymmdd <= calendar["end_date"].to_numpy()[:, None])
+        active[rows] |= flags & in_range
+
+    if len(calendar_dates):
+        date_index = pd.Index(yyyymmdd)
+        calendar_dates = calendar_dates.dropna(subset=["date"])
+        cols = date_index.get_indexer(calendar_dates["date"].astype(int))
+        hit = cols >= 0
+        rows = index.get_indexer(calendar_dates["service_id"])[hit]
+        cols, kind = cols[hit], calendar_dates["exception_type"].to_numpy()[hit]
+        active[rows[kind == 1], cols[kind == 1]] = True
+        active[rows[kind == 2], cols[kind == 2]] = False
+
+    return active
+
+
+def table_exists(dbname, table):
+    return copy_query(dbname, f"SELECT to_regclass('{table}') IS NOT NULL AS found")["found"].iloc[0] in (True, "t")
+
+
+def load_feed(dbname, schema):
+    """
+    Service calendars and departures (stop, route, time, service) of one feed.
+    """
+    calendar = copy_query(dbname, f"SELECT * FROM {schema}.calendar", dtype={"service_id": str}) \
+        if table_exists(dbname, f"{schema}.calendar") else pd.DataFrame()
+    calendar_dates = copy_query(dbname, f"SELECT * FROM {schema}.calendar_dates", dtype={"service_id": str}) \
+        if table_exists(dbname, f"{schema}.calendar_dates") else pd.DataFrame()
+    trips = copy_query(dbname, f"SELECT trip_id, route_id, service_id FROM {schema}.trips", dtype=str)
+    stop_times = copy_query(dbname, f"""
+        SELECT st.stop_id, t.route_id, st.departure_time, t.service_id
+        FROM {schema}.stop_times st
+        JOIN {schema}.trips t ON st.trip_id = t.trip_id
+        WHERE st.departure_time IS NOT NULL
+    """, dtype=str)
+    return calendar, calendar_dates, trips, stop_times
+
+
+def count_departures(stop_times, active, service_ids, windows):
+    """
+    Departures per stop and service day for the whole day and each window.
+
+    A departure is a distinct (stop, route, time) among the trips running that
+    day, the same rows the all_stop_times UNION keeps. One sparse product
+    resolves every day at once.
+
+    Returns (stop ids, {window: stops x dates array}).
+    """
+    keys = stop_times[["stop_id", "route_id", "departure_time"]]
+    key_codes, key_values = pd.MultiIndex.from_frame(keys).factorize()
+    key_values = key_values.to_frame(index=False, name=list(keys.columns))
+    service_codes = pd.Index(service_ids).get_indexer(stop_times["service_id"])
+    known = service_codes >= 0
+
+    key_services = sparse.csr_matrix(
+        (np.ones(known.sum()), (key_codes[known], service_codes[known])),
+        shape=(len(key_values), len(service_ids)),
+    )
+    runs = (key_services @ sparse.csr_matrix(active.astype(np.float64))).tocsr()
+    runs.data[:] = 1  # a key counts once per day however many trips share it
+
+    stop_codes, stop_ids = pd.factorize(key_values["stop_id"])
+    seconds = gtfs_seconds(key_values["departure_time"])
+    counts = {}
+    for name, (start, end) in {"tot": (-np.inf, np.inf), **windows}.items():
+        inside = (seconds >= start) & (seconds < end)
+        stop_keys = sparse.csr_matrix(
+            (np.ones(inside.sum()), (stop_codes[inside], np.flatnonzero(inside))),
+            shape=(len(stop_ids), len(key_values)),
+        )
+        counts[name] = np.asarray((stop_keys @ runs).todense())
+    return np.asarray(stop_ids), counts
+
+
+def service_trips(trips, active, service_ids, label):
+    """
+    The trips running on any of the dates, as output.all_trips rows.
+    """
+    running = pd.Index(service_ids)[active.any(axis=1)]
+    trips = trips[trips["service_id"].isin(running)].copy()
+    trips["gtfs"] = label
+    return trips[["trip_id", "route_id", "service_id", "gtfs"]]
+
+
+def departures(dbname, dates, windows=None, feeds=None, output="output", update=False):
+    """
+    Resolves service for every date, counts departures per stop for the day
+    and each time window ({name: ("HH:MM:SS", "HH:MM:SS")}), and writes
+    {output}.stop_departures (per stop, date and window), {output}.all_trips and
+    {output}.stops_w_departs with the daily average over the dates. With
+    update=True only the rows of the given feeds are swapped out, in one
+    transaction, and the other feeds' rows stay as they are.
+    """
+    print("\t -> Counting departures...")
+    windows = window_seconds(windows)
+    feeds = feeds or feed_labels
+    dates = pd.to_datetime(pd.Series(dates)).dt.date.to_numpy()
+    per_stop, all_trips = [], []
+
+    for schema, label in feeds.items():
+        if not table_exists(dbname, f"{schema}.stop_times"):
+            print(f"\t \t -> {schema}: no stop_times, skipped")
+            continue
+        calendar, calendar_dates, trips, stop_times = load_feed(dbname, schema)
+        service_ids = np.unique(np.concatenate([
+            trips["service_id"].dropna().to_numpy(dtype=str),
+            calendar.get("service_id", pd.Series(dtype=str)).dropna().to_numpy(dtype=str),
+            calendar_dates.get("service_id", pd.Series(dtype=str)).dropna().to_numpy(dtype=str),
+        ]))
+        active = service_days(service_ids, calendar, calendar_dates, dates)
+        stop_ids, counts = count_departures(stop_times, active, service_ids, windows)
+        all_trips.append(service_trips(trips, active, service_ids, label))
+
+        for name, count in counts.items():
+            per_stop.append(pd.DataFrame({
+                "gtfs": label,
+                "stop_id": np.repeat(stop_ids, len(dates)),
+                "service_date": np.tile(dates, len(stop_ids)),
+                "time_window": name,
+                "departures": count.ravel().astype(np.int64),
+            }))
+        print(f"\t \t -> {schema}: {len(stop_times)} stop times, {counts['tot'].sum()} departures over {len(dates)} days")
+
+    per_stop = pd.concat(per_stop, ignore_index=True)
+    all_trips = pd.concat(all_trips, ignore_index=True)
+    daily = lambda name: f"ROUND(SUM(d.departures) FILTER (WHERE d.time_window = '{name}') / {len(dates)}.0)::BIGINT"
+    window_columns = "".join(f",\n                {daily(name)} AS {name}_departures" for name in windows)
+    labels = {"gtfs": list(feeds.values())}
+    stops_w_departs = f"""
+            SELECT
+                s.stop_id,
+                s.gtfs,
+                s.geom,
+                {daily('tot')} AS tot_departures{window_columns}
+            FROM
+                output.all_stops s
+                JOIN {output}.stop_departures d ON s.stop_id = d.stop_id AND s.gtfs = d.gtfs
+            {"WHERE d.gtfs = ANY(%(gtfs)s)" if update else ""}
+            GROUP BY
+                s.stop_id,
+                s.gtfs,
+                s.geom
+            HAVING
+                SUM(d.departures) FILTER (WHERE d.time_window = 'tot') > 0
+    """
+
+    if update:
+        conn = bulk.connect(dbname)
+        with conn.cursor() as cur:
+            for table in ("stops_w_departs", "stop_departures", "all_trips"):
+                cur.execute(f"DELETE FROM {output}.{table} WHERE gtfs = ANY(%(gtfs)s);", labels)
+        bulk.copy_rows(conn, per_stop, output, "stop_departures", commit=False)
+        bulk.copy_rows(conn, all_trips, output, "all_trips", commit=False)
+        with conn.cursor() as cur:
+            cur.execute(f"INSERT INTO {output}.stops_w_departs {stops_w_departs};", labels)
+        conn.commit()
+        conn.close()
+        return
+
+    db.drop_relations(dbname, [f"{output}.stops_w_departs", f"{output}.all_trips"])  # the sql engine leaves materialized views
+    conn = bulk.connect(dbname)
+    bulk.copy_frame(dbname, per_stop, "stop_departures", output,
+                    dtypes={"service_date": "DATE"}, indexes=[("gtfs", "stop_id")], conn=conn)
+    bulk.copy_frame(dbname, all_trips, "all_trips", output,
+                    indexes=["trip_id", "gtfs"], conn=conn)
+
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE TABLE {output}.stops_w_departs AS {stops_w_departs};")
+        cur.execute(f"CREATE INDEX stops_w_departs_idx ON {output}.stops_w_departs USING GIST (geom);")
+    conn.commit()
+    conn.close()
@@ -0,0 +1,263 @@
+import os
+import io
+import psycopg2
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+from dotenv import load_dotenv
+import instrument
+
+load_dotenv()
+
+host = os.getenv("HOST")
+user = os.getenv("USER")
+password = os.getenv("PASSWORD")
+port = os.getenv("PORT")
+
+# walk cutoffs in meters, see walkshed.py for the speed/time math
+BUS_CUTOFF = 420
+RAIL_CUTOFF = 1260
+
+# upper bound on the dense (batch x nodes) distance block dijkstra hands back
+MAX_BATCH_BYTES = 256 * 1024 ** 2
+
+
+class SidewalkGraph:
+    """
+    Compact CSR copy of network.sw_network keyed on the pgRouting vertex ids.
+    """
+
+    def __init__(self, node_ids, x, y, csr, contraction=None):
+        self.node_ids = node_ids
+        self.x = x
+        self.y = y
+        self.csr = csr
+        self.contraction = contraction
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    def index_of(self, node_ids):
+        """
+        Maps pgRouting vertex ids to CSR row indexes, -1 where the id is unknown.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        idx = np.searchsorted(self.node_ids, node_ids)
+        idx = np.clip(idx, 0, self.n_nodes - 1)
+        return np.where(self.node_ids[idx] == node_ids, idx, -1)
+
+
+def copy_query(dbname, query, dtype=None, params=None):
+    """
+    Streams a query result out of postgres with COPY and reads it into a DataFrame.
+    COPY takes no bind parameters, so params are quoted into the query by psycopg2.
+    """
+    conn = psycopg2.connect(
+        host=host, port=port, database=dbname, user=user, password=password
+    )
+    buffer = io.StringIO()
+    with conn.cursor() as cur, instrument.db_time():
+        if params:
+            query = cur.mogrify(query, params).decode()
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", buffer)
+    conn.close()
+    buffer.seek(0)
+    return pd.read_csv(buffer, dtype=dtype)
+
+
+def build_csr(n_nodes, u, v, w):
+    """
+    Builds a symmetric CSR matrix from undirected edges, keeping the cheapest
+    of any parallel edges the same way pgRouting would.
+    """
+    keep = w >= 0  # pgRouting skips edges with a negative cost
+    u, v, w = u[keep], v[keep], w[keep]
+
+    rows = np.concatenate([u, v])
+    cols = np.concatenate([v, u])
+    costs = np.concatenate([w, w])
+
+    order = np.lexsort((costs, cols, rows))
+    rows, cols, costs = rows[order], cols[order], costs[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    rows, cols, costs = rows[first], cols[first], costs[first]
+
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_nodes), out=indptr[1:])
+    # built straight from the arrays so zero cost edges stay explicit edges
+    return sparse.csr_matrix((costs, cols.astype(np.int32), indptr), shape=(n_nodes, n_nodes))
+
+
+def load_graph(dbname, edge_table="network.sw_network", vertex_table="network.sw_network_vertices_pgr"):
+    """
+    Loads the routable sidewalk network and its vertices into memory once.
+    """
+    print("\t -> Loading sidewalk graph...")
+    vertices = copy_query(
+        dbname,
+        f"SELECT id, ST_X(the_geom) AS x, ST_Y(the_geom) AS y FROM {vertex_table} ORDER BY id",
+        dtype={"id": np.int64, "x": np.float64, "y": np.float64},
+    )
+    edges = copy_query(
+        dbname,
+        f"SELECT source, target, cost FROM {edge_table} WHERE source IS NOT NULL AND target IS NOT NULL",
+        dtype={"source": np.int64, "target": np.int64, "cost": np.float64},
+    )
+
+    node_ids = vertices["id"].to_numpy()
+    graph = SidewalkGraph(node_ids, vertices["x"].to_numpy(), vertices["y"].to_numpy(), None)
+
+    u = graph.index_of(edges["source"].to_numpy())
+    v = graph.index_of(edges["target"].to_numpy())
+    known = (u >= 0) & (v >= 0)
+    graph.csr = build_csr(graph.n_nodes, u[known], v[known], edges["cost"].to_numpy()[known])
+
+    print(f"\t \t -> {graph.n_nodes} vertices, {graph.csr.nnz // 2} edges")
+    return graph
+
+
+class Contraction:
+    """
+    A sidewalk graph with its degree-2 chains folded into single edges.
+
+    core holds the original indexes of the nodes kept and core_csr the graph
+    between them. Every removed node sits on one chain between core nodes
+    chain_a and chain_b (positions in core), offset_a/offset_b along it.
+    """
+
+    def __init__(self, core, core_csr, chain_nodes, chain_a, chain_b, offset_a, offset_b):
+        self.core = core
+        self.core_csr = core_csr
+        self.chain_nodes = chain_nodes
+        self.chain_a = chain_a
+        self.chain_b = chain_b
+        self.offset_a = offset_a
+        self.offset_b = offset_b
+
+
+def contract(graph, protected=()):
+    """
+    Folds chains of degree-2 nodes into single edges so dijkstra only settles
+    junctions, dead ends and the protected nodes (the walkshed sources). The
+    chain nodes keep their original ids and get their distances back in
+    drive_distance, so results are the same as on the full graph.
+    """
+    csr = graph.csr
+    n = graph.n_nodes
+    rows = np.repeat(np.arange(n), np.diff(csr.indptr))
+    not_self = csr.indices != rows
+    degree = np.bincount(rows[not_self], minlength=n)
+
+    removable = degree == 2
+    removable[np.asarray(protected, dtype=np.int64)] = False
+
+    # chains are the components of the removable nodes; each attaches to the core at both ends
+    inner = csr[removable][:, removable]
+    removed = np.flatnonzero(removable)
+    _, component = csgraph.connected_components(inner, directed=False)
+    local = np.full(n, -1)
+    local[removed] = np.arange(len(removed))
+
+    attach = not_self & removable[rows] & ~removable[csr.indices]
+    attach_node = local[rows[attach]]
+    attach_core = csr.indices[attach]
+    attach_cost = csr.data[attach]
+    attach_component = component[attach_node]
+
+    # cycles with no core node can't be reached from any source, they just go
+    order = np.argsort(attach_component, kind="stable")
+    attach_node, attach_core, attach_cost, attach_component = (
+        attach_node[order], attach_core[order], attach_cost[order], attach_component[order])
+    ends = np.flatnonzero(np.r_[True, attach_component[1:] != attach_component[:-1]])
+    a_node, b_node = attach_node[ends], attach_node[ends + 1]
+    a_core, b_core = attach_core[ends], attach_core[ends + 1]
+    a_cost, b_cost = attach_cost[ends], attach_cost[ends + 1]
+    chains = attach_component[ends]
+
+    # distance along each chain from its a end, one multi-source dijkstra over all chains
+    along = csgraph.dijkstra(inner, directed=False, indices=a_node, min_only=True)
+    reached = np.isfinite(along) & np.isin(component, chains)
+    chain_of = np.full(component.max() + 1 if len(component) else 0, -1)
+    chain_of[chains] = np.arange(len(chains))
+    which = chain_of[component[reached]]
+    length = a_cost + along[b_node] + b_cost
+
+    core = np.flatnonzero(~removable)
+    core_index = np.full(n, -1)
+    core_index[core] = np.arange(len(core))
+    keep = ~removable[rows] & ~removable[csr.indices]
+    u = np.concatenate([core_index[rows[keep]], core_index[a_core]])
+    v = np.concatenate([core_index[csr.indices[keep]], core_index[b_core]])
+    w = np.concatenate([csr.data[keep], length])
+    core_csr = build_csr(len(core), u, v, w)
+
+    offset_a = a_cost[which] + along[reached]
+    contraction = Contraction(
+        core, core_csr, removed[reached], core_index[a_core[which]], core_index[b_core[which]],
+        offset_a, length[which] - offset_a,
+    )
+    print(f"\t \t -> contracted {graph.n_nodes} vertices to {len(core)} ({len(chains)} chains)")
+    return SidewalkGraph(graph.node_ids, graph.x, graph.y, graph.csr, contraction)
+
+
+def cutoff_for_mode(mode):
+    """
+    Same rule as walkshed.route_me: anything ending in bus gets the short walk.
+    """
+    return BUS_CUTOFF if str(mode).endswith("bus") else RAIL_CUTOFF
+
+
+def batch_size_for(graph, max_batch_bytes=MAX_BATCH_BYTES):
+    """
+    Number of sources per dijkstra call that keeps the distance block under budget.
+    A contracted graph holds the core distances plus two chain-wide blocks, the
+    distances through either end of each chain.
+    """
+    c = graph.contraction
+    width = graph.n_nodes if c is None else len(c.core) + 2 * len(c.chain_nodes)
+    return max(1, int(max_batch_bytes // (max(width, 1) * 8)))
+
+
+def drive_distance(graph, sources, cutoff, batch_size=None):
+    """
+    Cost-bounded dijkstra from each source index, the in-memory equivalent of
+    pgr_drivingdistance(..., directed := false).
+
+    Yields (source_positions, node_indexes, agg_costs) per batch, where
+    source_positions index into the given sources array.
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    if batch_size is None:
+        batch_size = batch_size_for(graph)
+    c = graph.contraction
+
+    for start in range(0, len(sources), batch_size):
+        batch = sources[start:start + batch_size]
+        if c is None:
+            dist = csgraph.dijkstra(graph.csr, directed=True, indices=batch, limit=cutoff)
+            rows, cols = np.nonzero(np.isfinite(dist))
+            yield rows + start, cols, dist[rows, cols]
+            continue
+
+        # route the core, then a chain node is as far as the nearer of its two ends plus the walk in
+        core_batch = np.clip(np.searchsorted(c.core, batch), 0, len(c.core) - 1)
+        if not np.array_equal(c.core[core_batch], batch):
+            raise ValueError("contracted graphs only route from protected nodes")
+        dist = csgraph.dijkstra(c.core_csr, directed=True, indices=core_batch, limit=cutoff)
+        chain = dist[:, c.chain_a]
+        chain += c.offset_a
+        through_b = dist[:, c.chain_b]
+        through_b += c.offset_b
+        np.minimum(chain, through_b, out=chain)
+        del through_b
+        chain[chain > cutoff] = np.inf
+        rows, cols = np.nonzero(np.isfinite(dist))
+        chain_rows, chain_cols = np.nonzero(np.isfinite(chain))
+        positions = np.concatenate([rows, chain_rows])
+        nodes = np.concatenate([c.core[cols], c.chain_nodes[chain_cols]])
+        costs = np.concatenate([dist[rows, cols], chain[chain_rows, chain_cols]])
+        order = np.argsort(positions, kind="stable")  # grouped by source, as build_hulls expects
+        yield positions[order] + start, nodes[order], costs[order]
@@ -1,13 +1,12 @@
 import os
-import io
 import zipfile
-import psycopg2
 from dotenv import load_dotenv
 import pandas as pd
-from sqlalchemy import create_engine
-import requests
-import math
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import bulk
+import cache
+import pipeline
+import instrument
 
 load_dotenv()
 
@@ -17,122 +16,163 @@ user = os.getenv("USER")
 password = os.getenv("PASSWORD")
 port = os.getenv("PORT")
 
+# where each feed's tables land: nested archive name -> schema, None is the feed zip itself.
+# {mode} is filled from the feed file name, e.g. bus_data.zip -> bus
+feed_registry = {
+    "septa": {"google_bus.zip": "septa_bus", "google_rail.zip": "septa_rail"},
+    "nj_transit": {None: "njtransit_{mode}"},
+    "patco": {None: "patco"},
+}
+
+# the gtfs tables and columns the analysis uses, everything else stays in the zip
+gtfs_tables = {
+    "stops": {
+        "stop_id": "TEXT", "stop_name": "TEXT", "stop_lat": "DOUBLE PRECISION", "stop_lon": "DOUBLE PRECISION",
+    },
+    "routes": {
+        "route_id": "TEXT", "route_short_name": "TEXT", "route_long_name": "TEXT", "route_type": "INTEGER",
+    },
+    "trips": {
+        "route_id": "TEXT", "service_id": "TEXT", "trip_id": "TEXT",
+    },
+    "stop_times": {
+        "trip_id": "TEXT", "stop_id": "TEXT", "departure_time": "TEXT", "stop_sequence": "INTEGER",
+    },
+    "calendar": {
+        "service_id": "TEXT", "monday": "INTEGER", "tuesday": "INTEGER", "wednesday": "INTEGER",
+        "thursday": "INTEGER", "friday": "INTEGER", "saturday": "INTEGER", "sunday": "INTEGER",
+        "start_date": "INTEGER", "end_date": "INTEGER",
+    },
+    "calendar_dates": {
+        "service_id": "TEXT", "date": "INTEGER", "exception_type": "INTEGER",
+    },
+    "feed_info": {
+        "feed_publisher_name": "TEXT", "feed_version": "TEXT", "feed_start_date": "TEXT", "feed_end_date": "TEXT",
+    },
+}
+
+pandas_types = {"TEXT": str, "INTEGER": "Int64", "DOUBLE PRECISION": "float64"}
+
+# indexes built on the gtfs tables once they are loaded
+table_indexes = {
+    "stop_times": ["trip_id", "stop_id", "departure_time"],
+    "trips": ["trip_id", "service_id"],
+    "stops": ["stop_id"],
+    "routes": ["route_id"],
+}
+
+CHUNK_ROWS = 200_000
+
+
+def resolve_feeds(gtfs_urls):
+    """
+    pairs each url in data_sources.json with its archive -> schema mapping
+    """
+    feeds = []
+    for name, urls in gtfs_urls.items():
+        for url in urls if isinstance(urls, list) else [urls]:
+            mode = url.rsplit('/', 1)[-1].split('_')[0]
+            schemas = {archive: schema.format(mode=mode) for archive, schema in feed_registry[name].items()}
+            feeds.append((name, url, schemas))
+    return feeds
 
-def download_and_load_septagtfs(dbname, gtfs_url):
+
+def feed_digest(url):
     """
-    downloads, extracts, loads septa gtfs into the db
+    sha256 of the feed zip as the cache has it now, revalidating with the
+    agency once the cached copy is past its TTL. Cached blobs are named by it.
     """
-    print("\t -> Loading SEPTA GTFS data...")
-    response = requests.get(gtfs_url)
-    zip_content = io.BytesIO(response.content)
-
-    with zipfile.ZipFile(zip_content, 'r') as zip_ref:
-        zip_ref.extractall('gtfs')
-
-    zip_files = [file for file in os.listdir('gtfs') if file.endswith(".zip")]
-    for zip in zip_files:
-        path = os.path.join('gtfs', zip)
-        file_name = os.path.splitext(path)[0] 
-        os.mkdir(file_name) 
-        with zipfile.ZipFile(path, 'r') as zip_ref:
-            zip_ref.extractall(os.path.join(file_name))
-
-    folder_to_schema = {
-        'google_bus': 'septa_bus',
-        'google_rail': 'septa_rail'
-    }
-
-    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
-    conn = psycopg2.connect(
-        host=host, port=port, database=dbname, user=user, password=password
-    )
-    cur = conn.cursor()
-    conn.autocommit = True
-
-    for folder, schema in folder_to_schema.items():
-        cur.execute(f"SELECT 1 FROM pg_namespace WHERE nspname='{schema}'")
-        schema_exists = bool(cur.rowcount)
-        if not schema_exists:
-            cur.execute(f"CREATE SCHEMA {schema};")
-
-        folder_path = os.path.join('gtfs', folder)
-        for file_name in os.listdir(folder_path):
-            if file_name.endswith('.txt'):
-                file_path = os.path.join(folder_path, file_name)
-                table_name = os.path.splitext(file_name)[0]
-
-                df = pd.read_csv(file_path)
-                df.to_sql(table_name, engine, schema=schema, if_exists='replace', index=False)
-
-    cur.close()
-    conn.close()
+    path = cache.fetch(url)
+    if url.startswith("file://"):
+        return pipeline.file_digest(path)
+    return os.path.basename(path)
+
+
+def stage_schemas(stage_names):
+    """
+    gtfs schemas behind gtfs:* stage names (gtfs:septa_bus+septa_rail)
+    """
+    return [schema for name in stage_names if name.startswith("gtfs:") for schema in name.split(":", 1)[1].split("+")]
 
 
-def download_and_load_njtgtfs(dbname, gtfs_url):
+def load_member(conn, archive, member, schema, table_name, chunk_rows=CHUNK_ROWS):
     """
-    downloads, extracts, loads septa gtfs into the db
+    streams one .txt out of the archive into the agency schema in typed chunks
     """
-    print("\t -> Loading NJT GTFS data...")
-    gtfs_type = gtfs_url.rsplit('/', 1)[-1]
-    mode = gtfs_type.split('_')[0]
-    response = requests.get(gtfs_url)
-    zip_content = io.BytesIO(response.content)
-
-    with zipfile.ZipFile(zip_content, 'r') as zip_ref:
-        zip_ref.extractall(f'./gtfs/njtransit_{mode}')
-    
-    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
-    conn = psycopg2.connect(
-        host=host, port=port, database=dbname, user=user, password=password
-    )
-    cur = conn.cursor()
-    conn.autocommit = True
-
-    schema = f'njtransit_{mode}'
-
-    cur.execute(f"SELECT 1 FROM pg_namespace WHERE nspname='{schema}'")
-    schema_exists = bool(cur.rowcount)
-    if not schema_exists:
-        cur.execute(f"CREATE SCHEMA {schema};")
-
-    for file_name in os.listdir(os.path.join('gtfs', schema)):
-        if file_name.endswith('.txt'):
-            file_path = os.path.join('gtfs', schema, file_name)
-            table_name = os.path.splitext(file_name)[0]
-
-            df = pd.read_csv(file_path)
-            df.to_sql(table_name, engine, schema=schema, if_exists='replace', index=False)
-
-
-def download_and_load_patcogtfs(dbname, gtfs_url):
+    columns = gtfs_tables[table_name]
+    # truncated rather than dropped so output.all_stops outlives a reload and can be
+    # refreshed; a table whose registered columns changed is recreated instead
+    bulk.create_table(conn, schema, table_name, columns, if_exists="truncate")
+
+    rows = 0
+    with archive.open(member) as stream:
+        chunks = pd.read_csv(
+            stream,
+            encoding="utf-8-sig",
+            skipinitialspace=True,
+            usecols=lambda column: column.strip() in columns,
+            dtype={column: pandas_types[pg_type] for column, pg_type in columns.items()},
+            chunksize=chunk_rows,
+        )
+        for chunk in chunks:
+            chunk.columns = [column.strip() for column in chunk.columns]
+            rows += bulk.copy_rows(conn, chunk, schema, table_name)
+
+    bulk.create_indexes(conn, schema, table_name, table_indexes.get(table_name))
+    return rows
+
+
+def load_archive(conn, archive, schema):
+    """
+    loads every registered gtfs table in an archive into one schema
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {schema};")
+    conn.commit()
+
+    loaded = set()
+    for member in archive.namelist():
+        table_name = os.path.splitext(os.path.basename(member))[0]
+        if member.endswith('.txt') and table_name in gtfs_tables:
+            with instrument.span(f"{schema}.{table_name}"):
+                rows = load_member(conn, archive, member, schema, table_name)
+            loaded.add(table_name)
+            print(f"\t \t -> {schema}.{table_name}: {rows} rows")
+
+    # a member the agency stopped publishing leaves an empty table, not last feed's rows
+    with conn.cursor() as cur:
+        for table_name in set(gtfs_tables) - loaded:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{schema}.{table_name}",))
+            if cur.fetchone()[0]:
+                cur.execute(f"TRUNCATE {schema}.{table_name};")
+                print(f"\t \t -> {schema}.{table_name}: not in the feed anymore, emptied")
+    conn.commit()
+
+
+def load_feed(dbname, name, url, schemas):
+    """
+    fetches one feed through the download cache and streams its members (nested
+    zips included) into the db, nothing is extracted to disk
+    """
+    print(f"\t -> Loading {name} GTFS data...")
+    conn = bulk.connect(dbname)
+    with open(cache.fetch(url), 'rb') as feed_file:
+        with zipfile.ZipFile(feed_file) as archive:
+            for nested, schema in schemas.items():
+                if nested is None:
+                    load_archive(conn, archive, schema)
+                else:
+                    with archive.open(nested) as nested_file, zipfile.ZipFile(nested_file) as nested_archive:
+                        load_archive(conn, nested_archive, schema)
+    conn.close()
+
+
+def load_feeds(dbname, gtfs_urls, max_workers=4):
     """
-    downloads, extracts, loads septa gtfs into the db
+    loads all gtfs feeds in data_sources.json concurrently
     """
-    print("\t -> Loading PATCO GTFS data...")
-    response = requests.get(gtfs_url)
-    zip_content = io.BytesIO(response.content)
-
-    with zipfile.ZipFile(zip_content, 'r') as zip_ref:
-        zip_ref.extractall(f'./gtfs/patco')
-    
-    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
-    conn = psycopg2.connect(
-        host=host, port=port, database=dbname, user=user, password=password
-    )
-    cur = conn.cursor()
-    conn.autocommit = True
-
-    schema = 'patco'
-
-    cur.execute(f"SELECT 1 FROM pg_namespace WHERE nspname='{schema}'")
-    schema_exists = bool(cur.rowcount)
-    if not schema_exists:
-        cur.execute(f"CREATE SCHEMA {schema};")
-
-    for file_name in os.listdir(os.path.join('gtfs', schema)):
-        if file_name.endswith('.txt'):
-            file_path = os.path.join('gtfs', schema, file_name)
-            table_name = os.path.splitext(file_name)[0]
-
-            df = pd.read_csv(file_path)
-            df.to_sql(table_name, engine, schema=schema, if_exists='replace', index=False)
\ No newline at end of file
+    feeds = resolve_feeds(gtfs_urls)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(load_feed, dbname, *feed) for feed in feeds]
+        for future in as_completed(futures):
+            future.result()
@@ -0,0 +1,341 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from datetime import datetime
+import psycopg2
+from dotenv import load_dotenv
+
+try:
+    import psutil
+except ImportError:  # optional, /proc is read instead on linux
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+load_dotenv()
+
+host = os.getenv("HOST")
+user = os.getenv("USER")
+password = os.getenv("PASSWORD")
+port = os.getenv("PORT")
+
+# how often open spans sample the process RSS for their peak
+SAMPLE_SECONDS = 0.1
+
+# statement shapes EXPLAIN can replay without redoing side effects: the query behind a create, or dml (rolled back)
+EXPLAIN_CREATE = re.compile(
+    r'^\s*CREATE\s+(?:OR\s+REPLACE\s+)?(?:MATERIALIZED\s+VIEW|VIEW|TABLE)\s+(?:IF\s+NOT\s+EXISTS\s+)?[\w."]+\s+AS\s+(.*)$',
+    re.IGNORECASE | re.DOTALL,
+)
+EXPLAIN_DML = re.compile(r'^\s*(?:WITH|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+
+
+def rss_bytes():
+    """
+    Resident set size of this process, None where it can't be read.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, not current
+    return None
+
+
+class Span:
+    """
+    One timed piece of a run (a stage, a sql statement, a step inside a
+    stage) with the counters charged to it and everything it contains.
+    """
+
+    def __init__(self, recorder, name, cat, parent, args):
+        self.recorder = recorder
+        self.id = len(recorder.spans)
+        self.name = name
+        self.cat = cat
+        self.parent = parent
+        self.args = args
+        self.tid = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+        self.counters = {"rows": 0, "bytes": 0, "db_time": 0.0}
+        self.peak_rss = rss_bytes()
+
+    @property
+    def wall(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def add(self, **counters):
+        """
+        Charges counters to this span and every span around it.
+        """
+        with self.recorder.lock:
+            span = self
+            while span is not None:
+                for key, value in counters.items():
+                    span.counters[key] = span.counters.get(key, 0) + value
+                span = span.parent
+
+    def summary(self):
+        return {
+            "name": self.name,
+            "cat": self.cat,
+            "parent": self.parent.name if self.parent else None,
+            "wall": round(self.wall, 4),
+            **{key: round(value, 4) if isinstance(value, float) else value for key, value in self.counters.items()},
+            "peak_rss": self.peak_rss,
+            **{key: value for key, value in self.args.items() if key != "sql"},
+        }
+
+
+class Recorder:
+    """
+    Collects the spans of one run and samples memory while they are open.
+    """
+
+    def __init__(self, dbname, report_dir, explain=0):
+        self.dbname = dbname
+        self.report_dir = report_dir
+        self.explain = explain
+        self.spans = []
+        self.open = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = datetime.now()
+        self.t0 = time.perf_counter()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while not self.stopped.wait(SAMPLE_SECONDS):
+            rss = rss_bytes()
+            if rss is None:
+                return
+            with self.lock:
+                for span in self.open:
+                    span.peak_rss = max(span.peak_rss or 0, rss)
+
+    def current(self):
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, cat, parent=None, **args):
+        parent = parent or self.current()
+        with self.lock:
+            span = Span(self, name, cat, parent, args)
+            self.spans.append(span)
+            self.open.add(span)
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.args["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            span.end = time.perf_counter()
+            rss = rss_bytes()
+            with self.lock:
+                self.open.discard(span)
+                if rss is not None:
+                    span.peak_rss = max(span.peak_rss or 0, rss)
+
+
+_recorder = None
+
+
+def start(dbname, report_dir="reports", explain=0):
+    """
+    Turns instrumentation on for this run. explain > 0 replays that many of
+    the slowest sql statements under EXPLAIN (ANALYZE, BUFFERS) at the end.
+    """
+    global _recorder
+    _recorder = Recorder(dbname, report_dir, explain)
+    return _recorder
+
+
+def current():
+    return _recorder.current() if _recorder else None
+
+
+@contextmanager
+def span(name, cat="step", parent=None, **args):
+    """
+    Times a block as a child of the current span (or parent, from another thread).
+    A no-op until start() is called.
+    """
+    if _recorder is None:
+        yield None
+        return
+    with _recorder.span(name, cat, parent, **args) as s:
+        yield s
+
+
+def add(**counters):
+    """
+    Charges rows / bytes / db_time to the current span and the spans around it.
+    """
+    s = current()
+    if s is not None:
+        s.add(**counters)
+
+
+def bind(fn):
+    """
+    Wraps fn so it runs inside the caller's span when handed to another thread.
+    """
+    parent = current()
+    if parent is None:
+        return fn
+
+    @functools.wraps(fn)
+    def bound(*args, **kwargs):
+        with span(getattr(fn, "__name__", "task"), "task", parent=parent):
+            return fn(*args, **kwargs)
+    return bound
+
+
+@contextmanager
+def db_time():
+    """
+    Charges the time spent in the block to db_time.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(db_time=time.perf_counter() - start_time)
+
+
+def explainable(sql):
+    """
+    The statement EXPLAIN ANALYZE can rerun safely inside a rolled back
+    transaction, or None.
+    """
+    match = EXPLAIN_CREATE.match(sql)
+    if match:
+        return match.group(1)
+    if EXPLAIN_DML.match(sql):
+        return sql
+    return None
+
+
+def explain_slowest(recorder):
+    """
+    Reruns the slowest sql statements under EXPLAIN (ANALYZE, BUFFERS) and rolls back.
+    """
+    candidates = sorted(
+        (s for s in recorder.spans if s.cat == "sql" and "error" not in s.args and explainable(s.args.get("sql", ""))),
+        key=lambda s: s.wall, reverse=True,
+    )[:recorder.explain]
+    plans = []
+    conn = psycopg2.connect(
+        host=host, port=port, database=recorder.dbname, user=user, password=password
+    )
+    for s in candidates:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + explainable(s.args["sql"]))
+                plans.append({"statement": s.name, "wall": round(s.wall, 4), "plan": cur.fetchone()[0]})
+        except Exception as e:
+            plans.append({"statement": s.name, "wall": round(s.wall, 4), "error": str(e)})
+        conn.rollback()
+    conn.close()
+    return plans
+
+
+def chrome_trace(recorder):
+    """
+    The spans as Chrome trace events (chrome://tracing, Perfetto).
+    """
+    tids = {}
+    events = []
+    for s in recorder.spans:
+        tid = tids.setdefault(s.tid, len(tids) + 1)
+        events.append({
+            "name": s.name, "cat": s.cat, "ph": "X", "pid": 1, "tid": tid,
+            "ts": round((s.start - recorder.t0) * 1e6), "dur": round(s.wall * 1e6),
+            "args": {key: value for key, value in s.summary().items() if key not in ("name", "cat", "wall")},
+        })
+    events += [
+        {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": f"thread {tid}"}}
+        for tid in tids.values()
+    ]
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def finish():
+    """
+    Writes {report_dir}/run-<timestamp>.json and .trace.json and prints the stage table.
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is None:
+        return None
+    recorder.stopped.set()
+
+    report = {
+        "database": recorder.dbname,
+        "started": recorder.started.isoformat(timespec="seconds"),
+        "duration": round(time.perf_counter() - recorder.t0, 3),
+        "peak_rss": max((s.peak_rss or 0 for s in recorder.spans), default=None),
+        "stages": [s.summary() for s in recorder.spans if s.cat == "stage"],
+        "sql": [s.summary() for s in recorder.spans if s.cat == "sql"],
+        "steps": [s.summary() for s in recorder.spans if s.cat not in ("stage", "sql")],
+        "explain": explain_slowest(recorder) if recorder.explain else [],
+    }
+
+    os.makedirs(recorder.report_dir, exist_ok=True)
+    stem = os.path.join(recorder.report_dir, f"run-{recorder.started:%Y%m%d-%H%M%S}")
+    with open(f"{stem}.json", "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    with open(f"{stem}.trace.json", "w") as f:
+        json.dump(chrome_trace(recorder), f, default=str)
+
+    print(f"\t -> Run report: {stem}.json (trace: {stem}.trace.json)")
+    for stage in sorted(report["stages"], key=lambda s: s["wall"], reverse=True):
+        rss = f"{stage['peak_rss'] / 1024 ** 2:.0f}MB" if stage["peak_rss"] else "n/a"
+        print(f"\t \t -> {stage['name']}: {stage['wall']:.1f}s, {stage['rows']} rows, "
+              f"{stage['bytes'] / 1024 ** 2:.1f}MB downloaded, {stage['db_time']:.1f}s in db, peak {rss}")
+    return report
+
+
+def compare(old_path, new_path, threshold=0.2):
+    """
+    Stages whose wall time grew by more than threshold between two reports.
+    """
+    with open(old_path) as f:
+        old = {s["name"]: s for s in json.load(f)["stages"]}
+    with open(new_path) as f:
+        new = {s["name"]: s for s in json.load(f)["stages"]}
+    regressions = []
+    for name, stage in new.items():
+        before = old.get(name)
+        if before and before["wall"] > 0 and stage["wall"] > before["wall"] * (1 + threshold):
+            regressions.append((name, before["wall"], stage["wall"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python instrument.py OLD_REPORT NEW_REPORT")
+    regressed = compare(sys.argv[1], sys.argv[2])
+    for name, before, after in regressed:
+        print(f"{name}: {before:.1f}s -> {after:.1f}s ({after / before - 1:+.0%})")
+    if not regressed:
+        print("no stage regressed")
@@ -6,11 +6,21 @@ from dotenv import load_dotenv
 import geopandas as gpd
 from geopandas import GeoDataFrame
 import pandas as pd
-from sqlalchemy import create_engine
 import requests
-import math
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pyproj import CRS
 import numpy as np
-from urllib.parse import urlparse
+import time
+import json
+import hashlib
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import parse_qsl
+import bulk
+import cache
+import instrument
 
 load_dotenv()
 
@@ -29,6 +39,12 @@ portal = {
     "f": os.getenv("PORTAL_F")
     }
 
+# concurrent page requests per feature service
+PAGE_WORKERS = 4
+# travel time cutoffs (minutes) with a matrix_{minutes}min view, and origins summed per block
+MATRIX_THRESHOLDS = (30, 45, 60)
+MATRIX_BLOCK_ROWS = 500
+
 
 def explode_gdf_if_multipart(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """
@@ -59,97 +75,315 @@ def fetch_portal_token():
         raise SystemError(f"An error occurred while fetching the token: {e}")
 
 
-def load_gis_data(dbname, target_schema, url_key, url, crs):
+_token = {"value": None, "fetched": 0}
+_token_lock = threading.Lock()
+
+
+def portal_token():
     """
-    Loads the data from feature services into database.
+    One portal token shared by every layer, refreshed a minute before it expires.
     """
-    print("\t -> Loading GIS data...")
-    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
+    with _token_lock:
+        if not _token["value"] or time.time() - _token["fetched"] > (portal["expiration"] - 1) * 60:
+            _token["value"] = fetch_portal_token()
+            _token["fetched"] = time.time()
+        return _token["value"]
 
-    if 'opendata.arcgis.com/' in url.lower():
-        print(f"\t \t -> Loading direct GeoJSON for {url_key}...")
-        response = requests.get(url)
-        gdf = gpd.read_file(response.content)
-        gdf = gdf.to_crs(crs)
-    else:
-        if url.startswith("https://arcgis.dvrpc.org"):
-            token = fetch_portal_token()
-        else:
-            token = None
 
-        parsed_url = urlparse(url)
-        path_parts = parsed_url.path.split("/")
-        base_url = url.split('?')[0]
+def arcgis_session(max_workers=PAGE_WORKERS):
+    """
+    Pooled session that retries throttled or failed requests with backoff.
+    """
+    retry = Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+    )
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def arcgis_json(session, url, params, token=None):
+    """
+    GET an ArcGIS REST endpoint through the download cache, raising on the
+    errors it reports with a 200.
+    """
+    secret_params = {"token": token} if token else None
+    data = cache.get_json(url, params=params, session=session, secret_params=secret_params)
+    if "error" in data:
+        cache.evict(url, params)
+        raise requests.HTTPError(f"{url}: {data['error']}")
+    return data
+
+
+def layer_info(session, url, token=None):
+    """
+    Layer metadata: the server's maxRecordCount, object id field and field types.
+    """
+    layer_url = url.split('?')[0].rsplit('/query', 1)[0]
+    return arcgis_json(session, layer_url, {"f": "json"}, token)
+
+
+def field_types(info):
+    """
+    Postgres column types for the layer's fields, so every page lands in the same table.
+    """
+    esri_types = {
+        "esriFieldTypeOID": "INTEGER",
+        "esriFieldTypeSmallInteger": "INTEGER",
+        "esriFieldTypeInteger": "INTEGER",
+        "esriFieldTypeBigInteger": "BIGINT",
+        "esriFieldTypeSingle": "REAL",
+        "esriFieldTypeDouble": "DOUBLE PRECISION",
+        "esriFieldTypeDate": "BIGINT",
+        "esriFieldTypeString": "TEXT",
+        "esriFieldTypeGUID": "TEXT",
+        "esriFieldTypeGlobalID": "TEXT",
+    }
+    return {
+        field["name"].lower(): esri_types.get(field["type"], "TEXT")
+        for field in info.get("fields") or []
+    }
+
+
+def fetch_pages(url, session=None, token=None, page_size=None, max_workers=PAGE_WORKERS, skip_offsets=()):
+    """
+    Pages through a feature service query with a bounded number of requests in
+    flight, yielding (offset, GeoDataFrame) as each page arrives. Works against
+    any ArcGIS-compatible endpoint, no database needed.
+    """
+    session = session or arcgis_session(max_workers)
+    base_url, _, query = url.partition('?')
+    params = dict(parse_qsl(query, keep_blank_values=True))
+
+    info = layer_info(session, url, token)
+    page_size = page_size or info.get("maxRecordCount") or 2000
+    if info.get("objectIdField") and "orderByFields" not in params:
+        params["orderByFields"] = info["objectIdField"]  # stable order so offsets don't shift
+
+    count_params = {**params, "returnCountOnly": "true", "f": "json"}
+    count_params.pop("orderByFields", None)
+    total_features = arcgis_json(session, base_url, count_params, token).get("count") or 0
+
+    skip_offsets = set(skip_offsets)
+    offsets = [offset for offset in range(0, total_features, page_size) if offset not in skip_offsets]
+
+    def fetch(offset):
+        page_params = {**params, "resultOffset": offset, "resultRecordCount": page_size}
+        data = arcgis_json(session, base_url, page_params, token)
+        return gpd.GeoDataFrame.from_features(data["features"])
 
-        count_url = f"{base_url}?where=1=1&returnCountOnly=true"
-        if token:
-            count_url += f"&token={token}"
-        count_url += "&f=json"
+    fetch = instrument.bind(fetch)  # pages download on pool threads, charge them to this stage
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        offsets = iter(offsets)
+        for offset in itertools.islice(offsets, max_workers * 2):
+            pending[executor.submit(fetch, offset)] = offset
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                offset = pending.pop(future)
+                yield offset, future.result()
+                for next_offset in itertools.islice(offsets, 1):
+                    pending[executor.submit(fetch, next_offset)] = next_offset
 
-        count_response = requests.get(count_url)
-        total_features = count_response.json().get("count")
 
-        gdf_list = []
+def load_feature_service(dbname, target_schema, url_key, url, crs, resume=True, max_workers=PAGE_WORKERS):
+    """
+    Streams a feature service into the database page by page. Each page and its
+    offset are committed together, so a rerun with resume=True only fetches the
+    pages that did not make it in, as long as the url and page size are unchanged.
+    """
+    table = url_key.lower()
+    srid = CRS(crs).to_epsg()
+    token = portal_token() if url.startswith("https://arcgis.dvrpc.org") else None
+    session = arcgis_session(max_workers)
+
+    print(f"\t \t -> {url_key}...")
+    info = layer_info(session, url, token)
+    # offsets only carry over to the same query paged the same way
+    source = hashlib.sha256(json.dumps([url, info.get("maxRecordCount"), info.get("objectIdField")]).encode()).hexdigest()
+
+    conn = bulk.connect(dbname)
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {target_schema}.load_progress (layer TEXT, page_offset INTEGER);")
+        cur.execute(f"ALTER TABLE {target_schema}.load_progress ADD COLUMN IF NOT EXISTS source TEXT;")
+        cur.execute(f"SELECT page_offset FROM {target_schema}.load_progress WHERE layer = %s AND source = %s;", (table, source))
+        done_offsets = {row[0] for row in cur.fetchall()} if resume else set()
+        if not done_offsets:
+            cur.execute(f"DELETE FROM {target_schema}.load_progress WHERE layer = %s;", (table,))
+    conn.commit()
 
-        total_chunks = math.ceil(total_features / 2000) # 2000 default esri record limit on feature services
+    columns = field_types(info)
+    spatial = bool(info.get("geometryType"))  # tables without geometry load as plain tables
+    if spatial:
+        columns["geometry"] = f"geometry(Geometry, {srid})"
+    if done_offsets:
+        print(f"\t \t -> resuming, {len(done_offsets)} pages already loaded")
+    else:
+        bulk.create_table(conn, target_schema, table, columns, if_exists="truncate")
+
+    rows = 0
+    for offset, page in fetch_pages(url, session, token, max_workers=max_workers, skip_offsets=done_offsets):
+        if len(page):
+            page.columns = map(str.lower, page.columns)
+            page = page[[column for column in page.columns if column in columns]]
+            if spatial:
+                page = page.set_crs(crs, allow_override=True)
+            page = bulk.match_types(page, columns)
+            rows += bulk.copy_rows(conn, page, target_schema, table, srid=srid, commit=False)
+        with conn.cursor() as cur:
+            cur.execute(
+                f"INSERT INTO {target_schema}.load_progress (layer, page_offset, source) VALUES (%s, %s, %s);",
+                (table, offset, source),
+            )
+        conn.commit()
 
-        print(f"\t \t -> {url_key}...")
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM {target_schema}.load_progress WHERE layer = %s;", (table,))
+    conn.commit()
+    bulk.create_indexes(conn, target_schema, table, geometry_columns=["geometry"] if spatial else None)
+    conn.close()
+    print(f"\t \t -> {rows} features")
 
-        for chunk in range(total_chunks):
-            offset = chunk * 2000
-            query_url = f"{url}&resultOffset={offset}&resultRecordCount=2000"
-            if token:
-                query_url += f"&token={token}"
-            response = requests.get(query_url)
-            data = response.json()
 
-            chunk_gdf = gpd.GeoDataFrame.from_features(data['features'])
-            gdf_list.append(chunk_gdf)
+def load_gis_data(dbname, target_schema, url_key, url, crs):
+    """
+    Loads the data from feature services into database.
+    """
+    print("\t -> Loading GIS data...")
+
+    if 'opendata.arcgis.com/' not in url.lower():
+        load_feature_service(dbname, target_schema, url_key, url, crs)
+        return
 
-        gdf = pd.concat(gdf_list, ignore_index=True)
+    print(f"\t \t -> Loading direct GeoJSON for {url_key}...")
+    gdf = gpd.read_file(cache.fetch(url))
+    gdf = gdf.to_crs(crs)
 
     if 'geometry' not in gdf.columns:
         # no geometry service
         gdf.columns = map(str.lower, gdf.columns)
-        gdf.to_sql(url_key.lower(), engine, schema=target_schema, if_exists='replace', index=False)
+        bulk.copy_frame(dbname, pd.DataFrame(gdf), url_key.lower(), target_schema, if_exists="truncate")
     else:
         # geometries
         gdf.columns = map(str.lower, gdf.columns)
         gdf.crs = crs
-        gdf.to_postgis(url_key.lower(), engine, schema=target_schema, if_exists='replace', index=False)
+        bulk.copy_frame(dbname, gdf, url_key.lower(), target_schema, if_exists="truncate")
 
 
 def csv_table(dbname, target_schema, csv):
     """
     Loads the csv into database.
     """
-    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
-
     df = pd.read_csv(csv)
     df.columns = map(str.lower, df.columns)
     table_name = os.path.splitext(os.path.basename(csv))[0]
     print(f"Loading {table_name}.csv...\n")
-    df.to_sql(table_name, con=engine, schema=target_schema, if_exists='replace', index=False)
+    bulk.copy_frame(dbname, df, table_name, target_schema)
+
+
+def count_rows(csv_path):
+    """
+    Data rows in a csv (lines minus the header), without parsing it.
+    """
+    with open(csv_path, 'rb') as f:
+        lines = sum(block.count(b'\n') for block in iter(lambda: f.read(1024 * 1024), b''))
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+            lines += 1
+    return lines - 1
+
+
+def matrix_cache_path(csv_path_i, csv_path_o):
+    """
+    Where the summed matrix for this pair of csvs is cached, keyed on their size and mtime.
+    """
+    stamp = [
+        [os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+        for path in (csv_path_i, csv_path_o)
+    ]
+    key = hashlib.sha256(json.dumps(stamp).encode()).hexdigest()
+    return os.path.join(cache.cache_dir, "matrix", key)
+
+
+def read_matrix(csv_path_i, csv_path_o, block_rows=MATRIX_BLOCK_ROWS):
+    """
+    In-vehicle + out-of-vehicle time as a float32 matrix memory-mapped from the
+    cache. The csvs are only parsed when they changed, in aligned row blocks,
+    so the full matrix is never held in memory.
+
+    Returns (origin tazs, destination tazs, matrix).
+    """
+    path = matrix_cache_path(csv_path_i, csv_path_o)
+    if os.path.exists(path + ".npy") and os.path.exists(path + ".zones.npz"):
+        zones = np.load(path + ".zones.npz")
+        return zones["origins"], zones["destinations"], np.load(path + ".npy", mmap_mode='r')
+
+    print("\t \t -> Summing matrix csvs...")
+    n_rows = count_rows(csv_path_i)
+    if count_rows(csv_path_o) != n_rows:
+        raise ValueError(f"{csv_path_i} and {csv_path_o} have different row counts")
+
+    destinations = pd.read_csv(csv_path_i, index_col=0, nrows=0).columns.astype(np.int32).to_numpy()
+    origins = np.empty(n_rows, dtype=np.int32)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp.npy"
+    matrix = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(n_rows, len(destinations)))
+
+    blocks_i = pd.read_csv(csv_path_i, index_col=0, dtype=np.float32, chunksize=block_rows)
+    blocks_o = pd.read_csv(csv_path_o, index_col=0, dtype=np.float32, chunksize=block_rows)
+    start = 0
+    for block_i, block_o in zip(blocks_i, blocks_o):
+        if not block_i.index.equals(block_o.index) or not block_i.columns.equals(block_o.columns):
+            raise ValueError(f"{csv_path_i} and {csv_path_o} are not aligned at row {start}")
+        end = start + len(block_i)
+        origins[start:end] = block_i.index.astype(np.int32)
+        np.add(block_i.to_numpy(), block_o.to_numpy(), out=matrix[start:end])
+        start = end
+
+    matrix.flush()
+    del matrix
+    np.savez(path + ".zones.npz", origins=origins, destinations=destinations)
+    os.replace(tmp, path + ".npy")
+    return origins, destinations, np.load(path + ".npy", mmap_mode='r')
 
 
-def load_matrix(csv_path_i, csv_path_o, dbname, target_schema, table_name, minutes=45):
+def load_matrix(csv_path_i, csv_path_o, dbname, target_schema, table_name="matrix",
+                thresholds=MATRIX_THRESHOLDS, block_rows=MATRIX_BLOCK_ROWS):
     """
-    Find zones in matrix tables w/in 45 minutes and output to database for analysis
+    Writes every zone pair within the largest threshold to one sparse table and
+    a {table_name}_{minutes}min view per threshold for analysis
     """
-    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
+    with instrument.span("read matrix"):
+        origins, destinations, matrix = read_matrix(csv_path_i, csv_path_o, block_rows)
+    limit = max(thresholds)
 
-    df_i = pd.read_csv(csv_path_i, index_col=0)
-    df_o = pd.read_csv(csv_path_o, index_col=0)
+    conn = bulk.connect(dbname)
+    bulk.create_table(conn, target_schema, table_name, {"o_taz": "INTEGER", "d_taz": "INTEGER", "total_time": "REAL"})
 
-    total_time = df_i.values + df_o.values
+    rows = 0
+    for start in range(0, len(origins), block_rows):
+        block = matrix[start:start + block_rows]
+        o, d = np.nonzero(block <= limit)
+        rows += bulk.copy_rows(conn, pd.DataFrame({
+            'o_taz': origins[start + o],
+            'd_taz': destinations[d],
+            'total_time': block[o, d],
+        }), target_schema, table_name)
 
-    within_threshold_mask = total_time <= minutes
-    
-    o_taz, d_taz = np.where(within_threshold_mask)
-    df = pd.DataFrame({
-        'o_taz': df_i.index[o_taz],
-        'd_taz': df_i.columns[d_taz],
-        'total_time': total_time[o_taz, d_taz]
-    })
-    
-    df.to_sql(table_name, engine, schema=target_schema, if_exists='replace', index=False)
\ No newline at end of file
+    bulk.create_indexes(conn, target_schema, table_name, indexes=[('o_taz', 'total_time'), ('d_taz', 'total_time')])
+    with conn.cursor() as cur:
+        for minutes in sorted(thresholds):
+            cur.execute(f"""
+                CREATE OR REPLACE VIEW {target_schema}.{table_name}_{minutes}min AS
+                SELECT o_taz, d_taz, total_time FROM {target_schema}.{table_name} WHERE total_time <= {minutes};
+            """)
+    conn.commit()
+    conn.close()
+    print(f"\t \t -> {rows} zone pairs within {limit} minutes")
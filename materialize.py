@@ -0,0 +1,195 @@
+import bulk
+import instrument
+
+# one row per materialized view the sql scripts build: its unique key, the
+# relations it reads (from pg_depend, at build time) and when it was last filled
+CATALOG = """
+    CREATE TABLE IF NOT EXISTS public.materialized_views (
+        view TEXT PRIMARY KEY,
+        key TEXT[],
+        depends_on TEXT[],
+        rows BIGINT,
+        built_at TIMESTAMP,
+        refreshed_at TIMESTAMP
+    );
+"""
+
+
+def relation_kinds(cur, relations):
+    """
+    relkind of each relation that exists, by name.
+    """
+    kinds = {}
+    for relation in relations:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (relation,))
+        row = cur.fetchone()
+        if row:
+            kinds[relation] = row[0]
+    return kinds
+
+
+def direct_dependencies(cur, view):
+    """
+    Relations a view's query names, schema-qualified.
+    """
+    cur.execute("""
+        SELECT DISTINCT format('%%s.%%s', n.nspname, c.relname)
+        FROM pg_rewrite r
+        JOIN pg_depend d ON d.classid = 'pg_rewrite'::regclass AND d.objid = r.oid
+            AND d.refclassid = 'pg_class'::regclass
+        JOIN pg_class c ON c.oid = d.refobjid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE r.ev_class = to_regclass(%s) AND d.refobjid <> r.ev_class
+        ORDER BY 1;
+    """, (view,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def view_dependencies(cur, view):
+    """
+    Tables and views a materialized view reads, following plain views down to
+    what they read so a change to input.lodes_data reaches es_count through
+    output.lodes_jobs.
+    """
+    deps, pending = set(), direct_dependencies(cur, view)
+    while pending:
+        relation = pending.pop()
+        if relation in deps:
+            continue
+        deps.add(relation)
+        if relation_kinds(cur, [relation]).get(relation) == "v":
+            pending.extend(direct_dependencies(cur, relation))
+    return sorted(deps)
+
+
+def unique_key(cur, view):
+    """
+    Columns of the view's first unique index, which REFRESH ... CONCURRENTLY needs.
+    """
+    cur.execute("""
+        SELECT array_agg(a.attname ORDER BY k.ord)
+        FROM pg_index i
+        CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord)
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+        WHERE i.indrelid = to_regclass(%s) AND i.indisunique AND i.indpred IS NULL
+        GROUP BY i.indexrelid
+        ORDER BY i.indexrelid
+        LIMIT 1;
+    """, (view,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def row_count(cur, relation):
+    cur.execute("SELECT reltuples::BIGINT FROM pg_class WHERE oid = to_regclass(%s)", (relation,))
+    return cur.fetchone()[0]
+
+
+def built(dbname, relations):
+    """
+    Call after a script has (re)created relations: gathers planner statistics
+    for the tables and materialized views among them and records each view's
+    key and dependencies in public.materialized_views.
+    """
+    conn = bulk.connect(dbname)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(CATALOG)
+        for relation, kind in relation_kinds(cur, relations).items():
+            if kind not in ("r", "m"):
+                continue
+            with instrument.span(f"analyze {relation}", "sql"):
+                cur.execute(f"ANALYZE {relation};")
+            if kind == "m":
+                cur.execute("""
+                    INSERT INTO public.materialized_views (view, key, depends_on, rows, built_at, refreshed_at)
+                    VALUES (%(view)s, %(key)s, %(deps)s, %(rows)s, now(), now())
+                    ON CONFLICT (view) DO UPDATE SET
+                        key = EXCLUDED.key,
+                        depends_on = EXCLUDED.depends_on,
+                        rows = EXCLUDED.rows,
+                        built_at = EXCLUDED.built_at,
+                        refreshed_at = EXCLUDED.refreshed_at;
+                """, {"view": relation, "key": unique_key(cur, relation),
+                      "deps": view_dependencies(cur, relation), "rows": row_count(cur, relation)})
+    conn.close()
+
+
+def missing(dbname, relations):
+    """
+    The relations that don't exist (anymore), e.g. views a DROP ... CASCADE took along.
+    """
+    conn = bulk.connect(dbname)
+    with conn.cursor() as cur:
+        found = relation_kinds(cur, relations)
+    conn.close()
+    return [relation for relation in relations if relation not in found]
+
+
+def read_graph(cur):
+    """
+    Recorded views that still exist as materialized views (a restored snapshot
+    brings them back as tables), with their keys and dependencies.
+    """
+    cur.execute(CATALOG)
+    cur.execute("""
+        SELECT m.view, m.key, m.depends_on FROM public.materialized_views m
+        JOIN pg_class c ON c.oid = to_regclass(m.view)
+        WHERE c.relkind = 'm';
+    """)
+    return {view: (key, deps) for view, key, deps in cur.fetchall()}
+
+
+def downstream(graph, changed):
+    """
+    Views that read any of the changed relations, directly or through another
+    recorded view, ordered so each comes after the views it reads.
+    """
+    changed = set(changed)
+    ordered, seen = [], set()
+
+    def visit(view):
+        if view in seen:
+            return
+        seen.add(view)
+        for dep in graph[view][1]:
+            if dep in graph:
+                visit(dep)
+        ordered.append(view)
+
+    stale = set()
+    grew = True
+    while grew:
+        grew = False
+        for view, (_, deps) in graph.items():
+            if view not in stale and changed.union(stale).intersection(deps):
+                stale.add(view)
+                grew = True
+    for view in sorted(stale):
+        visit(view)
+    return [view for view in ordered if view in stale]
+
+
+def refresh(dbname, changed):
+    """
+    Refreshes the recorded materialized views downstream of relations whose
+    rows were changed in place, concurrently where the view has a unique key,
+    and re-analyzes each one. Returns the views refreshed.
+    """
+    conn = bulk.connect(dbname)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        graph = read_graph(cur)
+        views = downstream(graph, changed)
+        for view in views:
+            print(f"\t \t -> refreshing {view}...")
+            concurrently = "CONCURRENTLY " if graph[view][0] else ""
+            with instrument.span(f"refresh {view}", "sql"):
+                cur.execute(f"REFRESH MATERIALIZED VIEW {concurrently}{view};")
+                cur.execute(f"ANALYZE {view};")
+            cur.execute(
+                "UPDATE public.materialized_views SET rows = %s, refreshed_at = now() WHERE view = %s;",
+                (row_count(cur, view), view),
+            )
+    conn.close()
+    return views
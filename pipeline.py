@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import hashlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import bulk
+import instrument
+
+
+class Stage:
+    """
+    One step of the ETA run. Its fingerprint covers its config inputs, the
+    contents of its code/sql files, the size and mtime of its data files and the
+    fingerprints of the stages it depends on.
+
+    A resumable stage's run takes a resume flag, set when the same fingerprint
+    failed or was interrupted last time so partial work can be kept.
+
+    probe is called at plan time and its result joins the fingerprint, for
+    inputs that can change behind the same url (a feed's content hash).
+
+    incremental is a predicate over stage names: when the stage itself is
+    unchanged and everything that changed upstream of it passes, its run is
+    called with changed=[those stages] to patch its outputs in place instead
+    of rebuilding them.
+    """
+
+    def __init__(self, name, run, deps=(), inputs=None, files=(), data_files=(), resumable=False,
+                 probe=None, incremental=None):
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        self.inputs = inputs
+        self.files = list(files)
+        self.data_files = list(data_files)
+        self.resumable = resumable
+        self.probe = probe
+        self.incremental = incremental
+
+
+def file_digest(path):
+    """
+    sha256 of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def digest(parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def own_fingerprint(stage):
+    """
+    Fingerprint of what a stage is given directly: inputs, files, data files, probe.
+    """
+    return digest({
+        "inputs": stage.inputs,
+        "files": {path: file_digest(path) for path in stage.files},
+        "data_files": {
+            path: [os.path.getsize(path), os.path.getmtime(path)] if os.path.exists(path) else None
+            for path in stage.data_files
+        },
+        "probe": stage.probe() if stage.probe else None,
+    })
+
+
+def fingerprint(stage, upstream, own=None):
+    """
+    Fingerprint of a stage given the fingerprints of its dependencies.
+    """
+    return digest({
+        "own": own or own_fingerprint(stage),
+        "deps": {dep: upstream[dep] for dep in sorted(stage.deps)},
+    })
+
+
+def topological(stages):
+    """
+    Stages ordered so every stage comes after its dependencies.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    ordered, seen = [], set()
+
+    def visit(stage, path=()):
+        if stage.name in path:
+            raise ValueError(f"Stage cycle: {' -> '.join(path + (stage.name,))}")
+        if stage.name in seen:
+            return
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError(f"{stage.name} depends on unknown stage {dep}")
+            visit(by_name[dep], path + (stage.name,))
+        seen.add(stage.name)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+def read_manifest(dbname):
+    """
+    Last recorded fingerprint and status per stage.
+    """
+    conn = bulk.connect(dbname)
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.stage_manifest (
+                stage TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                status TEXT,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                error TEXT
+            );
+        """)
+        cur.execute("ALTER TABLE public.stage_manifest ADD COLUMN IF NOT EXISTS own_fingerprint TEXT;")
+        cur.execute("SELECT stage, fingerprint, status, own_fingerprint FROM public.stage_manifest;")
+        manifest = {stage: (fp, status, own) for stage, fp, status, own in cur.fetchall()}
+    conn.commit()
+    conn.close()
+    return manifest
+
+
+def record(dbname, stage, fp, status, error=None, own=None):
+    """
+    Upserts a stage's fingerprint and status in the manifest.
+    """
+    conn = bulk.connect(dbname)
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO public.stage_manifest (stage, fingerprint, status, started_at, finished_at, error, own_fingerprint)
+            VALUES (%(stage)s, %(fp)s, %(status)s, now(), CASE WHEN %(status)s = 'running' THEN NULL ELSE now() END, %(error)s, %(own)s)
+            ON CONFLICT (stage) DO UPDATE SET
+                fingerprint = EXCLUDED.fingerprint,
+                own_fingerprint = EXCLUDED.own_fingerprint,
+                status = EXCLUDED.status,
+                started_at = CASE WHEN EXCLUDED.status = 'running' THEN now() ELSE stage_manifest.started_at END,
+                finished_at = EXCLUDED.finished_at,
+                error = EXCLUDED.error;
+        """, {"stage": stage, "fp": fp, "status": status, "error": error, "own": own})
+    conn.commit()
+    conn.close()
+
+
+def plan(dbname, stages, force=()):
+    """
+    Fingerprints every stage and works out which ones have to run: anything
+    new, changed, failed or forced, plus everything downstream of those.
+    Stages that only have to run because of upstream changes their
+    incremental predicate accepts are listed in changed with those changes.
+    """
+    ordered = topological(stages)
+    manifest = read_manifest(dbname)
+    fingerprints, owns, dirty, resume = {}, {}, set(), set()
+    roots, changed = {}, {}
+
+    for stage in ordered:
+        own = owns[stage.name] = own_fingerprint(stage)
+        fp = fingerprints[stage.name] = fingerprint(stage, fingerprints, own)
+        recorded = manifest.get(stage.name)
+        upstream = set().union(*(roots[dep] for dep in stage.deps if dep in dirty))
+        if stage.name in force or recorded is None or recorded[1] != "success" or recorded[2] != own:
+            dirty.add(stage.name)
+            roots[stage.name] = {stage.name}
+            if recorded and recorded[0] == fp and recorded[1] != "success" and stage.name not in force:
+                resume.add(stage.name)
+        elif upstream or recorded[0] != fp:
+            dirty.add(stage.name)
+            roots[stage.name] = upstream
+            if stage.incremental and upstream and all(stage.incremental(name) for name in upstream):
+                changed[stage.name] = sorted(upstream)
+
+    return ordered, fingerprints, owns, dirty, resume, changed
+
+
+def run(dbname, stages, max_workers=4, force=()):
+    """
+    Runs the stages that need it, independent ones in parallel. A failed stage
+    stops its dependents; everything that succeeded is skipped on the next run.
+    """
+    ordered, fingerprints, owns, dirty, resume, changed = plan(dbname, stages, force)
+    skipped = [stage.name for stage in ordered if stage.name not in dirty]
+    if skipped:
+        print(f"\t -> Up to date, skipping: {', '.join(skipped)}")
+
+    todo = {stage.name: stage for stage in ordered if stage.name in dirty}
+    finished, failed = set(skipped), {}
+
+    def execute(stage):
+        record(dbname, stage.name, fingerprints[stage.name], "running", own=owns[stage.name])
+        start = time.time()
+        with instrument.span(stage.name, "stage", resumed=stage.name in resume, changed=changed.get(stage.name)):
+            if stage.name in changed:
+                print(f"\t -> {stage.name}: updating for {', '.join(changed[stage.name])}")
+                stage.run(changed=changed[stage.name])
+            elif stage.resumable:
+                stage.run(resume=stage.name in resume)
+            else:
+                stage.run()
+        print(f"\t -> {stage.name} done in {time.time() - start:.1f}s")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while todo or running:
+            blocked = [name for name, stage in todo.items() if any(dep in failed for dep in stage.deps)]
+            for name in blocked:
+                failed[name] = "upstream failure"
+                del todo[name]
+
+            ready = [stage for stage in todo.values() if all(dep in finished for dep in stage.deps)]
+            for stage in ready:
+                running[executor.submit(execute, stage)] = stage
+                del todo[stage.name]
+
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    failed[stage.name] = str(e)
+                    record(dbname, stage.name, fingerprints[stage.name], "failed", traceback.format_exc(), owns[stage.name])
+                    print(f"\t -> {stage.name} FAILED: {e}")
+                else:
+                    finished.add(stage.name)
+                    record(dbname, stage.name, fingerprints[stage.name], "success", own=owns[stage.name])
+
+    if failed:
+        raise RuntimeError(f"Stages failed: {', '.join(failed)}")
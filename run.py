@@ -1,19 +1,56 @@
 import os
 import db
+import argparse
+import pipeline
 import load
 import gtfs
 import json
 import time
 import census
 import walkshed
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import coverage
+import access
+import scoring
+import departures
+import topology
+import snap
+import stops as transit_stops
+import tiles
+import instrument
+import materialize
 
 start_time = time.time()
 
-dbname = "eta"
 schemas = ["input", "network", "output"]
 data_sources = "source/data_sources.json"
 crs = "EPSG:26918"
+topology_engine = "numpy"  # "numpy" snaps the sidewalk topology in topology.py, "pgrouting" runs pgr_createTopology
+topology_tolerance = 0.001  # meters, endpoints this close to an existing vertex snap to it
+snap_engine = "kdtree"  # "kdtree" snaps stops and ES points in snap.py, "sql" runs sql/transit_poi.sql
+snap_distance = 300  # meters, stops further than this from the network are reported, not routed
+walkshed_engine = "csr"  # "csr" routes in memory, "pgrouting" keeps routing in the db
+walkshed_contract = True  # csr only, route on the graph with degree-2 chains folded away
+walkshed_hull = "convex"  # "convex" or "concave", concave matches between engines on PostGIS >= 3.3 only
+walkshed_paths = False  # also keep every reachable node in network.transit_poi_paths
+walkshed_coverage = "vector"  # "vector" runs the transit_ws view, "raster" grids it in numpy
+coverage_resolution = 10  # meters, raster coverage only
+matrix_thresholds = [30, 45, 60]  # minutes, each gets an input.matrix_{minutes}min view
+access_engine = "sparse"  # "sparse" computes transit accessibility in scipy, "sql" runs sql/accessibility.sql
+access_measures = [("45", "cutoff", 45)]  # (label, cutoff/linear/exponential, minutes), sparse engine only
+departures_engine = "numpy"  # "numpy" counts departures in departures.py, "sql" runs sql/departures.sql (one service date only)
+service_dates = ["2024-09-11"]  # departures are the daily average over these service days
+departure_windows = {}  # extra time-of-day counts, e.g. {"am_peak": ("06:00:00", "09:00:00")}, numpy engine only
+scoring_engine = "numpy"  # "numpy" scores in scoring.py, "sql" runs sql/scoring.sql
+# what-if weightings scored alongside the base into output.scenario_scores, numpy engine only, e.g.
+# {"name": "no_seniors", "tiles": 5, "weights": {"pop65_quantile": 0, "depart_quantile": 2}}
+scoring_scenarios = []
+# what-if runs next to the base run over the same input, gtfs, network and output tables, each written to
+# its own output_{name} schema. A scenario only reruns the stages its keys change and reads the rest from
+# output: service_dates / departure_windows (departures), access_measures (accessibility, the first measure
+# fills the t_45 columns, cutoffs up to max(matrix_thresholds)), tiles / weights (scoring), e.g.
+# {"name": "saturday", "service_dates": ["2024-09-14"]}, {"name": "t60", "access_measures": [("60", "cutoff", 60)]}
+scenarios = []
+export_format = "ndjson"  # "ndjson" (also cut into eta.mbtiles when tippecanoe is installed), "flatgeobuf", "geoparquet", or None to skip
 
 acs_variables = [
     "B11001_001E",  # Total Number of Households
@@ -30,37 +67,315 @@ acs_state_county_pairs = [
     ("42", ["017", "029", "045", "091", "101"])   
 ]
 
-db.create_database(dbname)
-db.create_schemas(dbname, schemas)
-db.create_extensions(dbname)
+parser = argparse.ArgumentParser(description="Builds the ETA database, rerunning only the stages whose inputs changed.")
+parser.add_argument("--dbname", default="eta", help="database to build, or to add scenarios to")
+parser.add_argument("--rebuild", action="store_true", help="drop the database and run every stage from scratch")
+parser.add_argument("--force", nargs="+", default=[], metavar="STAGE", help="rerun these stages (and everything downstream)")
+parser.add_argument("--workers", type=int, default=4, help="stages run at the same time")
+parser.add_argument("--statement-timeout", type=float, default=None, metavar="SECONDS",
+                    help="cancel any single sql statement that runs longer than this")
+parser.add_argument("--report-dir", default="reports", help="where the run report and chrome trace are written")
+parser.add_argument("--explain", type=int, default=0, metavar="N", help="EXPLAIN ANALYZE the N slowest sql statements into the report")
+args = parser.parse_args()
+dbname = args.dbname
 
-census.load_acs_data(acs_variables, acs_year, acs_state_county_pairs, dbname, schemas[0])
-census.load_lodes_data(dbname, schemas[0])
+db.ensure_database(dbname, rebuild=args.rebuild)
+db.create_schemas(dbname, schemas + [f"output_{scenario['name']}" for scenario in scenarios])
+db.create_extensions(dbname)
 
 with open(data_sources, 'r') as f:
     urls = json.load(f)
 gis_urls = urls['gis_urls']
 gtfs_urls = urls['gtfs_urls']
 
+
+def sql_stage(sql, params=None):
+    """
+    drops what the script created last time, then runs it and analyzes what it built
+    """
+    def run():
+        db.reset_analysis(dbname, sql, params)
+        db.do_analysis(dbname, sql, timeout=args.statement_timeout, params=params)
+        materialize.built(dbname, db.created_relations(sql, params))
+    return run
+
+
+stages = [
+    pipeline.Stage(
+        "acs",
+        lambda: census.load_acs_data(acs_variables, acs_year, acs_state_county_pairs, dbname, schemas[0]),
+        inputs=[acs_variables, acs_year, acs_state_county_pairs],
+        files=["census.py"],
+    ),
+    pipeline.Stage(
+        "lodes",
+        lambda: census.load_lodes_data(dbname, schemas[0], acs_state_county_pairs),
+        inputs=[acs_state_county_pairs],
+        files=["census.py"],
+    ),
+]
+
 for url_key, url_value in gis_urls.items():
-    load.load_gis_data(dbname, schemas[0], url_key, url_value, crs)
+    stages.append(pipeline.Stage(
+        f"gis:{url_key}",
+        lambda url_key=url_key, url_value=url_value: load.load_gis_data(dbname, schemas[0], url_key, url_value, crs),
+        inputs=[url_value, crs],
+        files=["load.py"],
+    ))
+
+for name, url, feed_schemas in gtfs.resolve_feeds(gtfs_urls):
+    stages.append(pipeline.Stage(
+        "gtfs:" + "+".join(feed_schemas.values()),
+        lambda name=name, url=url, feed_schemas=feed_schemas: gtfs.load_feed(dbname, name, url, feed_schemas),
+        inputs=[url, feed_schemas],
+        files=["gtfs.py"],
+        probe=lambda url=url: gtfs.feed_digest(url),
+    ))
+
+matrix_csvs = ['source/AM_matrix_i_put.csv', 'source/AM_matrix_o_put.csv']
+stages.append(pipeline.Stage(
+    "matrix",
+    lambda: load.load_matrix(*matrix_csvs, dbname, schemas[0], 'matrix', thresholds=matrix_thresholds),
+    inputs=[matrix_thresholds],
+    files=["load.py"],
+    data_files=matrix_csvs,
+))
+
+feed_loaders = [stage.name for stage in stages if stage.name.startswith("gtfs:")]
+loaders = [stage.name for stage in stages if stage.name not in feed_loaders]
+
+# stages that can patch just the reloaded agencies' rows when nothing but gtfs:* stages changed upstream
+from_feeds = lambda name: name.startswith("gtfs:")
+
+
+def changed_labels(changed):
+    """
+    output.all_stops labels of the feeds behind the changed gtfs:* stages
+    """
+    return [departures.feed_labels[schema] for schema in gtfs.stage_schemas(changed)]
+
+
+# loaders whose tables analysis.sql only reads through views; they are truncated and
+# refilled in place, so a reload just refreshes the materialized views reading them
+refreshable_inputs = {
+    "acs": "input.acs_data",
+    "lodes": "input.lodes_data",
+    "gis:open_space": "input.open_space",
+    "gis:trails": "input.trails",
+}
+
+
+def analysis_stage(changed=None):
+    """
+    builds the analysis tables and views, or only refreshes the materialized views
+    downstream of the reloaded inputs when everything the script built is still there
+    """
+    sql = './sql/analysis.sql'
+    if changed and not materialize.missing(dbname, db.created_relations(sql)):
+        materialize.refresh(dbname, [refreshable_inputs[name] for name in changed])
+    else:
+        sql_stage(sql)()
+
+
+if walkshed_engine == "pgrouting":
+    route = lambda resume=False: walkshed.route_parallel(dbname, resume=resume, paths=walkshed_paths, hull=walkshed_hull)
+else:
+    route = lambda resume=False, changed=None: walkshed.route_all(
+        dbname, paths=walkshed_paths, hull=walkshed_hull, contract=walkshed_contract,
+        gtfs=changed_labels(changed) if changed else None,
+    )
+
+
+def stops_stage(changed=None):
+    """
+    builds output.all_stops and stop_assignment, or refreshes just the changed feeds' stops
+    """
+    if changed and departures.table_exists(dbname, "output.all_stops"):  # a feed's table was recreated and took it along
+        transit_stops.refresh_stops(dbname, changed_labels(changed))
+    else:
+        sql_stage('./sql/stops.sql')()
+
+
+if topology_engine == "pgrouting":
+    build_topology = sql_stage('./sql/topology.sql')
+else:
+    build_topology = lambda: topology.build_topology(dbname, topology_tolerance)
+
+
+if snap_engine == "sql":
+    snap_pois = sql_stage('./sql/transit_poi.sql')
+else:
+    snap_pois = lambda changed=None: snap.snap_points(dbname, snap_distance, gtfs=changed_labels(changed) if changed else None)
+
+
+def network_stage():
+    """
+    builds the sidewalk network and its routable topology
+    """
+    sql_stage('./sql/network.sql')()
+    build_topology()
+
+
+def es_walk_stage(changed=None):
+    """
+    walk time from the sidewalk network to the nearest essential service, skipped
+    when only feeds changed since network.es_poi stays as it was
+    """
+    if not changed:
+        snap.es_walk_time(dbname)
+
+
+if access_engine == "sql":
+    transit_access = sql_stage('./sql/accessibility.sql')
+else:
+    transit_access = lambda: access.transit_access(dbname, access_measures)
+
+if walkshed_coverage == "raster":
+    cover = lambda: coverage.transit_ws(dbname, resolution=coverage_resolution)
+else:
+    cover = lambda changed=None: (
+        materialize.refresh(dbname, ["network.transit_poi_isochrones"]) if changed else sql_stage('./sql/coverage.sql')()
+    )
+
+if departures_engine == "sql":
+    if len(service_dates) != 1:
+        raise ValueError("the sql departures engine counts a single service date, set one in service_dates")
+    count_departures = sql_stage('./sql/departures.sql', departures.service_day_params(service_dates[0]))
+else:
+    count_departures = lambda: departures.departures(dbname, service_dates, departure_windows)
+
+
+def departures_stage(changed=None):
+    """
+    counts departures per stop, or recounts just the changed feeds and refreshes transit_departs
+    """
+    if changed:
+        feeds = {schema: departures.feed_labels[schema] for schema in gtfs.stage_schemas(changed)}
+        departures.departures(dbname, service_dates, departure_windows, feeds=feeds, update=True)
+        materialize.refresh(dbname, ["output.stops_w_departs"])
+        return
+    count_departures()
+    sql_stage('./sql/transit_departs.sql')()
+
+
+if scoring_engine == "sql":
+    score = sql_stage('./sql/scoring.sql')
+else:
+    score = lambda: scoring.run_scoring(dbname, scoring_scenarios)
+
+stages += [
+    pipeline.Stage(
+        "analysis", analysis_stage, deps=loaders,
+        files=['./sql/analysis.sql'], incremental=lambda name: name in refreshable_inputs,
+    ),
+    pipeline.Stage(
+        "stops", stops_stage, deps=["analysis"] + feed_loaders,
+        files=["stops.py", './sql/stops.sql'], incremental=from_feeds,
+    ),
+    pipeline.Stage(
+        "accessibility", transit_access, deps=["analysis"],
+        inputs=[access_engine, access_measures],
+        files=["access.py", './sql/accessibility.sql'],
+    ),
+    pipeline.Stage(
+        "departures", departures_stage, deps=["stops"],
+        inputs=[departures_engine, service_dates, departure_windows],
+        files=["departures.py", './sql/departures.sql', './sql/transit_departs.sql'],
+        incremental=from_feeds if departures_engine == "numpy" else None,
+    ),
+    pipeline.Stage(
+        "network", network_stage, deps=["gis:pedestrian_network"],
+        inputs=[topology_engine, topology_tolerance],
+        files=["topology.py", './sql/network.sql', './sql/topology.sql'],
+    ),
+    pipeline.Stage(
+        "transit_poi", snap_pois, deps=["network", "stops"],
+        inputs=[snap_engine, snap_distance],
+        files=["snap.py", './sql/transit_poi.sql'],
+        incremental=from_feeds if snap_engine == "kdtree" else None,
+    ),
+    pipeline.Stage(
+        "es_walk", es_walk_stage, deps=["transit_poi"],
+        files=["snap.py", "graph.py"], incremental=from_feeds,
+    ),
+    pipeline.Stage(
+        "walksheds", route, deps=["transit_poi"],
+        inputs=[walkshed_engine, walkshed_hull, walkshed_paths, walkshed_contract],
+        files=["walkshed.py", "graph.py"],
+        resumable=True,
+        incremental=from_feeds if walkshed_engine == "csr" else None,
+    ),
+    pipeline.Stage(
+        "coverage", cover, deps=["walksheds"],
+        inputs=[walkshed_coverage, coverage_resolution],
+        files=["coverage.py", './sql/coverage.sql'],
+        incremental=from_feeds if walkshed_coverage == "vector" else None,
+    ),
+    pipeline.Stage(
+        "scoring", score, deps=["analysis", "accessibility", "departures", "coverage"],
+        inputs=[scoring_engine, scoring_scenarios],
+        files=["scoring.py", './sql/scoring.sql'],
+    ),
+]
+
+
+def scenario_stages(scenario):
+    """
+    the stages one scenario reruns, all writing to output_{name}; the scenario's
+    scoring reads whatever it didn't recompute from the base run
+    """
+    name = scenario["name"]
+    schema = f"output_{name}"
+    stages, access_from, departures_from = [], None, None
+
+    if "access_measures" in scenario:
+        measures = scenario["access_measures"]
+        if max((parameter for _, kind, parameter in measures if kind == "cutoff"), default=0) > max(matrix_thresholds):
+            raise ValueError(f"scenario {name}: cutoffs past {max(matrix_thresholds)} minutes aren't in input.matrix")
+        stages.append(pipeline.Stage(
+            f"accessibility@{name}", lambda: access.transit_access(dbname, measures, output=schema), deps=["analysis"],
+            inputs=[measures], files=["access.py"],
+        ))
+        access_from = (schema, measures[0][0])
+
+    if "service_dates" in scenario or "departure_windows" in scenario:
+        dates = scenario.get("service_dates", service_dates)
+        windows = scenario.get("departure_windows", departure_windows)
+
+        def scenario_departures():
+            departures.departures(dbname, dates, windows, output=schema)
+            sql_stage('./sql/transit_departs.sql', {"output": schema})()
+        stages.append(pipeline.Stage(
+            f"departures@{name}", scenario_departures, deps=["stops"],
+            inputs=[dates, windows], files=["departures.py", './sql/transit_departs.sql'],
+        ))
+        departures_from = schema
 
-if 'septa' in gtfs_urls:
-    gtfs.download_and_load_septagtfs(dbname, gtfs_urls['septa'])  
-if 'nj_transit' in gtfs_urls:
-    for url in gtfs_urls['nj_transit']:
-        gtfs.download_and_load_njtgtfs(dbname, url)
-if 'patco' in gtfs_urls:
-    gtfs.download_and_load_patcogtfs(dbname, gtfs_urls['patco'])
+    weights = {key: scenario[key] for key in ("tiles", "weights") if key in scenario}
+    sources = scoring.scenario_sources(access_from, departures_from)
+    stages.append(pipeline.Stage(
+        f"scoring@{name}", lambda: scoring.run_scoring(dbname, output=schema, sources=sources, base=weights),
+        deps=["accessibility", "departures", "coverage"] + [stage.name for stage in stages],
+        inputs=[weights, sources], files=["scoring.py"],
+    ))
+    return stages
 
-load.load_matrix('source/AM_matrix_i_put.csv', 'source/AM_matrix_o_put.csv', dbname, schemas[0], 'matrix_45min')
 
-db.do_analysis(dbname, './sql/analysis.sql')
+for scenario in scenarios:
+    stages += scenario_stages(scenario)
 
-pois = walkshed.get_transit_poi(dbname)
-walkshed.polys(dbname)
+if export_format:
+    stages.append(pipeline.Stage(
+        "tiles", lambda: tiles.export_layers(dbname, export_format), deps=["scoring", "walksheds"],
+        inputs=[export_format, tiles.output_dir],
+        files=["tiles.py"],
+    ))
 
-db.do_analysis(dbname, './sql/scoring.sql')
+instrument.start(dbname, args.report_dir, args.explain)
+try:
+    pipeline.run(dbname, stages, max_workers=args.workers, force=args.force)
+finally:
+    instrument.finish()
 
 end_time = time.time()
 duration = end_time - start_time
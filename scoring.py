@@ -0,0 +1,320 @@
+import numpy as np
+import pandas as pd
+import bulk
+from graph import copy_query
+
+# what each quantile ranks, as (output table, value column, descending); ties
+# keep geoid order, nulls sort the way postgres does (last ascending, first descending)
+quantile_sources = {
+    "hh_pov_quantile": ("acs_bg", "hh_pov", False),
+    "hh_dis_quantile": ("acs_bg", "hh_dis", False),
+    "pop65_quantile": ("acs_bg", "pop65", False),
+    "es_quantile": ("es_count", "es_sum", False),
+    "jobs_quantile": ("es_count", "sum_jobs", False),
+    "t_es_quantile": ("transit_45_es", "es_cnt", True),
+    "t_jobs_quantile": ("transit_45_jobs", "jobs", True),
+    "t_zone_quantile": ("transit_45min", "t_45min_zone_cnt", True),
+    "depart_quantile": ("transit_departs", "total_departures", True),
+    "walkshed_quantile": ("transit_ws", "intersection_percent", True),
+}
+
+source_columns = {
+    "acs_bg": ["hh", "pop", "hh_dis", "hh_pov", "pop65"],
+    "es_count": ["ss_cnt", "food_cnt", "hc_cnt", "school_cnt", "os_check", "trail_cnt", "es_sum", "sum_jobs"],
+    "transit_45_es": ["es_cnt"],
+    "transit_45_jobs": ["jobs"],
+    "transit_45min": ["t_45min_zone_cnt"],
+    "transit_departs": ["total_departures"],
+    "transit_ws": ["intersection_percent"],
+    "bg_muni_crosswalk": ["mun1", "mun2"],
+}
+
+# each rank is the (weighted) average of its quantiles, rounded down like the integer math in scoring.sql
+default_weights = {
+    "vul_pop_rank": {"hh_pov_quantile": 1, "hh_dis_quantile": 1, "pop65_quantile": 1},
+    "es_rank": {"es_quantile": 1, "jobs_quantile": 1},
+    "transit_access_rank": {"t_45_es_job_avg": 1, "t_zone_quantile": 1, "depart_quantile": 1, "walkshed_quantile": 1},
+}
+
+
+def sort_positions(values, descending=False):
+    """
+    Position of each value in ORDER BY value [DESC], stable on ties.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    if descending:
+        order = np.lexsort((-values, ~missing))
+    else:
+        order = np.lexsort((values, missing))
+    positions = np.empty(len(values), dtype=np.int64)
+    positions[order] = np.arange(len(values))
+    return positions
+
+
+def tiles_at(positions, n_tiles):
+    """
+    NTILE(n) bucket for each sort position: the first len % n buckets get one
+    extra row. n_tiles can be an array, giving one row of buckets per entry.
+    """
+    n_rows = len(positions)
+    n_tiles = np.asarray(n_tiles)[..., None]
+    size, extra = n_rows // n_tiles, n_rows % n_tiles
+    boundary = extra * (size + 1)
+    return np.where(
+        positions < boundary,
+        positions // (size + 1),
+        extra + (positions - boundary) // np.maximum(size, 1),
+    ) + 1
+
+
+def ntile(values, n=10, descending=False):
+    """
+    NTILE(n) OVER (ORDER BY values [DESC]) in numpy.
+    """
+    return tiles_at(sort_positions(values, descending), n)
+
+
+class Indicators:
+    """
+    Every scoring input keyed on one geoid axis, with a presence mask per
+    source table so the SQL joins can be reproduced.
+    """
+
+    def __init__(self, geoids, values, present):
+        self.geoids = geoids
+        self.values = values
+        self.present = present
+
+    def __len__(self):
+        return len(self.geoids)
+
+
+def scenario_sources(access=None, departures=None):
+    """
+    Where a scenario's own indicators live, for load_indicators: access is the
+    (schema, label) of the measure standing in for transit_45*, departures the
+    schema holding its transit_departs. Anything not given comes from output.
+    """
+    sources = {}
+    if access:
+        schema, label = access
+        sources["transit_45_es"] = (f"{schema}.transit_{label}_es", {})
+        sources["transit_45_jobs"] = (f"{schema}.transit_{label}_jobs", {})
+        sources["transit_45min"] = (f"{schema}.transit_{label}min", {"t_45min_zone_cnt": f"t_{label}min_zone_cnt"})
+    if departures:
+        sources["transit_departs"] = (f"{departures}.transit_departs", {})
+    return sources
+
+
+def load_indicators(dbname, sources=None):
+    """
+    Pulls the block groups and every table scoring reads, once. sources
+    reads a table from another relation, {table: (relation, {column: source column})}.
+    """
+    sources = sources or {}
+    frames = {"census_blockgroups": copy_query(
+        dbname, "SELECT geoid FROM input.census_blockgroups", dtype={"geoid": str}
+    )}
+    for table, columns in source_columns.items():
+        relation, renames = sources.get(table, (f"output.{table}", {}))
+        select = ", ".join(f"{renames[column]} AS {column}" if column in renames else column for column in columns)
+        frames[table] = copy_query(
+            dbname, f"SELECT geoid, {select} FROM {relation}", dtype={"geoid": str, "mun1": str, "mun2": str}
+        )
+
+    geoids = np.unique(np.concatenate([frame["geoid"].dropna().to_numpy(dtype=str) for frame in frames.values()]))
+    values, present = {}, {}
+    for table, frame in frames.items():
+        frame = frame.dropna(subset=["geoid"]).drop_duplicates("geoid")
+        idx = np.searchsorted(geoids, frame["geoid"].to_numpy(dtype=str))
+        present[table] = np.zeros(len(geoids), dtype=bool)
+        present[table][idx] = True
+        for column in source_columns.get(table, []):
+            if pd.api.types.is_numeric_dtype(frame[column]):
+                column_values = np.full(len(geoids), np.nan)
+            else:
+                column_values = np.full(len(geoids), None, dtype=object)
+            column_values[idx] = frame[column].to_numpy()
+            values[column] = column_values
+    return Indicators(geoids, values, present)
+
+
+def scenario_weights(scenarios, rank):
+    """
+    (scenarios x quantiles) weight matrix for one rank, defaults where a scenario doesn't say.
+    """
+    names = list(default_weights[rank])
+    weights = np.array([
+        [scenario.get("weights", {}).get(name, default_weights[rank][name]) for name in names]
+        for scenario in scenarios
+    ], dtype=np.float64)
+    return names, weights
+
+
+def weighted_rank(quantiles, names, weights):
+    """
+    floor(sum(w * q) / sum(w)) per scenario; null where a weighted quantile is null.
+    """
+    stacked = np.stack([quantiles[name] for name in names], axis=-1)  # scenarios x geoids x quantiles
+    used = weights[:, None, :] > 0
+    total = np.where(used, stacked * weights[:, None, :], 0).sum(axis=-1)
+    missing = (used & np.isnan(stacked)).any(axis=-1)
+    rank = np.floor(total / weights.sum(axis=1)[:, None])
+    return np.where(missing, np.nan, rank)
+
+
+def score(indicators, scenarios):
+    """
+    Every quantile and rank for a batch of scenarios in one vectorized pass.
+    A scenario is a dict with optional "tiles" (quantile count, default 10) and
+    "weights" ({quantile: weight}, 0 drops an indicator).
+
+    Returns {name: scenarios x geoids array}, nan where the SQL would be null.
+    """
+    tiles = np.array([scenario.get("tiles", 10) for scenario in scenarios])
+    n_scenarios, n_geoids = len(scenarios), len(indicators)
+    quantiles = {}
+
+    for name, (table, column, descending) in quantile_sources.items():
+        rows = indicators.present[table]
+        quantile = np.full((n_scenarios, n_geoids), np.nan)
+        positions = sort_positions(indicators.values[column][rows], descending)
+        quantile[:, rows] = tiles_at(positions, tiles)
+        quantiles[name] = quantile
+
+    quantiles["t_45_es_job_avg"] = np.floor((quantiles["t_jobs_quantile"] + quantiles["t_es_quantile"]) / 2)
+
+    for rank in default_weights:
+        names, weights = scenario_weights(scenarios, rank)
+        quantiles[rank] = weighted_rank(quantiles, names, weights)
+
+    # transit_rank is left joined to every block group, missing ranks score as the last quantile
+    transit = np.where(np.isnan(quantiles["transit_access_rank"]), tiles[:, None], quantiles["transit_access_rank"])
+    quantiles["access_gap_rank"] = quantiles["vul_pop_rank"] - quantiles["es_rank"]
+    quantiles["eta_score"] = quantiles["access_gap_rank"] * transit
+    quantiles["tiles"] = np.broadcast_to(tiles[:, None], (n_scenarios, n_geoids))
+    return quantiles
+
+
+def integers(values):
+    return pd.array(np.where(np.isnan(values), None, values), dtype="Int64")
+
+
+def base_tables(indicators, scores):
+    """
+    The five scoring.sql tables for the first scenario.
+    """
+    v, p = indicators.values, indicators.present
+    q = {name: values[0] for name, values in scores.items()}
+    tiles = int(q["tiles"][0]) if len(indicators) else 10
+    geoids = indicators.geoids
+    frame = lambda rows, columns: pd.DataFrame({"geoid": geoids[rows], **columns})
+
+    acs = p["acs_bg"]
+    vul_pop_rank = frame(acs, {
+        **{column: integers(v[column][acs]) for column in source_columns["acs_bg"]},
+        **{name: integers(q[name][acs]) for name in ["hh_pov_quantile", "hh_dis_quantile", "pop65_quantile", "vul_pop_rank"]},
+    })
+
+    es = p["es_count"]
+    es_rank = frame(es, {
+        **{column: integers(v[column][es]) for column in source_columns["es_count"]},
+        **{name: integers(q[name][es]) for name in ["es_quantile", "jobs_quantile", "es_rank"]},
+    })
+
+    gap = acs & es
+    access_gap_rank = frame(gap, {name: integers(q[name][gap]) for name in ["vul_pop_rank", "es_rank", "access_gap_rank"]})
+
+    cb = p["census_blockgroups"]
+    transit_rank = frame(cb, {
+        "t_es_cnt": v["es_cnt"][cb],
+        "t_jobs_cnt": v["jobs"][cb],
+        "t_45_es_job_avg": integers(q["t_45_es_job_avg"][cb]),
+        "t_45min_zone_cnt": v["t_45min_zone_cnt"][cb],
+        "t_zone_quantile": integers(q["t_zone_quantile"][cb]),
+        "total_departures": integers(v["total_departures"][cb]),
+        "depart_quantile": integers(q["depart_quantile"][cb]),
+        "walkshed_quantile": integers(q["walkshed_quantile"][cb]),
+        "transit_access_rank": integers(q["transit_access_rank"][cb]),
+    })
+
+    fill = lambda values, default: np.where(np.isnan(values), default, values)
+    output = frame(cb, {
+        "mun1": v["mun1"][cb],
+        "mun2": v["mun2"][cb],
+        **{column: integers(v[column][cb]) for column in source_columns["acs_bg"]},
+        "vul_pop_rank": integers(q["vul_pop_rank"][cb]),
+        **{column: integers(v[column][cb]) for column in source_columns["es_count"]},
+        "es_rank": integers(q["es_rank"][cb]),
+        "access_gap_rank": integers(q["access_gap_rank"][cb]),
+        "t_45min_zone_cnt": fill(v["t_45min_zone_cnt"][cb], 0),
+        "t_zone_quantile": integers(fill(q["t_zone_quantile"][cb], tiles)),
+        "t_es_cnt": fill(v["es_cnt"][cb], 0),
+        "t_jobs_cnt": fill(v["jobs"][cb], 0),
+        "t_45_es_job_avg": integers(fill(q["t_45_es_job_avg"][cb], tiles)),
+        "total_departures": integers(fill(v["total_departures"][cb], 0)),
+        "depart_quantile": integers(fill(q["depart_quantile"][cb], tiles)),
+        "walkshed_quantile": integers(fill(q["walkshed_quantile"][cb], tiles)),
+        "transit_access_rank": integers(fill(q["transit_access_rank"][cb], tiles)),
+        "eta_score": integers(q["eta_score"][cb]),
+    })
+
+    return {
+        "vul_pop_rank": vul_pop_rank,
+        "es_rank": es_rank,
+        "access_gap_rank": access_gap_rank,
+        "transit_rank": transit_rank,
+        "output": output,
+    }
+
+
+def scenario_table(indicators, scores, scenarios):
+    """
+    One long table of ranks and eta_score, a row per scenario and block group.
+    """
+    cb = indicators.present["census_blockgroups"]
+    frames = []
+    for s, scenario in enumerate(scenarios):
+        transit = scores["transit_access_rank"][s][cb]
+        frames.append(pd.DataFrame({
+            "scenario": scenario.get("name", f"scenario_{s}"),
+            "geoid": indicators.geoids[cb],
+            "tiles": int(scores["tiles"][s][0]) if cb.any() else scenario.get("tiles", 10),
+            "vul_pop_rank": integers(scores["vul_pop_rank"][s][cb]),
+            "es_rank": integers(scores["es_rank"][s][cb]),
+            "access_gap_rank": integers(scores["access_gap_rank"][s][cb]),
+            "transit_access_rank": integers(np.where(np.isnan(transit), scores["tiles"][s][cb], transit)),
+            "eta_score": integers(scores["eta_score"][s][cb]),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def run_scoring(dbname, scenarios=(), output="output", sources=None, base=None):
+    """
+    Numpy stand-in for scoring.sql. The base weighting ({"tiles", "weights"}
+    overrides in base) writes the usual tables to the output schema, any
+    what-if weightings go to {output}.scenario_scores, all scored in one call.
+    sources points indicators at another schema, see scenario_sources.
+    """
+    print("\t -> Scoring...")
+    scenarios = [{**(base or {}), "name": "base"}] + list(scenarios)
+    indicators = load_indicators(dbname, sources)
+    scores = score(indicators, scenarios)
+
+    conn = bulk.connect(dbname)
+    for table, frame in base_tables(indicators, scores).items():
+        bulk.copy_frame(dbname, frame, table, output, indexes=["geoid"], conn=conn)
+    with conn.cursor() as cur:
+        cur.execute(f"ALTER TABLE {output}.output ADD COLUMN geometry geometry;")
+        cur.execute(f"""
+            UPDATE {output}.output o SET geometry = cb.geometry
+            FROM input.census_blockgroups cb WHERE cb.geoid = o.geoid;
+        """)
+    conn.commit()
+
+    if len(scenarios) > 1:
+        bulk.copy_frame(dbname, scenario_table(indicators, scores, scenarios), "scenario_scores", output,
+                        indexes=[("scenario", "geoid")], conn=conn)
+    conn.close()
+    print(f"\t \t -> {len(scenarios)} scenarios scored")
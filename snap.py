@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from scipy.sparse import csgraph
+import bulk
+import db
+import graph
+from graph import copy_query
+
+# stops further than this from any sidewalk vertex are reported instead of routed, meters
+SNAP_DISTANCE = 300
+
+WALK_SPEED = 1.4  # m/s, as in walkshed.py
+ES_WALK_LIMIT = 60  # minutes, anything further is left NULL
+
+es_types = {"es": None, "ss": "senior service", "food": "food store", "hc": "health care", "school": "school"}
+
+
+def load_vertices(dbname, vertex_table="network.sw_network_vertices_pgr"):
+    return copy_query(
+        dbname,
+        f"SELECT id, ST_X(the_geom) AS x, ST_Y(the_geom) AS y FROM {vertex_table} ORDER BY id",
+        dtype={"id": np.int64, "x": np.float64, "y": np.float64},
+    )
+
+
+def snap(tree, vertex_ids, x, y, max_distance=SNAP_DISTANCE):
+    """
+    Nearest vertex for every point in one batched KD-tree query. Points with
+    nothing within max_distance (inclusive, like ST_DWithin) get no vertex
+    but still report how far the nearest one is.
+    """
+    distance, nearest = tree.query(np.column_stack([x, y]), k=1, workers=-1)
+    snapped = distance <= max_distance
+    return np.where(snapped, vertex_ids[nearest], -1), distance, snapped
+
+
+def feed_filter(gtfs, column="gtfs"):
+    """
+    WHERE clause keeping the given feeds (all_stops labels), which are bound
+    as the %(gtfs)s parameter, see feed_params.
+    """
+    return f"WHERE {column} = ANY(%(gtfs)s)" if gtfs else ""
+
+
+def feed_params(gtfs):
+    return {"gtfs": [str(label) for label in gtfs]} if gtfs else None
+
+
+def snap_points(dbname, max_distance=SNAP_DISTANCE, gtfs=None):
+    """
+    Snaps every stop in output.all_stops and every point in
+    output.es_point_locations to the sidewalk network with one KD-tree over
+    the vertices. Writes network.transit_poi (as sql/transit_poi.sql did, plus
+    snap_distance), network.es_poi, and network.snap_failures for the points
+    left off the network. With gtfs (all_stops labels) only those feeds' stops
+    are resnapped and swapped in, new rows numbered after the existing ids;
+    the essential services are left alone.
+    """
+    print("\t -> Snapping stops and essential services to the sidewalk network...")
+    vertices = load_vertices(dbname)
+    vertex_ids = vertices["id"].to_numpy()
+    tree = cKDTree(vertices[["x", "y"]].to_numpy())
+
+    stops = copy_query(dbname, f"""
+        SELECT stop_id, gtfs, mode, ST_X(geom) AS x, ST_Y(geom) AS y, encode(ST_AsEWKB(geom), 'hex') AS geom
+        FROM output.all_stops
+        {feed_filter(gtfs)}
+        ORDER BY stop_id, gtfs
+    """, dtype={"stop_id": str}, params=feed_params(gtfs))
+    stop_node, stop_distance, stop_snapped = snap(tree, vertex_ids, stops["x"], stops["y"], max_distance)
+    first_id = 1
+    if gtfs:
+        first_id += int(copy_query(dbname, "SELECT COALESCE(MAX(id), 0) AS id FROM network.transit_poi")["id"].iloc[0])
+
+    # nearest_point stays the stop itself, which is what ST_ClosestPoint(stop, vertex) returned
+    poi = stops[stop_snapped].reset_index(drop=True)
+    transit_poi = pd.DataFrame({
+        "id": np.arange(first_id, first_id + len(poi)),
+        "stop_id": poi["stop_id"],
+        "nearest_point": poi["geom"],
+        "source_node": stop_node[stop_snapped],
+        "gtfs": poi["gtfs"],
+        "mode": poi["mode"],
+        "snap_distance": stop_distance[stop_snapped],
+    })
+    stop_failures = pd.DataFrame({"kind": "stop", "point_id": stops["stop_id"][~stop_snapped], "gtfs": stops["gtfs"][~stop_snapped],
+                                  "nearest_distance": stop_distance[~stop_snapped]})
+
+    if gtfs:
+        conn = bulk.connect(dbname)
+        with conn.cursor() as cur:
+            cur.execute(f"DELETE FROM network.transit_poi {feed_filter(gtfs)};", feed_params(gtfs))
+            cur.execute(f"DELETE FROM network.snap_failures {feed_filter(gtfs)} AND kind = 'stop';", feed_params(gtfs))
+        bulk.copy_rows(conn, transit_poi, "network", "transit_poi", commit=False)
+        bulk.copy_rows(conn, stop_failures, "network", "snap_failures", commit=False)
+        conn.commit()
+        conn.close()
+        print(f"\t \t -> {len(transit_poi)} of {len(stops)} stops resnapped for {', '.join(gtfs)}")
+        return
+
+    es = copy_query(dbname, """
+        SELECT es_id, type, ST_X(geometry) AS x, ST_Y(geometry) AS y
+        FROM output.es_point_locations
+        ORDER BY es_id
+    """)
+    es_node, es_distance, es_snapped = snap(tree, vertex_ids, es["x"], es["y"], max_distance)
+    es_poi = pd.DataFrame({
+        "es_id": es["es_id"][es_snapped].to_numpy(),
+        "type": es["type"][es_snapped].to_numpy(),
+        "source_node": es_node[es_snapped],
+        "snap_distance": es_distance[es_snapped],
+    })
+    failures = pd.concat([
+        stop_failures,
+        pd.DataFrame({"kind": "es", "point_id": es["es_id"][~es_snapped].astype(str), "gtfs": None,
+                      "nearest_distance": es_distance[~es_snapped]}),
+    ], ignore_index=True)
+
+    db.drop_relations(dbname, ["network.transit_poi", "network.es_poi", "network.snap_failures"])
+    conn = bulk.connect(dbname)
+    bulk.copy_frame(dbname, transit_poi, "transit_poi", "network",
+                    dtypes={"nearest_point": "geometry(Point, 26918)", "source_node": "BIGINT"}, indexes=["id"], conn=conn)
+    bulk.copy_frame(dbname, es_poi, "es_poi", "network", dtypes={"source_node": "BIGINT"}, indexes=["es_id"], conn=conn)
+    bulk.copy_frame(dbname, failures, "snap_failures", "network", dtypes={"point_id": "TEXT", "gtfs": "TEXT"}, conn=conn)
+    with conn.cursor() as cur:
+        cur.execute("CREATE INDEX transit_poi_geom_idx ON network.transit_poi USING GIST (nearest_point);")
+    conn.commit()
+    conn.close()
+
+    print(f"\t \t -> {len(transit_poi)} of {len(stops)} stops snapped, median {np.median(stop_distance[stop_snapped]) if len(poi) else 0:.1f}m")
+    print(f"\t \t -> {len(es_poi)} of {len(es)} essential services snapped")
+    if len(failures):
+        print(f"\t \t -> {len(failures)} points further than {max_distance}m from the network, see network.snap_failures")
+
+
+def es_walk_time(dbname, limit=ES_WALK_LIMIT):
+    """
+    Walk minutes from every sidewalk vertex to the nearest essential service,
+    overall and by type, one multi-source dijkstra per type. Summarized per
+    block group (median over its vertices) into output.es_walk_time.
+    """
+    print("\t -> Computing walk time to essential services...")
+    sw_graph = graph.load_graph(dbname)
+    es_poi = copy_query(dbname, "SELECT type, source_node FROM network.es_poi", dtype={"source_node": np.int64})
+    meters = limit * 60 * WALK_SPEED
+
+    walk = {"id": sw_graph.node_ids}
+    for prefix, es_type in es_types.items():
+        nodes = es_poi["source_node"] if es_type is None else es_poi.loc[es_poi["type"] == es_type, "source_node"]
+        sources = np.unique(sw_graph.index_of(nodes.to_numpy()))
+        sources = sources[sources >= 0]
+        minutes = np.full(sw_graph.n_nodes, np.nan)
+        if len(sources):
+            distance = csgraph.dijkstra(sw_graph.csr, directed=True, indices=sources, limit=meters, min_only=True)
+            minutes = np.where(np.isfinite(distance), distance / WALK_SPEED / 60, np.nan)
+        walk[f"{prefix}_walk_min"] = minutes
+
+    db.drop_relations(dbname, ["network.es_walk", "output.es_walk_time"])
+    conn = bulk.connect(dbname)
+    bulk.copy_frame(dbname, pd.DataFrame(walk), "es_walk", "network", dtypes={"id": "BIGINT"}, indexes=["id"], conn=conn)
+    medians = ",\n".join(
+        f"percentile_cont(0.5) WITHIN GROUP (ORDER BY w.{prefix}_walk_min) AS {prefix}_walk_min" for prefix in es_types
+    )
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE output.es_walk_time AS
+            SELECT
+                cb.geoid,
+                {medians}
+            FROM
+                input.census_blockgroups cb
+                JOIN network.sw_network_vertices_pgr v ON ST_Intersects (cb.geometry, v.the_geom)
+                JOIN network.es_walk w ON w.id = v.id
+            GROUP BY
+                cb.geoid;
+        """)
+        cur.execute("CREATE INDEX es_walk_time_geoid_idx ON output.es_walk_time (geoid);")
+    conn.commit()
+    conn.close()
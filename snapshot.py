@@ -0,0 +1,376 @@
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from pyproj import CRS
+import bulk
+import db
+
+SNAPSHOT_CHUNK_ROWS = 100_000
+SNAPSHOT_PART_ROWS = 2_000_000
+
+# schemas that belong to postgres and its extensions, never snapshotted by default
+system_schemas = {"public", "information_schema", "topology", "tiger", "tiger_data"}
+
+# pipeline bookkeeping that travels with the data, so a restored db only reruns what changed
+manifest_tables = ["public.stage_manifest", "public.materialized_views"]
+
+# postgres types arrow holds natively; everything else goes through its text form
+arrow_types = {
+    "smallint": pa.int16(), "integer": pa.int32(), "bigint": pa.int64(),
+    "real": pa.float32(), "double precision": pa.float64(), "numeric": pa.float64(),
+    "boolean": pa.bool_(), "text": pa.string(), "date": pa.date32(),
+    "timestamp without time zone": pa.timestamp("us"),
+    "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+}
+
+extensions = {"parquet": "parquet", "arrow": "arrow"}
+
+
+def arrow_type(pg_type):
+    """
+    Arrow type a postgres column is snapshotted as. Geometry is WKB, numeric(p, s) an exact decimal.
+    """
+    base = pg_type.split("(")[0].strip()
+    if base in ("geometry", "geography"):
+        return pa.binary()
+    if base == "numeric" and "(" in pg_type:
+        precision, scale = (int(part) for part in pg_type[len("numeric("):-1].split(","))
+        return pa.decimal128(precision, scale)
+    if base in ("character varying", "character"):
+        return pa.string()
+    return arrow_types.get(base, pa.string())
+
+
+def select_list(columns):
+    """
+    Select expressions matching arrow_type: WKB geometry, unconstrained numeric as
+    double, text for anything arrow can't hold.
+    """
+    expressions = []
+    for name, pg_type in columns:
+        base = pg_type.split("(")[0].strip()
+        if base in ("geometry", "geography"):
+            expressions.append(f"ST_AsBinary({bulk.quote(name)}) AS {bulk.quote(name)}")
+        elif pg_type == "numeric":
+            expressions.append(f"{bulk.quote(name)}::double precision AS {bulk.quote(name)}")
+        elif arrow_type(pg_type) == pa.string() and base not in ("text", "character varying", "character"):
+            expressions.append(f"{bulk.quote(name)}::text AS {bulk.quote(name)}")
+        else:
+            expressions.append(bulk.quote(name))
+    return ", ".join(expressions)
+
+
+def describe(conn, schemas, include_manifest=True):
+    """
+    Tables (and materialized views, whose rows are snapshotted like a table's
+    along with their definition) with their columns, geometry SRIDs and index
+    definitions, plus view definitions. order is each relation's creation order.
+    """
+    with conn.cursor() as cur:
+        if not schemas:
+            cur.execute("SELECT nspname FROM pg_namespace WHERE nspname NOT LIKE 'pg\\_%' ORDER BY nspname")
+            schemas = [row[0] for row in cur.fetchall() if row[0] not in system_schemas]
+
+        cur.execute("""
+            SELECT c.oid, n.nspname, c.relname, c.relkind
+            FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind IN ('r', 'm', 'v') AND (n.nspname = ANY(%s) OR (n.nspname || '.' || c.relname) = ANY(%s))
+            ORDER BY c.oid
+        """, (list(schemas), manifest_tables if include_manifest else []))
+        relations = cur.fetchall()
+
+        tables, views = [], []
+        for order, (oid, schema, name, kind) in enumerate(relations):
+            definition = None
+            if kind in ("v", "m"):
+                cur.execute("SELECT pg_get_viewdef(%s)", (oid,))
+                definition = cur.fetchone()[0]
+            if kind == "v":
+                views.append({"schema": schema, "name": name, "definition": definition, "order": order})
+                continue
+            cur.execute("""
+                SELECT attname, format_type(atttypid, atttypmod)
+                FROM pg_attribute WHERE attrelid = %s AND attnum > 0 AND NOT attisdropped ORDER BY attnum
+            """, (oid,))
+            columns = cur.fetchall()
+            cur.execute("SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid = %s ORDER BY indexrelid", (oid,))
+            indexes = [row[0] for row in cur.fetchall()]
+            srids = {}
+            for column, pg_type in columns:
+                if pg_type.startswith(("geometry", "geography")):
+                    cur.execute(f"SELECT ST_SRID({bulk.quote(column)}) FROM {schema}.{bulk.quote(name)} WHERE {bulk.quote(column)} IS NOT NULL LIMIT 1")
+                    row = cur.fetchone()
+                    srids[column] = row[0] if row else 0
+            tables.append({
+                "schema": schema, "table": name, "kind": "matview" if kind == "m" else "table",
+                "columns": columns, "srids": srids, "indexes": indexes, "order": order,
+                **({"definition": definition} if kind == "m" else {}),
+            })
+    return list(schemas), tables, views
+
+
+def geo_metadata(srids):
+    """
+    GeoParquet 1.0 "geo" metadata for the WKB columns.
+    """
+    if not srids:
+        return {}
+    columns = {
+        column: {"encoding": "WKB", "geometry_types": [], "crs": CRS.from_epsg(srid).to_json_dict() if srid else None}
+        for column, srid in srids.items()
+    }
+    return {"geo": json.dumps({"version": "1.0.0", "primary_column": next(iter(columns)), "columns": columns})}
+
+
+class PartWriter:
+    """
+    Writes a table's batches into part-00000, part-00001, ... files of at most
+    part_rows rows each, as Parquet row groups or Arrow IPC record batches.
+    """
+
+    def __init__(self, directory, schema, fmt, part_rows=SNAPSHOT_PART_ROWS):
+        self.directory, self.schema, self.fmt, self.part_rows = directory, schema, fmt, part_rows
+        self.writer, self.rows_in_part, self.parts, self.rows = None, 0, [], 0
+
+    def _open(self):
+        name = f"part-{len(self.parts):05d}.{extensions[self.fmt]}"
+        path = os.path.join(self.directory, name)
+        if self.fmt == "parquet":
+            self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self.writer = ipc.new_file(path, self.schema)
+        self.parts.append(name)
+        self.rows_in_part = 0
+
+    def write(self, batch):
+        if self.writer is None or self.rows_in_part >= self.part_rows:
+            self.close()
+            self._open()
+        self.writer.write_batch(batch)
+        self.rows_in_part += batch.num_rows
+        self.rows += batch.num_rows
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def dump_table(dbname, root, table, fmt, chunk_rows=SNAPSHOT_CHUNK_ROWS):
+    """
+    Streams one table out through a server-side cursor into {root}/{schema}/{table}/part-*.
+    """
+    schema, name = table["schema"], table["table"]
+    directory = os.path.join(root, schema, name)
+    os.makedirs(directory, exist_ok=True)
+    for stale in os.listdir(directory):
+        os.remove(os.path.join(directory, stale))
+
+    fields = pa.schema([(column, arrow_type(pg_type)) for column, pg_type in table["columns"]])
+    fields = fields.with_metadata({**geo_metadata(table["srids"]), "postgres": json.dumps(table["columns"])})
+    writer = PartWriter(directory, fields, fmt)
+
+    conn = bulk.connect(dbname)
+    try:
+        with conn.cursor(name=f"snapshot_{schema}_{name}") as cur:
+            cur.itersize = chunk_rows
+            cur.execute(f"SELECT {select_list(table['columns'])} FROM {schema}.{bulk.quote(name)}")
+            while True:
+                rows = cur.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                arrays = [
+                    pa.array([bytes(row[i]) if isinstance(row[i], memoryview) else row[i] for row in rows], type=field.type)
+                    for i, field in enumerate(fields)
+                ]
+                writer.write(pa.RecordBatch.from_arrays(arrays, schema=fields))
+        if not writer.parts:
+            writer._open()  # empty tables still get a part so they restore
+    finally:
+        writer.close()
+        conn.close()
+
+    print(f"\t \t -> {schema}.{name}: {writer.rows} rows in {len(writer.parts)} part(s)")
+    return {**table, "rows": writer.rows, "parts": writer.parts}
+
+
+def snapshot(dbname, root, schemas=None, fmt="parquet", max_workers=4):
+    """
+    Dumps schemas (every non-system schema by default, plus the manifest tables)
+    into {root}, one directory of parts per table and snapshot.json describing
+    types, indexes and views. The parts can be read without postgres, see open_table.
+    """
+    print(f"\t -> Snapshotting {dbname} to {root}...")
+    conn = bulk.connect(dbname)
+    schemas, tables, views = describe(conn, schemas)
+    conn.close()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(lambda table: dump_table(dbname, root, table, fmt), tables))
+
+    with open(os.path.join(root, "snapshot.json"), "w") as f:
+        json.dump({
+            "database": dbname, "created": datetime.now().isoformat(timespec="seconds"), "format": fmt,
+            "schemas": schemas, "tables": tables, "views": views,
+        }, f, indent=2)
+
+
+def read_manifest(root):
+    with open(os.path.join(root, "snapshot.json")) as f:
+        return json.load(f)
+
+
+def open_table(root, schema, table):
+    """
+    A snapshotted table as a pyarrow dataset over its parts. Arrow parts are
+    memory mapped, so scanning them copies nothing; geometry columns are WKB
+    (shapely.from_wkb or geopandas.GeoSeries.from_wkb).
+    """
+    fmt = read_manifest(root)["format"]
+    return ds.dataset(os.path.join(root, schema, table), format="ipc" if fmt == "arrow" else "parquet")
+
+
+def read_batches(root, table):
+    directory = os.path.join(root, table["schema"], table["table"])
+    for part in table["parts"]:
+        path = os.path.join(directory, part)
+        if part.endswith(".parquet"):
+            yield from pq.ParquetFile(path).iter_batches(batch_size=SNAPSHOT_CHUNK_ROWS)
+        else:
+            with pa.memory_map(path) as source:
+                yield from ipc.open_file(source).to_batches()
+
+
+def restore_table(dbname, root, table):
+    """
+    Recreates a table with its original column types, COPYs the parts back in
+    and replays its index definitions (the GiST indexes among them).
+    """
+    schema, name = table["schema"], table["table"]
+    columns = dict((column, pg_type) for column, pg_type in table["columns"])
+    conn = bulk.connect(dbname)
+    bulk.create_table(conn, schema, name, columns)
+
+    rows = 0
+    for batch in read_batches(root, table):
+        frame = batch.to_pandas(integer_object_nulls=True)
+        for column, srid in table["srids"].items():
+            frame[column] = gpd.GeoSeries.from_wkb(frame[column], crs=srid or None)
+        frame = gpd.GeoDataFrame(frame) if table["srids"] else frame
+        rows += bulk.copy_rows(conn, frame, schema, name, srid=None, commit=False)
+    conn.commit()
+
+    with conn.cursor() as cur:
+        for index in table["indexes"]:
+            cur.execute(index)
+        cur.execute(f"ANALYZE {schema}.{bulk.quote(name)}")
+    conn.commit()
+    conn.close()
+    print(f"\t \t -> {schema}.{name}: {rows} rows")
+
+
+def restore_view(cur, view):
+    """
+    Recreates a view, or a materialized view (recomputed from its restored
+    sources) with its indexes, inside a savepoint. Returns the error, if any.
+    """
+    relation = f"{view['schema']}.{bulk.quote(view.get('name') or view['table'])}"
+    cur.execute("SAVEPOINT view")
+    try:
+        if "table" in view:
+            cur.execute(f"CREATE MATERIALIZED VIEW {relation} AS {view['definition']}")
+            for index in view["indexes"]:
+                cur.execute(index)
+            cur.execute(f"ANALYZE {relation}")
+        else:
+            cur.execute(f"CREATE VIEW {relation} AS {view['definition']}")
+    except Exception as error:
+        cur.execute("ROLLBACK TO SAVEPOINT view")
+        return error
+    cur.execute("RELEASE SAVEPOINT view")
+    return None
+
+
+def restore(dbname, root, max_workers=4, rebuild=False):
+    """
+    Loads a snapshot into dbname: schemas, tables (in parallel), then views and
+    materialized views in their original order. A materialized view whose
+    sources aren't in the snapshot comes back as a table holding its rows, and
+    then the stage manifest is cleared so the next run rebuilds rather than
+    trying to refresh it. Returns the views that couldn't be restored.
+    """
+    manifest = read_manifest(root)
+    print(f"\t -> Restoring {root} ({manifest['created']}) into {dbname}...")
+    db.ensure_database(dbname, rebuild=rebuild)
+    db.create_schemas(dbname, manifest["schemas"])
+    db.create_extensions(dbname)
+
+    relations = [f"{t['schema']}.{t['table']}" for t in manifest["tables"]] + \
+                [f"{v['schema']}.{v['name']}" for v in manifest["views"]]
+    db.drop_relations(dbname, reversed(relations))
+
+    # snapshots from before matview definitions were kept restore those as tables
+    tables = [t for t in manifest["tables"] if "definition" not in t]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda table: restore_table(dbname, root, table), tables))
+
+    matviews = [t for t in manifest["tables"] if "definition" in t]
+    failed = []
+    as_tables = [f"{t['schema']}.{t['table']}" for t in tables if t.get("kind") == "matview"]
+    conn = bulk.connect(dbname)
+    with conn.cursor() as cur:
+        for view in sorted(manifest["views"] + matviews, key=lambda v: v.get("order", 0)):
+            relation = f"{view['schema']}.{view.get('name') or view['table']}"
+            error = restore_view(cur, view)
+            if error is None:
+                continue
+            if "table" in view:
+                print(f"\t \t -> {relation}: materialized view not recreated ({error}), restoring its rows as a table")
+                conn.commit()
+                restore_table(dbname, root, view)
+                as_tables.append(relation)
+            else:
+                print(f"\t \t -> {relation}: view not restored ({error})")
+                failed.append(relation)
+        if as_tables:
+            cur.execute("SELECT to_regclass('public.stage_manifest') IS NOT NULL")
+            if cur.fetchone()[0]:
+                cur.execute("DELETE FROM public.stage_manifest")
+                print("\t \t -> stage manifest cleared, the next run rebuilds every stage")
+    conn.commit()
+    conn.close()
+
+    if failed:
+        print(f"\t -> {len(failed)} views not restored: {', '.join(failed)}")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshots pipeline schemas to GeoParquet/Arrow files and restores them.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    dump_parser = commands.add_parser("dump", help="write a snapshot of the database")
+    dump_parser.add_argument("root", help="directory the snapshot is written to")
+    dump_parser.add_argument("--dbname", default="eta")
+    dump_parser.add_argument("--schemas", nargs="+", help="schemas to include (default: all non-system schemas)")
+    dump_parser.add_argument("--format", choices=list(extensions), default="parquet")
+    dump_parser.add_argument("--workers", type=int, default=4)
+    restore_parser = commands.add_parser("restore", help="load a snapshot into a database")
+    restore_parser.add_argument("root", help="directory holding snapshot.json")
+    restore_parser.add_argument("--dbname", default="eta")
+    restore_parser.add_argument("--rebuild", action="store_true", help="drop the database first")
+    restore_parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        os.makedirs(args.root, exist_ok=True)
+        snapshot(args.dbname, args.root, args.schemas, args.format, args.workers)
+    else:
+        if restore(args.dbname, args.root, args.workers, args.rebuild):
+            raise SystemExit(1)
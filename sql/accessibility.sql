@@ -0,0 +1,134 @@
+-- AM transit travel zones within 45 minutes count
+CREATE MATERIALIZED VIEW
+    output.transit_45min AS
+WITH
+    zone_count AS (
+        SELECT DISTINCT
+            (o_taz),
+            COUNT(*) AS t_45min_zone_cnt
+        FROM
+            INPUT.matrix_45min
+        GROUP BY
+            o_taz
+    ),
+    weighted_avg AS (
+        SELECT DISTINCT
+            geoid,
+            ROUND(SUM(t_45min_zone_cnt * intersection_percent)) AS t_45min_zone_cnt
+        FROM
+            zone_count zc
+            JOIN output.bg_to_taz bg ON zc.o_taz = bg.taz
+        GROUP BY
+            geoid
+    )
+SELECT
+    *,
+    NTILE(10) OVER (ORDER BY t_45min_zone_cnt DESC) AS t_zone_quantile
+FROM
+    weighted_avg;
+COMMIT;
+
+CREATE UNIQUE INDEX transit_45min_geoid_idx ON output.transit_45min (geoid);
+COMMIT;
+
+-- essential Service count in AM transit travel zones within 45 minutes
+CREATE MATERIALIZED VIEW
+    output.transit_45_es AS   
+WITH
+    taz_45_es AS (
+        SELECT
+            m.o_taz,
+            COUNT(esa.es_id) AS es_cnt
+        FROM
+            INPUT.matrix_45min m
+            JOIN output.es_assignment esa ON m.d_taz = esa.taz
+        GROUP BY
+            m.o_taz
+    ),
+    weighted_avg AS (
+        SELECT DISTINCT
+            geoid,
+            ROUND(SUM(es_cnt * intersection_percent)) AS es_cnt
+        FROM
+            taz_45_es t
+            JOIN output.bg_to_taz bg ON t.o_taz = bg.taz
+        GROUP BY
+            geoid
+    )
+SELECT
+    *,
+    NTILE(10) OVER (ORDER BY es_cnt DESC) AS t_es_quantile
+FROM
+    weighted_avg;
+COMMIT;
+
+CREATE UNIQUE INDEX transit_45_es_geoid_idx ON output.transit_45_es (geoid);
+COMMIT;
+
+-- lodes job count in AM transit travel zones within 45 minutes
+CREATE MATERIALIZED VIEW
+    output.transit_45_jobs as   
+WITH
+    taz_45 AS (
+        SELECT
+            o_taz,
+            d_taz
+        FROM
+            INPUT.matrix_45min m
+            JOIN INPUT.taz t ON m.d_taz = t.taz
+    ),
+    weighted_avg AS (
+        SELECT DISTINCT
+            o_taz,
+            d_taz,
+            geoid,
+            intersection_percent
+        FROM
+            taz_45 t
+            JOIN output.bg_to_taz bg ON t.d_taz = bg.taz
+    ),
+    jobs_added AS (
+        SELECT
+            wa.o_taz,
+            ROUND(SUM(lj.sum_jobs * intersection_percent)) AS jobs
+        FROM
+            weighted_avg wa
+            JOIN output.lodes_jobs lj ON wa.geoid = lj.geoid
+        GROUP BY
+            wa.o_taz
+    ),
+    bg_45_jobs AS (
+        SELECT
+            bg.geoid,
+            SUM(ja.jobs * intersection_percent) AS jobs
+        FROM
+            jobs_added ja
+            JOIN output.bg_to_taz bg ON ja.o_taz = bg.taz
+        GROUP BY
+            bg.geoid
+    )
+SELECT
+    j.*,
+    NTILE(10) OVER (ORDER BY jobs DESC) AS t_jobs_quantile,
+    cb.geometry
+FROM
+    bg_45_jobs j
+JOIN INPUT.census_blockgroups cb ON cb.geoid = j.geoid;
+COMMIT;
+
+CREATE UNIQUE INDEX transit_45_jobs_geoid_idx ON output.transit_45_jobs (geoid);
+COMMIT;
+
+-- avg essential services and jobs within transit 45min
+CREATE MATERIALIZED VIEW
+    output.transit_45_es_job AS
+SELECT
+    tj.geoid,
+    (tj.t_jobs_quantile + te.t_es_quantile) / 2 AS t_45_es_job_avg
+FROM
+    output.transit_45_jobs tj
+    JOIN output.transit_45_es te ON tj.geoid = te.geoid;
+COMMIT;
+
+CREATE UNIQUE INDEX transit_45_es_job_geoid_idx ON output.transit_45_es_job (geoid);
+COMMIT;
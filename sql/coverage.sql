@@ -0,0 +1,31 @@
+-- walkshed intersection (this takes some time, coverage.py has a rasterized alternative)
+CREATE MATERIALIZED VIEW
+    output.transit_ws AS
+WITH
+    walksheds AS (
+        SELECT
+            ST_Union(ws.geom) AS geom
+        FROM
+            network.transit_poi_isochrones ws
+    ),
+    intersected_areas AS (
+        SELECT
+            cb.geoid,
+            cb.geometry,
+            ST_Area(ST_Intersection(ws.geom, cb.geometry)) / ST_AREA(cb.geometry) AS intersection_percent
+        FROM
+            walksheds ws
+        JOIN input.census_blockgroups cb ON ST_Intersects(cb.geometry, ws.geom)
+    )
+SELECT
+    intersected_areas.geoid,
+    intersected_areas.geometry,
+    intersected_areas.intersection_percent,
+    NTILE(10) OVER (ORDER BY intersected_areas.intersection_percent DESC) AS walkshed_quantile
+FROM
+    intersected_areas;
+COMMIT;
+
+-- unique so a feed update can refresh the view concurrently
+CREATE UNIQUE INDEX transit_ws_geoid_idx ON output.transit_ws (geoid);
+COMMIT;
@@ -0,0 +1,209 @@
+-- finding {{weekday}} service ids ({{service_date}}, service_dates in run.py) from gtfs
+CREATE MATERIALIZED VIEW
+    output.all_service AS
+SELECT
+    service_id,
+    'septa_bus' AS gtfs
+FROM
+    septa_bus.calendar
+WHERE
+    {{weekday}} = 1
+    AND {{service_date}} BETWEEN start_date AND end_date
+UNION
+SELECT
+    service_id,
+    'septa_rail' AS gtfs
+FROM
+    septa_rail.calendar
+WHERE
+    {{weekday}} = 1
+    AND {{service_date}} BETWEEN start_date AND end_date
+UNION
+SELECT
+    service_id,
+    'septa_bus' AS gtfs
+FROM
+    septa_bus.calendar_dates
+WHERE
+    date = {{service_date}}
+    AND exception_type = 1
+UNION
+SELECT
+    service_id,
+    'njt_bus' AS gtfs
+FROM
+    njtransit_bus.calendar_dates
+WHERE
+    date = {{service_date}}
+    AND exception_type = 1
+UNION
+SELECT
+    service_id,
+    'njt_rail' AS gtfs
+FROM
+    njtransit_rail.calendar_dates
+WHERE
+    date = {{service_date}}
+    AND exception_type = 1
+UNION
+SELECT
+    service_id,
+    'patco' AS gtfs
+FROM
+    patco.calendar
+WHERE
+    {{weekday}} = 1
+    AND {{service_date}} BETWEEN start_date AND end_date;
+COMMIT;
+
+-- finding all trip_ids for the {{service_date}} service from gtfs
+CREATE MATERIALIZED VIEW
+    output.all_trips AS
+SELECT
+    t.trip_id,
+    t.route_id,
+    t.service_id,
+    s.gtfs
+FROM
+    septa_bus.trips t
+    JOIN output.all_service s ON t.service_id = s.service_id
+WHERE
+    s.gtfs = 'septa_bus'
+UNION
+SELECT
+    t.trip_id,
+    t.route_id,
+    t.service_id,
+    s.gtfs
+FROM
+    septa_rail.trips t
+    JOIN output.all_service s ON t.service_id = s.service_id
+WHERE
+    s.gtfs = 'septa_rail'
+UNION
+SELECT
+    t.trip_id,
+    t.route_id,
+    t.service_id,
+    s.gtfs
+FROM
+    njtransit_bus.trips t
+    JOIN output.all_service s ON t.service_id = s.service_id
+WHERE
+    s.gtfs = 'njt_bus'
+UNION
+SELECT
+    t.trip_id,
+    t.route_id,
+    t.service_id,
+    s.gtfs
+FROM
+    njtransit_rail.trips t
+    JOIN output.all_service s ON t.service_id = s.service_id
+WHERE
+    s.gtfs = 'njt_rail'
+UNION
+SELECT
+    t.trip_id,
+    t.route_id,
+    t.service_id,
+    s.gtfs
+FROM
+    patco.trips t
+    JOIN output.all_service s ON t.service_id = s.service_id
+WHERE
+    s.gtfs = 'patco';
+COMMIT;
+
+
+CREATE INDEX idx_all_trips_trip_id ON output.all_trips (trip_id);
+CREATE INDEX idx_all_trips_gtfs ON output.all_trips (gtfs);
+
+-- finding all stop times for service_id in the day time range from gtfs
+CREATE MATERIALIZED VIEW
+    output.all_stop_times AS
+WITH a AS (
+SELECT
+    st.stop_id,
+    t.gtfs,
+    t.route_id,
+    st.departure_time
+FROM
+    septa_bus.stop_times st
+    JOIN output.all_trips t ON st.trip_id = t.trip_id
+WHERE
+	t.gtfs = 'septa_bus'
+UNION
+SELECT
+    st.stop_id,
+    t.gtfs,
+    t.route_id,
+    st.departure_time
+FROM
+    septa_rail.stop_times st
+    JOIN output.all_trips t ON st.trip_id = t.trip_id
+WHERE
+    t.gtfs = 'septa_rail'
+UNION
+SELECT
+    st.stop_id,
+    t.gtfs,
+    t.route_id,
+    st.departure_time
+FROM
+    njtransit_bus.stop_times st
+    JOIN output.all_trips t ON st.trip_id = t.trip_id
+WHERE
+    t.gtfs = 'njt_bus'
+UNION
+SELECT
+    st.stop_id,
+    t.gtfs,
+    t.route_id,
+    st.departure_time
+FROM
+    njtransit_rail.stop_times st
+    JOIN output.all_trips t ON st.trip_id = t.trip_id
+WHERE
+    t.gtfs = 'njt_rail'
+UNION
+SELECT
+    st.stop_id,
+    t.gtfs,
+    t.route_id,
+    st.departure_time
+FROM
+    patco.stop_times st
+    JOIN output.all_trips t ON st.trip_id = t.trip_id
+WHERE
+    t.gtfs = 'patco')
+SELECT 
+    * 
+FROM 
+    a 
+WHERE 
+    departure_time IS NOT NULL;
+COMMIT;
+
+-- creating stops table with daily departure stats
+CREATE MATERIALIZED VIEW
+    output.stops_w_departs AS
+SELECT
+    s.stop_id,
+    s.gtfs,
+    s.geom,
+    COUNT(st.*) AS tot_departures
+FROM
+    output.all_stops s
+    JOIN output.all_stop_times st ON s.stop_id = st.stop_id
+    AND s.gtfs = st.gtfs
+GROUP BY
+    s.stop_id,
+    s.gtfs,
+    s.geom;
+COMMIT;
+
+CREATE INDEX stops_w_departs_idx
+  ON output.stops_w_departs
+  USING GIST (geom);
+COMMIT;
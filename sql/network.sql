@@ -0,0 +1,34 @@
+-- creating route-able sidewalk network
+CREATE TABLE
+    network.sw_network AS
+SELECT
+    NULL::INTEGER AS source,
+    NULL::INTEGER AS target,
+    st_length (geom.geom) AS COST,
+    geom.geom AS geometry
+FROM
+    (
+        SELECT 
+            (ST_Dump (geometry)).geom
+        FROM
+            input.pedestrian_network
+    ) AS geom;
+COMMIT;
+
+ALTER TABLE network.sw_network
+ADD COLUMN id serial PRIMARY KEY;
+COMMIT;
+
+CREATE INDEX sw_network_geom_idx ON network.sw_network USING GIST (geometry);
+COMMIT;
+
+-- per-node walkshed output, only filled when walksheds keep their paths
+CREATE TABLE 
+    network.transit_poi_paths (
+        id INTEGER,
+        stop_id VARCHAR(20),
+        gtfs VARCHAR(20),
+        node_id INTEGER,
+        travel_time FLOAT
+);
+COMMIT;
@@ -36,34 +36,6 @@ FROM
     JOIN output.es_rank esr ON vpr.geoid = esr.geoid;
 COMMIT;
 
--- walkshed intersection (this takes some time)
-CREATE MATERIALIZED VIEW
-    output.transit_ws AS
-WITH
-    walksheds AS (
-        SELECT
-            ST_Union(ws.geom) AS geom
-        FROM
-            network.transit_poi_isochrones ws
-    ),
-    intersected_areas AS (
-        SELECT
-            cb.geoid,
-            cb.geometry,
-            ST_Area(ST_Intersection(ws.geom, cb.geometry)) / ST_AREA(cb.geometry) AS intersection_percent
-        FROM
-            walksheds ws
-        JOIN input.census_blockgroups cb ON ST_Intersects(cb.geometry, ws.geom)
-    )
-SELECT
-    intersected_areas.geoid,
-    intersected_areas.geometry,
-    intersected_areas.intersection_percent,
-    NTILE(10) OVER (ORDER BY intersected_areas.intersection_percent DESC) AS walkshed_quantile
-FROM
-    intersected_areas;
-COMMIT;
-
 -- combine and calculate transit ranks
 CREATE TABLE output.transit_rank AS
 SELECT
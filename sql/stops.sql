@@ -0,0 +1,89 @@
+-- merging all transit stop locations from gtfs
+CREATE MATERIALIZED VIEW
+    output.all_stops AS
+SELECT
+    s.stop_id,
+    'septa_bus' AS gtfs,
+    CASE WHEN r.route_type = 3 THEN 'bus'
+        ELSE 'rail'
+        END AS mode,
+    ST_Transform(ST_SetSRID(ST_Point(stop_lon, stop_lat), 4326), 26918)::geometry (POINT, 26918) AS geom
+FROM
+    septa_bus.stops s
+JOIN septa_bus.stop_times st ON s.stop_id = st.stop_id
+    JOIN septa_bus.trips t ON st.trip_id = t.trip_id
+    JOIN septa_bus.routes r ON t.route_id = r.route_id
+GROUP BY
+    s.stop_id,
+    r.route_type,
+    s.stop_lon,
+    s.stop_lat
+UNION
+SELECT
+    s.stop_id,
+    'septa_rail' AS gtfs,
+    'rail' AS mode,
+    ST_Transform(ST_SetSRID(ST_Point(stop_lon, stop_lat), 4326), 26918)::geometry (POINT, 26918) AS geom
+FROM
+    septa_rail.stops s
+UNION
+SELECT
+    s.stop_id,
+    'njt_rail' AS gtfs,
+    'rail' AS mode,
+    ST_Transform(ST_SetSRID(ST_Point(stop_lon, stop_lat), 4326), 26918)::geometry (POINT, 26918) AS geom
+FROM
+    njtransit_rail.stops s
+UNION
+SELECT
+    s.stop_id,
+    'njt_bus' AS gtfs,
+    'bus' AS mode,
+    ST_Transform(ST_SetSRID(ST_Point(stop_lon, stop_lat), 4326), 26918)::geometry (POINT, 26918) AS geom
+FROM
+    njtransit_bus.stops s
+UNION
+SELECT
+    s.stop_id,
+    'patco' AS gtfs,
+    'rail' AS mode,
+    ST_Transform(ST_SetSRID(ST_Point(stop_lon, stop_lat), 4326), 26918)::geometry (POINT, 26918) AS geom
+FROM
+    patco.stops s;
+COMMIT;
+
+-- unique so the view can be refreshed concurrently when a feed is reloaded
+CREATE UNIQUE INDEX all_stops_key_idx ON output.all_stops (stop_id, gtfs, mode);
+CREATE INDEX all_stops_geom_idx ON output.all_stops USING GIST (geom);
+COMMIT;
+
+-- assign each transit stop a blockgroup and taz once, through the gist indexes
+-- (one row per stop, all_stops has a row per mode a stop serves)
+CREATE TABLE
+    output.stop_assignment AS
+SELECT
+    s.stop_id,
+    s.gtfs,
+    bg.geoid,
+    tz.taz
+FROM
+    (
+        SELECT DISTINCT ON (stop_id, gtfs) stop_id, gtfs, geom
+        FROM output.all_stops
+        ORDER BY stop_id, gtfs, mode
+    ) s
+    LEFT JOIN LATERAL (
+        SELECT cb.geoid FROM input.census_blockgroups cb
+        WHERE ST_Intersects (cb.geometry, s.geom)
+        ORDER BY cb.geoid LIMIT 1
+    ) bg ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT t.taz FROM input.taz t
+        WHERE ST_Intersects (t.geometry, s.geom)
+        ORDER BY t.taz LIMIT 1
+    ) tz ON TRUE;
+COMMIT;
+
+CREATE UNIQUE INDEX stop_assignment_stop_idx ON output.stop_assignment (stop_id, gtfs);
+CREATE INDEX stop_assignment_geoid_idx ON output.stop_assignment (geoid);
+COMMIT;
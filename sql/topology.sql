@@ -0,0 +1,15 @@
+-- creating and validating pedestrian network topology
+SELECT
+    pgr_createTopology (
+        'network.sw_network',
+        0.001,
+        'geometry',
+        'id',
+        clean := 'true'
+    );
+
+SELECT
+    pgr_analyzeGraph ('network.sw_network', 0.001, 'geometry', 'id');
+
+CREATE INDEX sw_network_verts_geom_idx ON network.sw_network_vertices_pgr USING GIST (the_geom);
+COMMIT;
@@ -0,0 +1,27 @@
+-- calculate daily departs per blockgroup
+CREATE MATERIALIZED VIEW
+    {{output}}.transit_departs AS
+WITH
+    bg_departs AS (
+        SELECT
+            cb.geoid,
+            COALESCE(SUM(s.tot_departures), 0) AS total_departures,
+            cb.geometry
+        FROM
+            input.census_blockgroups cb
+        LEFT JOIN output.stop_assignment sa ON sa.geoid = cb.geoid
+        LEFT JOIN {{output}}.stops_w_departs s ON s.stop_id = sa.stop_id AND s.gtfs = sa.gtfs
+        GROUP BY
+            cb.geoid, cb.geometry
+    )
+SELECT
+    bgd.geoid,
+    total_departures,
+    NTILE(10) OVER (ORDER BY total_departures DESC) AS depart_quantile
+FROM
+    bg_departs bgd;
+COMMIT;
+
+-- unique so a feed update can refresh it concurrently
+CREATE UNIQUE INDEX transit_departs_geoid_idx ON {{output}}.transit_departs (geoid);
+COMMIT;
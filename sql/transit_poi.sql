@@ -0,0 +1,31 @@
+-- creating transit poi for walksheds
+CREATE TABLE
+    network.transit_poi AS
+SELECT
+    ROW_NUMBER() OVER (ORDER BY t.stop_id, t.gtfs ASC) AS id,
+    t.stop_id,
+    ST_ClosestPoint(t.geom, sw.the_geom) AS nearest_point,
+    sw.id AS source_node,
+    t.gtfs,
+    t.mode
+FROM
+    output.all_stops AS t
+    JOIN LATERAL (
+        SELECT
+            id,
+            the_geom
+        FROM
+            network.sw_network_vertices_pgr AS sw
+        WHERE
+            ST_DWithin (t.geom, sw.the_geom, 300)
+        ORDER BY
+            ST_Distance (t.geom, sw.the_geom)
+        LIMIT
+            1
+    ) AS sw ON TRUE;
+COMMIT;
+
+CREATE INDEX transit_poi_geom_idx
+ON network.transit_poi
+USING GIST (nearest_point);
+COMMIT;
@@ -0,0 +1,235 @@
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+from psycopg2.pool import ThreadedConnectionPool
+import instrument
+
+load_dotenv()
+
+host = os.getenv("HOST")
+user = os.getenv("USER")
+password = os.getenv("PASSWORD")
+port = os.getenv("PORT")
+
+# functions that write relations their arguments only name, e.g. pgr_createTopology('network.sw_network')
+# builds network.sw_network_vertices_pgr
+SIDE_EFFECTS = {
+    "pgr_createtopology": "{}_vertices_pgr",
+    "pgr_analyzegraph": "{}_vertices_pgr",
+}
+
+WRITE_PATTERNS = [
+    r'CREATE\s+(?:OR\s+REPLACE\s+)?(?:MATERIALIZED\s+)?(?:VIEW|TABLE)\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+\.\w+)',
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?(?:\w+\s+)?ON\s+(?:ONLY\s+)?(\w+\.\w+)',
+    r'ALTER\s+(?:MATERIALIZED\s+VIEW|TABLE|VIEW)\s+(?:IF\s+EXISTS\s+)?(\w+\.\w+)',
+    r'DROP\s+(?:MATERIALIZED\s+VIEW|TABLE|VIEW)\s+(?:IF\s+EXISTS\s+)?(\w+\.\w+)',
+    r'REFRESH\s+MATERIALIZED\s+VIEW\s+(?:CONCURRENTLY\s+)?(\w+\.\w+)',
+    r'INSERT\s+INTO\s+(\w+\.\w+)',
+    r'UPDATE\s+(\w+\.\w+)',
+    r'DELETE\s+FROM\s+(\w+\.\w+)',
+]
+FUNCTION_PATTERN = r'CREATE\s+(?:OR\s+REPLACE\s+)?FUNCTION\s+((?:\w+\.)?\w+)'
+TRANSACTION_CONTROL = {"BEGIN", "COMMIT", "END", "START TRANSACTION"}
+
+
+class Statement:
+    """
+    One statement of a sql script with the relations it reads and writes.
+    """
+
+    def __init__(self, index, sql, comments):
+        self.index = index
+        self.sql = sql
+        self.comments = comments
+        self.reads = set()
+        self.writes = set()
+        self.deps = set()
+
+    def label(self):
+        return self.comments[-1] if self.comments else " ".join(self.sql.split())[:60]
+
+
+def split_statements(sql_contents):
+    """
+    Splits a script on top-level semicolons, leaving strings, quoted identifiers,
+    dollar-quoted bodies and comments intact. Returns (sql, comments) pairs where
+    comments are the -- lines that preceded the statement.
+    """
+    statements, comments = [], []
+    current, i, n = [], 0, len(sql_contents)
+
+    while i < n:
+        char = sql_contents[i]
+        if sql_contents.startswith('--', i):
+            end = sql_contents.find('\n', i)
+            end = n if end == -1 else end
+            if not "".join(current).strip():
+                comments.append(sql_contents[i + 2:end].strip())
+            else:
+                current.append(sql_contents[i:end])
+            i = end
+        elif sql_contents.startswith('/*', i):
+            end = sql_contents.find('*/', i + 2)
+            end = n if end == -1 else end + 2
+            current.append(sql_contents[i:end])
+            i = end
+        elif char in ("'", '"'):
+            end = i + 1
+            while end < n:
+                if sql_contents[end] == char:
+                    if end + 1 < n and sql_contents[end + 1] == char:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            current.append(sql_contents[i:end + 1])
+            i = end + 1
+        elif char == '$' and re.match(r'\$(\w*)\$', sql_contents[i:]):
+            tag = re.match(r'\$(\w*)\$', sql_contents[i:]).group(0)
+            end = sql_contents.find(tag, i + len(tag))
+            end = n if end == -1 else end + len(tag)
+            current.append(sql_contents[i:end])
+            i = end
+        elif char == ';':
+            sql = "".join(current).strip()
+            if sql and sql.upper() not in TRANSACTION_CONTROL:
+                statements.append((sql, [c for c in comments if c]))
+            current, comments = [], []
+            i += 1
+        else:
+            current.append(char)
+            i += 1
+
+    sql = "".join(current).strip()
+    if sql and sql.upper() not in TRANSACTION_CONTROL:
+        statements.append((sql, [c for c in comments if c]))
+    return statements
+
+
+def strip_comments(sql):
+    return re.sub(r'/\*.*?\*/', ' ', re.sub(r'--[^\n]*', ' ', sql), flags=re.DOTALL)
+
+
+def qualified_names(sql):
+    """
+    Every schema.name in a statement, including ones inside string arguments.
+    """
+    return {name.lower() for name in re.findall(r'\b([A-Za-z_]\w*\.[A-Za-z_]\w*)\b', strip_comments(sql))}
+
+
+def analyze(sql_contents):
+    """
+    Parses a script and works out which statements have to wait for which:
+    a statement depends on every earlier one that writes what it reads or
+    writes, or reads what it writes.
+    """
+    statements = [Statement(i, sql, comments) for i, (sql, comments) in enumerate(split_statements(sql_contents))]
+    functions = {}
+
+    for statement in statements:
+        body = strip_comments(statement.sql)
+        for pattern in WRITE_PATTERNS:
+            match = re.match(r'\s*' + pattern, body, flags=re.IGNORECASE)
+            if match:
+                statement.writes.add(match.group(1).lower())
+                break
+        function = re.match(r'\s*' + FUNCTION_PATTERN, body, flags=re.IGNORECASE)
+        if function:
+            name = function.group(1).lower()
+            functions[name.split('.')[-1]] = name
+            statement.writes.add(f"function:{name}")
+
+    # anything else (a SELECT of some function) is assumed to change every
+    # relation it names in a schema the script writes to, or in a string argument
+    schemas = {name.split('.')[0] for statement in statements for name in statement.writes if ':' not in name}
+    for statement in statements:
+        if statement.writes:
+            continue
+        body = strip_comments(statement.sql)
+        quoted = set()
+        for literal in re.findall(r"'([^']*)'", body):
+            quoted |= qualified_names(literal)
+        statement.writes = {name for name in qualified_names(body) if name.split('.')[0] in schemas} | quoted
+        for call, derived in SIDE_EFFECTS.items():
+            for target in re.findall(call + r"""\s*\(\s*'(\w+\.\w+)'""", body, flags=re.IGNORECASE):
+                statement.writes.add(derived.format(target.lower()))
+
+    known = set().union(*(statement.writes for statement in statements)) if statements else set()
+    for statement in statements:
+        body = strip_comments(statement.sql)
+        statement.reads = (qualified_names(body) & known) - statement.writes
+        for short, name in functions.items():
+            if re.search(r'\b' + short + r'\s*\(', body, flags=re.IGNORECASE) and f"function:{name}" not in statement.writes:
+                statement.reads.add(f"function:{name}")
+
+    for later in statements:
+        for earlier in statements[:later.index]:
+            if (
+                earlier.writes & (later.reads | later.writes)
+                or earlier.reads & later.writes
+            ):
+                later.deps.add(earlier.index)
+
+    return statements
+
+
+def run_script(dbname, sql_contents, workers=4, timeout=None):
+    """
+    Runs a script's statements on a connection pool, each as soon as the ones it
+    depends on have committed. The first failure cancels whatever is still
+    running and raises. timeout (seconds) is applied per statement.
+    """
+    statements = analyze(sql_contents)
+    settings = {"options": f"-c statement_timeout={int(timeout * 1000)}"} if timeout else {}
+    pool = ThreadedConnectionPool(
+        1, workers, host=host, port=port, database=dbname, user=user, password=password, **settings
+    )
+    active = {}
+    parent = instrument.current()
+
+    def execute(statement):
+        conn = pool.getconn()
+        active[statement.index] = conn
+        try:
+            start = time.time()
+            with instrument.span(statement.label(), "sql", parent=parent, statement=statement.index + 1, sql=statement.sql):
+                with conn.cursor() as cur, instrument.db_time():
+                    cur.execute(statement.sql)
+                    instrument.add(rows=max(cur.rowcount, 0))
+                conn.commit()
+            return time.time() - start
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            del active[statement.index]
+            pool.putconn(conn)
+
+    todo = {statement.index: statement for statement in statements}
+    done, running = set(), {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while todo or running:
+                for statement in [s for s in todo.values() if s.deps <= done]:
+                    for comment in statement.comments:
+                        print(f"\t \t -> {comment}\n")
+                    running[executor.submit(execute, statement)] = statement
+                    del todo[statement.index]
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    statement = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        for conn in list(active.values()):
+                            conn.cancel()
+                        todo.clear()
+                        raise RuntimeError(
+                            f"SQL statement {statement.index + 1} ({statement.label()}) failed: {e}"
+                        ) from e
+                    done.add(statement.index)
+    finally:
+        pool.closeall()
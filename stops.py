@@ -0,0 +1,46 @@
+import bulk
+import db
+from snap import feed_filter, feed_params
+
+
+def refresh_stops(dbname, gtfs):
+    """
+    Brings output.all_stops and output.stop_assignment up to date after the
+    given feeds (all_stops labels) were reloaded: the view is refreshed
+    concurrently instead of dropped, and only those feeds' stops are assigned
+    a block group and taz again.
+    """
+    print(f"\t -> Refreshing stops for {', '.join(gtfs)}...")
+    db.refresh_views(dbname, ["output.all_stops"])
+
+    conn = bulk.connect(dbname)
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM output.stop_assignment {feed_filter(gtfs)};", feed_params(gtfs))
+        cur.execute(f"""
+            INSERT INTO output.stop_assignment (stop_id, gtfs, geoid, taz)
+            SELECT
+                s.stop_id,
+                s.gtfs,
+                bg.geoid,
+                tz.taz
+            FROM
+                (
+                    SELECT DISTINCT ON (stop_id, gtfs) stop_id, gtfs, geom
+                    FROM output.all_stops
+                    ORDER BY stop_id, gtfs, mode
+                ) s
+                LEFT JOIN LATERAL (
+                    SELECT cb.geoid FROM input.census_blockgroups cb
+                    WHERE ST_Intersects (cb.geometry, s.geom)
+                    ORDER BY cb.geoid LIMIT 1
+                ) bg ON TRUE
+                LEFT JOIN LATERAL (
+                    SELECT t.taz FROM input.taz t
+                    WHERE ST_Intersects (t.geometry, s.geom)
+                    ORDER BY t.taz LIMIT 1
+                ) tz ON TRUE
+            {feed_filter(gtfs, "s.gtfs")};
+        """, feed_params(gtfs))
+        cur.execute("ANALYZE output.stop_assignment;")
+    conn.commit()
+    conn.close()
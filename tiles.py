@@ -0,0 +1,299 @@
+import os
+import json
+import shutil
+import subprocess
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import shapely
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyproj import CRS, Transformer
+from dotenv import load_dotenv
+import bulk
+
+load_dotenv()
+
+# where exported layers and tiles are written
+output_dir = os.getenv("OUTPUT_DIR", "output")
+
+EXPORT_CHUNK_ROWS = 5_000
+
+# layer name -> (query, geometry column); these were the pg_to_geojson calls in tileset.sh
+layers = {
+    "eta_score": ("SELECT ROW_NUMBER() OVER () AS id, * FROM output.output", "geometry"),
+    "walksheds": (
+        "SELECT ROW_NUMBER() OVER () AS id, stop_id, gtfs, geom AS geometry FROM network.transit_poi_isochrones",
+        "geometry",
+    ),
+    "transitstops": ("""
+        WITH a AS (
+            SELECT st.stop_id,
+            t.gtfs,
+            CASE WHEN r.route_type = 3 THEN json_agg(distinct(t.route_id)) ELSE '[]'::json END as routes,
+            CASE WHEN r.route_type = 3 THEN '[]'::json ELSE json_agg(distinct(r.route_long_name)) END as route_names
+            FROM septa_bus.stop_times st
+            JOIN output.all_trips t ON st.trip_id = t.trip_id
+            JOIN septa_bus.routes r ON t.route_id = r.route_id
+            WHERE t.gtfs = 'septa_bus'::text
+            GROUP BY st.stop_id, t.gtfs, r.route_type
+            UNION ALL
+            SELECT st.stop_id,
+            t.gtfs,
+            '[]'::json as routes,
+            json_agg(distinct(r.route_long_name)) as route_names
+            FROM septa_rail.stop_times st
+            JOIN output.all_trips t ON st.trip_id = t.trip_id
+            JOIN septa_rail.routes r ON t.route_id = r.route_id
+            WHERE t.gtfs = 'septa_rail'::text
+            GROUP BY st.stop_id, t.gtfs
+            UNION ALL
+            SELECT st.stop_id,
+            t.gtfs,
+            json_agg(distinct(t.route_id)) as routes,
+            '[]'::json as route_names
+            FROM njtransit_bus.stop_times st
+            JOIN output.all_trips t ON st.trip_id = t.trip_id
+            WHERE t.gtfs = 'njt_bus'::text
+            GROUP BY st.stop_id, t.gtfs
+            UNION ALL
+            SELECT st.stop_id,
+            t.gtfs,
+            '[]'::json as routes,
+            json_agg(distinct(r.route_long_name)) as route_names
+            FROM njtransit_rail.stop_times st
+            JOIN output.all_trips t ON st.trip_id = t.trip_id
+            JOIN njtransit_rail.routes r ON t.route_id = r.route_id
+            WHERE t.gtfs = 'njt_rail'::text
+            GROUP BY st.stop_id, t.gtfs
+            UNION ALL
+            SELECT st.stop_id,
+            t.gtfs,
+            '[]'::json as routes,
+            json_agg(distinct(r.route_long_name)) as route_names
+            FROM patco.stop_times st
+            JOIN output.all_trips t ON st.trip_id = t.trip_id
+            JOIN patco.routes r ON t.route_id = r.route_id
+            WHERE t.gtfs = 'patco'::text
+            GROUP BY st.stop_id, t.gtfs
+        )
+        SELECT ROW_NUMBER() OVER () AS id, a.*, s.geom as geometry
+        FROM a JOIN output.all_stops s ON a.stop_id = s.stop_id AND a.gtfs = s.gtfs
+        JOIN output.stop_assignment sa ON a.stop_id = sa.stop_id AND a.gtfs = sa.gtfs
+        WHERE sa.geoid IS NOT NULL
+    """, "geometry"),
+    "es": (
+        "SELECT es.es_id AS id, es.name, es.type, es.geometry FROM output.es_point_locations es "
+        "JOIN output.es_assignment esa ON es.es_id = esa.es_id WHERE esa.geoid IS NOT NULL",
+        "geometry",
+    ),
+    "os": ("SELECT ROW_NUMBER() OVER () AS id, os.* FROM input.open_space os", "geometry"),
+}
+
+extensions = {"ndjson": "geojsonl", "flatgeobuf": "fgb", "geoparquet": "parquet"}
+
+# postgres type oids -> arrow types, anything else is written as text
+arrow_types = {
+    16: pa.bool_(), 20: pa.int64(), 21: pa.int64(), 23: pa.int64(),
+    700: pa.float64(), 701: pa.float64(), 1700: pa.float64(),
+    1082: pa.date32(), 1114: pa.timestamp("us"),
+}
+
+
+def plain(value):
+    """
+    A property value JSON can hold.
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def text(value):
+    """
+    A property value as an arrow string, json columns (the transitstops route lists) as JSON.
+    """
+    if value is None:
+        return None
+    return json.dumps(value) if isinstance(value, (list, dict)) else str(value)
+
+
+def read_chunks(dbname, name, query, geom_column, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Streams a layer through a server-side cursor. Yields (columns, {column: values},
+    geometries in 4326) per chunk, so only one chunk is ever in memory.
+    """
+    conn = bulk.connect(dbname)
+    transformers = {}
+    try:
+        with conn.cursor(name=f"export_{name}") as cur:
+            cur.itersize = chunk_rows
+            cur.execute(f"SELECT * FROM ({query}) layer")
+            while True:
+                rows = cur.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                columns = [(column.name, column.type_code) for column in cur.description]
+                geom_index = [column for column, _ in columns].index(geom_column)
+                geoms = shapely.from_wkb([row[geom_index] for row in rows])
+
+                # NULL geometries (srid -1) pass through as null features
+                present = ~shapely.is_missing(geoms)
+                srids = shapely.get_srid(geoms)
+                for srid in np.unique(srids[present]):
+                    if srid <= 0 or srid == 4326:
+                        continue
+                    if srid not in transformers:
+                        transformers[srid] = Transformer.from_crs(int(srid), 4326, always_xy=True)
+                    at = present & (srids == srid)
+                    geoms[at] = shapely.transform(geoms[at], lambda xy, t=transformers[srid]: np.column_stack(t.transform(xy[:, 0], xy[:, 1])))
+
+                properties = {
+                    column: [plain(row[i]) for row in rows]
+                    for i, (column, _) in enumerate(columns) if i != geom_index
+                }
+                yield [c for c in columns if c[0] != geom_column], properties, geoms
+    finally:
+        conn.close()
+
+
+def write_ndjson(path, chunks):
+    """
+    One GeoJSON Feature per line, what tippecanoe reads in parallel with -P.
+    """
+    features = 0
+    with open(path, "w") as f:
+        for _, properties, geoms in chunks:
+            names = list(properties)
+            geometries = shapely.to_geojson(geoms)
+            for i, geometry in enumerate(geometries):
+                props = {column: properties[column][i] for column in names}
+                f.write(f'{{"type":"Feature","geometry":{geometry or "null"},"properties":{json.dumps(props, default=str)}}}\n')
+            features += len(geoms)
+    return features
+
+
+def arrow_schema(columns):
+    return pa.schema(
+        [(column, arrow_types.get(type_code, pa.string())) for column, type_code in columns]
+        + [("geometry", pa.binary())]
+    )
+
+
+def arrow_batches(chunks, first):
+    """
+    Record batches of the properties plus WKB geometry, all with the first chunk's schema.
+    """
+    schema = arrow_schema(first[0])
+    for columns, properties, geoms in _chain(first, chunks):
+        arrays = []
+        for (column, _), field in zip(columns, schema):
+            values = properties[column]
+            if field.type == pa.string():
+                values = [text(value) for value in values]
+            arrays.append(pa.array(values, type=field.type))
+        arrays.append(pa.array(shapely.to_wkb(geoms), type=pa.binary()))
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _chain(first, chunks):
+    yield first
+    yield from chunks
+
+
+def write_geoparquet(path, chunks):
+    """
+    GeoParquet 1.0 written a row group per chunk. read_chunks hands over
+    lon/lat, so the crs is OGC:CRS84 (a null crs would mean undefined).
+    """
+    first = next(chunks, None)
+    if first is None:
+        return 0
+    schema = arrow_schema(first[0]).with_metadata({"geo": json.dumps({
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": [], "crs": CRS("OGC:CRS84").to_json_dict()}},
+    })})
+    features = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in arrow_batches(chunks, first):
+            writer.write_batch(batch.replace_schema_metadata(schema.metadata))
+            features += batch.num_rows
+    return features
+
+
+def write_flatgeobuf(path, chunks):
+    """
+    FlatGeobuf through GDAL, fed from a record batch stream so it is written in one pass.
+    """
+    from pyogrio import write_arrow
+
+    first = next(chunks, None)
+    if first is None:
+        return 0
+    counted = []
+
+    def counting():
+        for batch in arrow_batches(chunks, first):
+            counted.append(batch.num_rows)
+            yield batch
+
+    reader = pa.RecordBatchReader.from_batches(arrow_schema(first[0]), counting())
+    write_arrow(reader, path, driver="FlatGeobuf", geometry_name="geometry", geometry_type="Unknown", crs="EPSG:4326")
+    return sum(counted)
+
+
+writers = {"ndjson": write_ndjson, "flatgeobuf": write_flatgeobuf, "geoparquet": write_geoparquet}
+
+
+def export_layer(dbname, name, fmt="ndjson", directory=None):
+    """
+    Exports one layer to {directory}/{name}.{ext}.
+    """
+    query, geom_column = layers[name]
+    directory = directory or output_dir
+    path = os.path.join(directory, f"{name}.{extensions[fmt]}")
+    features = writers[fmt](path, read_chunks(dbname, name, query, geom_column))
+    print(f"\t \t -> {name}: {features} features")
+    return path
+
+
+def build_tiles(paths, directory):
+    """
+    tippecanoe per layer (in parallel), then tile-join into eta.mbtiles, as tileset.sh did.
+    """
+    if not shutil.which("tippecanoe") or not shutil.which("tile-join"):
+        print("\t \t -> tippecanoe/tile-join not found, skipping tiles")
+        return
+
+    def tile(item):
+        name, path = item
+        mbtiles = os.path.join(directory, f"{name}.mbtiles")
+        subprocess.run(["tippecanoe", "-o", mbtiles, "-l", name, "-f", "-r1", "-pk", "-pf", "-P", path], check=True)
+        return mbtiles
+
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        mbtiles = list(executor.map(tile, paths.items()))
+
+    subprocess.run(["tile-join", "-n", "eta", "-pk", "-f", "-o", os.path.join(directory, "eta.mbtiles"), *mbtiles], check=True)
+    for path in mbtiles:
+        os.remove(path)
+
+
+def export_layers(dbname, fmt="ndjson", names=None, directory=None, tiles=True, max_workers=4):
+    """
+    Exports the map layers concurrently, each streamed in chunks and reprojected
+    to 4326 on the way out. With ndjson and tiles=True the layers are also cut
+    into eta.mbtiles.
+    """
+    print(f"\t -> Exporting layers as {fmt}...")
+    directory = directory or output_dir
+    os.makedirs(directory, exist_ok=True)
+    names = names or list(layers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        paths = dict(zip(names, executor.map(lambda name: export_layer(dbname, name, fmt, directory), names)))
+
+    if fmt == "ndjson" and tiles:
+        build_tiles(paths, directory)
+    return paths
@@ -0,0 +1,193 @@
+import numpy as np
+import pandas as pd
+import shapely
+import bulk
+import db
+from graph import copy_query
+
+# the half of the 3x3 cell neighbourhood that, together with the cell itself, covers every pair once
+NEIGHBOUR_OFFSETS = [(1, -1), (1, 0), (1, 1), (0, 1)]
+
+
+def read_endpoints(dbname, edge_table):
+    """
+    Edge ids with their start/end coordinates, in id order; non-line rows come back as NaN.
+    """
+    return copy_query(dbname, f"""
+        SELECT
+            id,
+            ST_X(ST_StartPoint(geometry)) AS sx, ST_Y(ST_StartPoint(geometry)) AS sy,
+            ST_X(ST_EndPoint(geometry)) AS ex, ST_Y(ST_EndPoint(geometry)) AS ey
+        FROM {edge_table}
+        ORDER BY id
+    """, dtype={"id": np.int64, "sx": np.float64, "sy": np.float64, "ex": np.float64, "ey": np.float64})
+
+
+def cell_pairs(starts, counts, a, b):
+    """
+    Every (i, j) point pair between cell a and cell b, given the sorted point
+    ranges of each cell.
+    """
+    per_pair = counts[a] * counts[b]
+    owner = np.repeat(np.arange(len(a)), per_pair)
+    k = np.arange(per_pair.sum()) - np.repeat(np.cumsum(per_pair) - per_pair, per_pair)
+    width = counts[b][owner]
+    return starts[a][owner] + k // width, starts[b][owner] + k % width
+
+
+def close_pairs(x, y, tolerance):
+    """
+    Every (i, j) pair of points closer than tolerance, i < j, found with a grid
+    hash: points only ever compare against their own and the neighbouring
+    cells, so this stays linear in the number of points.
+    """
+    cx = np.floor((x - x.min()) / tolerance).astype(np.int64)
+    cy = np.floor((y - y.min()) / tolerance).astype(np.int64)
+    height = cy.max() + 3
+    keys = (cx + 1) * height + (cy + 1)
+
+    order = np.argsort(keys, kind="stable")
+    cells, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+    rows, cols = [], []
+    same = np.flatnonzero(counts > 1)
+    if len(same):
+        i, j = cell_pairs(starts, counts, same, same)
+        keep = i < j
+        rows.append(i[keep]), cols.append(j[keep])
+    for dx, dy in NEIGHBOUR_OFFSETS:
+        target = cells + dx * height + dy
+        found = np.searchsorted(cells, target)
+        found = np.clip(found, 0, len(cells) - 1)
+        hit = cells[found] == target
+        i, j = cell_pairs(starts, counts, np.flatnonzero(hit), found[hit])
+        rows.append(i), cols.append(j)
+
+    a, b = order[np.concatenate(rows)], order[np.concatenate(cols)]
+    i, j = np.minimum(a, b), np.maximum(a, b)
+    keep = np.hypot(x[i] - x[j], y[i] - y[j]) <= tolerance
+    return i[keep], j[keep]
+
+
+def snap_points(x, y, tolerance):
+    """
+    Snaps points in order the way pgr_createTopology does: each point goes to
+    the nearest vertex already made within tolerance (the earliest on a tie),
+    or becomes a new vertex. Returns the index of its vertex's point per point.
+    """
+    n = len(x)
+    snapped = np.arange(n)
+    if n == 0:
+        return snapped
+    i, j = close_pairs(x, y, tolerance)
+    distance = np.hypot(x[i] - x[j], y[i] - y[j])
+
+    # points with no earlier point within tolerance start a vertex, and a point
+    # on top of one of those can only go there (vertices are over tolerance apart)
+    has_earlier = np.zeros(n, dtype=bool)
+    has_earlier[j] = True
+    on_top = (distance == 0) & ~has_earlier[i]
+    snapped[j[on_top]] = i[on_top]
+    decided = ~has_earlier
+    decided[j[on_top]] = True
+
+    # the rest depend on which earlier points became vertices, so they go one by one
+    pending = ~decided[j]
+    order = np.lexsort((i[pending], j[pending]))
+    later, earlier, gap = j[pending][order], i[pending][order], distance[pending][order]
+    _, starts = np.unique(later, return_index=True)
+    for start, stop in zip(starts, np.r_[starts[1:], len(later)]):
+        best = None
+        for k in range(start, stop):
+            e = earlier[k]
+            if snapped[e] == e and (best is None or gap[k] < gap[best]):
+                best = k
+        if best is not None:
+            snapped[later[start]] = earlier[best]
+    return snapped
+
+
+def build_vertices(endpoints, tolerance):
+    """
+    Source/target vertex ids per edge and the vertex table. Vertices are
+    numbered from 1 in the order they are first met walking the edges by id
+    (start point, then end point) and sit at that first point, as
+    pgr_createTopology does.
+    """
+    valid = endpoints[["sx", "sy", "ex", "ey"]].notna().all(axis=1).to_numpy()
+    edges = endpoints[valid]
+    x = np.column_stack([edges["sx"], edges["ex"]]).ravel()
+    y = np.column_stack([edges["sy"], edges["ey"]]).ravel()
+
+    labels = snap_points(x, y, tolerance)
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(1, len(first) + 1)
+    vertex = rank[inverse].reshape(-1, 2)
+
+    ids = np.sort(rank)
+    at = np.sort(first)
+    cnt = np.bincount(vertex.ravel(), minlength=len(ids) + 1)[1:]
+    vertices = pd.DataFrame({"id": ids, "cnt": cnt, "x": x[at], "y": y[at]})
+
+    source = pd.Series(pd.NA, index=endpoints.index, dtype="Int64")
+    target = pd.Series(pd.NA, index=endpoints.index, dtype="Int64")
+    source[valid], target[valid] = vertex[:, 0], vertex[:, 1]
+    topology = pd.DataFrame({"id": endpoints["id"], "source": source, "target": target})
+    return topology, vertices
+
+
+def write_topology(dbname, topology, vertices, srid, edge_table, vertex_table):
+    """
+    Writes source/target onto the edges with one UPDATE from a COPYed temp
+    table and bulk loads a fresh vertex table with pgRouting's columns.
+    """
+    schema, table = vertex_table.split(".")
+    db.drop_relations(dbname, [vertex_table])
+    conn = bulk.connect(dbname)
+    with conn.cursor() as cur:
+        cur.execute("CREATE TEMP TABLE topology_ids (id BIGINT PRIMARY KEY, source BIGINT, target BIGINT) ON COMMIT DROP;")
+        bulk.copy_rows(conn, topology, "pg_temp", "topology_ids", commit=False)
+        cur.execute(f"""
+            UPDATE {edge_table} e SET source = t.source, target = t.target
+            FROM topology_ids t WHERE e.id = t.id;
+        """)
+        cur.execute(f"""
+            CREATE TABLE {vertex_table} (
+                id BIGSERIAL PRIMARY KEY,
+                cnt INTEGER,
+                chk INTEGER,
+                ein INTEGER,
+                eout INTEGER,
+                the_geom geometry(Point, {srid})
+            );
+        """)
+    frame = pd.DataFrame({
+        "id": vertices["id"],
+        "cnt": vertices["cnt"],
+        "the_geom": shapely.to_wkb(shapely.set_srid(shapely.points(vertices["x"], vertices["y"]), srid), hex=True, include_srid=True),
+    })
+    bulk.copy_rows(conn, frame, schema, table, commit=False)
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT setval(pg_get_serial_sequence('{vertex_table}', 'id'), GREATEST(MAX(id), 1)) FROM {vertex_table};")
+        cur.execute(f"CREATE INDEX {table}_geom_idx ON {vertex_table} USING GIST (the_geom);")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {edge_table.split('.')[1]}_source_idx ON {edge_table} (source);")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {edge_table.split('.')[1]}_target_idx ON {edge_table} (target);")
+        cur.execute(f"ANALYZE {edge_table}; ANALYZE {vertex_table};")
+    conn.commit()
+    conn.close()
+
+
+def build_topology(dbname, tolerance=0.001, edge_table="network.sw_network", vertex_table="network.sw_network_vertices_pgr"):
+    """
+    The in-memory stand-in for pgr_createTopology(clean := true) and
+    pgr_analyzeGraph: endpoints snap to the nearest vertex within tolerance, edges get
+    source/target and the vertex table gets its cnt (chk, ein and eout are
+    left NULL, nothing here reads them).
+    """
+    print("\t -> Building sidewalk topology...")
+    endpoints = read_endpoints(dbname, edge_table)
+    srid = int(copy_query(dbname, f"SELECT ST_SRID(geometry) AS srid FROM {edge_table} WHERE geometry IS NOT NULL LIMIT 1")["srid"].iloc[0])
+    topology, vertices = build_vertices(endpoints, tolerance)
+    write_topology(dbname, topology, vertices, srid, edge_table, vertex_table)
+    print(f"\t \t -> {len(topology)} edges, {len(vertices)} vertices, {int((vertices['cnt'] == 1).sum())} dead ends")
@@ -1,7 +1,15 @@
-from sqlalchemy import create_engine, text, NullPool
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
+import numpy as np
+import shapely
 from dotenv import load_dotenv
+import time
 import os
+import graph
+import bulk
+import instrument
 
 load_dotenv()
 
@@ -16,7 +24,7 @@ port = os.getenv("PORT")
 # rail distance = 900*1.4 = 1260m
 # walk bus = 5 minutes -> 300 seconds
 # bus distance = 300*1.4 = 1260m
-route_me = text(f"""
+route_me = text("""
     INSERT INTO network.transit_poi_paths (id, stop_id, gtfs, node_id, travel_time)
     SELECT
         :id AS id,
@@ -26,18 +34,49 @@ route_me = text(f"""
         shortest_path.agg_cost AS travel_time
     FROM
         pgr_drivingdistance (
-            'SELECT sw.id, sw.source, sw.target, sw.cost FROM network.sw_network sw',
+            :edges,
             :source_node,
-            CASE
-                WHEN :mode LIKE '%bus' THEN 420
-                ELSE 1260
-            END,
+            :cutoff,
             FALSE
         ) AS shortest_path
     JOIN network.sw_network_vertices_pgr node ON shortest_path.node = node.id;
-    COMMIT;
 """)
 
+# only edges within the walk cutoff (as the crow flies) of the vertex routing starts
+# from can be reached, so pgRouting gets that subgraph instead of the whole network
+bounded_edges = """
+    SELECT sw.id, sw.source, sw.target, sw.cost
+    FROM network.sw_network sw
+    WHERE ST_DWithin(
+        sw.geometry,
+        (SELECT the_geom FROM network.sw_network_vertices_pgr WHERE id = {source_node}),
+        {cutoff}
+    )
+"""
+
+
+route_me_iso = """
+    INSERT INTO network.transit_poi_isochrones (id, stop_id, gtfs, geom)
+    SELECT
+        :id AS id,
+        :stop_id AS stop_id,
+        :gtfs AS gtfs,
+        {hull} AS geom
+    FROM
+        pgr_drivingdistance (
+            :edges,
+            :source_node,
+            :cutoff,
+            FALSE
+        ) AS shortest_path
+    JOIN network.sw_network_vertices_pgr node ON shortest_path.node = node.id;
+"""
+
+hulls = {
+    "convex": "ST_ConvexHull(ST_Collect(node.the_geom))",
+    "concave": "ST_ConcaveHull(ST_Collect(node.the_geom), {ratio})",
+}
+
 
 def get_transit_poi(dbname):
     """
@@ -51,35 +90,293 @@ def get_transit_poi(dbname):
         return pd.read_sql(query, connection).to_dict(orient='records')
 
 
-def process_transit_poi(poi, dbname):
+def get_routed_ids(engine, table="network.transit_poi_paths"):
+    """
+    ids of pois that already have rows in the given output table
+    """
+    with engine.connect() as connection:
+        rows = connection.execute(text(f"SELECT DISTINCT id FROM {table};"))
+        return {row[0] for row in rows}
+
+
+def process_transit_poi(poi, engine, iso=None, paths=True):
     """
-    each poi gets routed
+    each poi gets routed on its own bounded subgraph, in one transaction,
+    writing its paths and/or its walkshed polygon
     """
+    cutoff = graph.cutoff_for_mode(poi['mode'])
+    params = {
+        'id': poi['id'],
+        'stop_id': poi['stop_id'],
+        'gtfs': poi['gtfs'],
+        'source_node': poi['source_node'],
+        'cutoff': cutoff,
+        'edges': bounded_edges.format(source_node=int(poi['source_node']), cutoff=cutoff)
+    }
+    with engine.begin() as connection:
+        if paths:
+            connection.execute(route_me, params)
+        if iso is not None:
+            connection.execute(iso, params)
+
+
+def process_shard(shard, engine, retries=3, backoff=2, **kwargs):
+    """
+    routes a shard of pois, retrying each one with exponential backoff
+    """
+    for poi in shard:
+        for attempt in range(retries + 1):
+            try:
+                process_transit_poi(poi, engine, **kwargs)
+                break
+            except OperationalError as e:
+                if attempt == retries:
+                    raise
+                wait = backoff ** attempt
+                print(f"\t \t -> POI {poi['id']} failed ({e.orig}), retrying in {wait}s...")
+                time.sleep(wait)
+    return len(shard)
+
+
+def route_parallel(dbname, workers=None, shard_size=50, retries=3, resume=True,
+                   paths=False, hull="convex", concave_ratio=0.3):
+    """
+    routes pois with pgRouting across a bounded pool of connections, skipping
+    pois already written so an interrupted run picks up where it stopped.
+    each walkshed polygon is written as soon as its stop is routed, the
+    per-node paths table is only filled when paths=True
+    """
+    print("\t -> Routing walksheds with pgRouting...")
+    workers = workers or os.cpu_count()
     engine = create_engine(
     f"postgresql://{user}:{password}@{host}:{port}/{dbname}",
-    poolclass=NullPool)
+    pool_size=workers, max_overflow=0, pool_pre_ping=True)
+
+    if not resume:
+        drop_isochrone_table(engine)
+        truncate_paths(engine)
+    create_isochrone_table(engine)
+    iso = text(route_me_iso.format(hull=hulls[hull].format(ratio=concave_ratio)))
+
+    pois = get_transit_poi(dbname)
+    if resume:
+        routed = get_routed_ids(engine, "network.transit_poi_paths" if paths else "network.transit_poi_isochrones")
+        pois = [poi for poi in pois if poi['id'] not in routed]
+        if routed:
+            print(f"\t \t -> resuming, {len(routed)} pois already routed")
+
+    shards = [pois[i:i + shard_size] for i in range(0, len(pois), shard_size)]
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(instrument.bind(process_shard), shard, engine, retries, iso=iso, paths=paths)
+            for shard in shards
+        ]
+        for future in as_completed(futures):
+            done += future.result()
+            print(f"\t \t -> {done}/{len(pois)} pois routed")
 
+    index_isochrones(engine)
+    engine.dispose()
+
+
+def drop_isochrone_table(engine):
+    """
+    drops the walkshed polygons table, and output.transit_ws built on it
+    """
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS network.transit_poi_isochrones CASCADE;"))
+
+
+def truncate_paths(engine):
+    """
+    empties the per-node paths table so a rerun doesn't append to the last one
+    """
+    with engine.begin() as connection:
+        connection.execute(text("TRUNCATE network.transit_poi_paths;"))
+
+
+def create_isochrone_table(engine, srid=26918):
+    """
+    creates the walkshed polygons table if it is not there yet
+    """
+    with engine.begin() as connection:
+        connection.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS
+                network.transit_poi_isochrones (
+                    id INTEGER,
+                    stop_id VARCHAR(20),
+                    gtfs VARCHAR(20),
+                    geom geometry(Geometry, {srid})
+            );
+        """))
+
+
+def index_isochrones(engine):
+    """
+    spatial index for the walkshed polygons, built once they are all written
+    """
+    with engine.begin() as connection:
+        connection.execute(text("""
+            CREATE INDEX IF NOT EXISTS isochrones_geom_idx
+            ON network.transit_poi_isochrones
+            USING GIST (geom);
+        """))
+
+
+def build_hulls(sw_graph, positions, nodes, hull="convex", concave_ratio=0.3, srid=26918):
+    """
+    one convex (or concave) hull per routed poi from the vertices it reached.
+    shapely's concave_hull is the GEOS algorithm ST_ConcaveHull uses from PostGIS 3.3
+    (with GEOS 3.11), where param_pctconvex is the same ratio; older PostGIS reads the
+    number as a target area percent, so concave shapes differ from the pgrouting engine there
+    """
+    routed, groups = np.unique(positions, return_inverse=True)
+    coords = np.column_stack([sw_graph.x[nodes], sw_graph.y[nodes]])
+    points = shapely.multipoints(coords, indices=groups)
+    if hull == "concave":
+        geoms = shapely.concave_hull(points, ratio=concave_ratio)
+    else:
+        geoms = shapely.convex_hull(points)
+    geoms = shapely.set_srid(geoms, srid)
+    return routed, shapely.to_wkb(geoms, hex=True, include_srid=True)
+
+
+def route_all(dbname, batch_size=None, paths=False, hull="convex", concave_ratio=0.3, contract=False, gtfs=None):
+    """
+    routes every transit poi in memory against a single CSR copy of the sidewalk
+    network instead of one pgr_drivingdistance call per stop. walkshed polygons
+    are built per batch as the stops are routed, so the per-node paths table is
+    only written when paths=True. contract=True routes on the graph with its
+    degree-2 chains folded away, same results with far fewer nodes to settle.
+    gtfs (all_stops labels) reroutes just those feeds' pois, replacing their
+    walksheds and keeping everyone else's
+    """
+    print("\t -> Routing walksheds...")
+    sw_graph = graph.load_graph(dbname)
+    pois = pd.DataFrame(get_transit_poi(dbname))
+    if gtfs:
+        pois = pois[pois["gtfs"].isin(gtfs)].copy()
+
+    pois["source_idx"] = sw_graph.index_of(pois["source_node"].to_numpy())
+    missing = pois["source_idx"] < 0
+    if missing.any():
+        print(f"\t \t -> {int(missing.sum())} pois snapped to vertices without edges, skipping")
+        pois = pois[~missing]
+    if contract:
+        sw_graph = graph.contract(sw_graph, pois["source_idx"].to_numpy())
+
+    engine = create_engine(
+    f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
+    if gtfs:
+        labels = {f"gtfs_{i}": label for i, label in enumerate(gtfs)}
+        placeholders = ", ".join(f":{name}" for name in labels)
+        with engine.begin() as connection:
+            connection.execute(text(f"DELETE FROM network.transit_poi_isochrones WHERE gtfs IN ({placeholders});"), labels)
+            connection.execute(text(f"DELETE FROM network.transit_poi_paths WHERE gtfs IN ({placeholders});"), labels)
+    else:
+        drop_isochrone_table(engine)
+        truncate_paths(engine)
+        create_isochrone_table(engine)
+
+    conn = bulk.connect(dbname)
+    total_rows = 0
+    total_polys = 0
+    for cutoff, group in pois.groupby(pois["mode"].map(graph.cutoff_for_mode)):
+        print(f"\t \t -> {len(group)} pois at {cutoff}m...")
+        group = group.reset_index(drop=True)
+        with instrument.span(f"route {cutoff}m", pois=len(group)):
+            for positions, nodes, costs in graph.drive_distance(
+                    sw_graph, group["source_idx"].to_numpy(), cutoff, batch_size):
+                routed, geoms = build_hulls(sw_graph, positions, nodes, hull, concave_ratio)
+                isochrones = group.iloc[routed]
+                bulk.copy_rows(conn, pd.DataFrame({
+                    "id": isochrones["id"].to_numpy(),
+                    "stop_id": isochrones["stop_id"].to_numpy(),
+                    "gtfs": isochrones["gtfs"].to_numpy(),
+                    "geom": geoms,
+                }), "network", "transit_poi_isochrones")
+                total_polys += len(routed)
+
+                if paths:
+                    reached = group.iloc[positions]
+                    frame = pd.DataFrame({
+                        "id": reached["id"].to_numpy(),
+                        "stop_id": reached["stop_id"].to_numpy(),
+                        "gtfs": reached["gtfs"].to_numpy(),
+                        "node_id": sw_graph.node_ids[nodes],
+                        "travel_time": costs,
+                    })
+                    bulk.copy_rows(conn, frame, "network", "transit_poi_paths")
+                    total_rows += len(frame)
+    conn.close()
+
+    index_isochrones(engine)
+    engine.dispose()
+    print(f"\t \t -> {total_polys} walksheds written")
+    if paths:
+        print(f"\t \t -> {total_rows} reachable nodes written")
+
+
+def verify_routes(dbname, sample_size=25, tolerance=1e-6, seed=0):
+    """
+    checks the in-memory router against pgr_drivingdistance for a sample of pois
+    """
+    print("\t -> Verifying CSR walksheds against pgRouting...")
+    sw_graph = graph.load_graph(dbname)
+    pois = pd.DataFrame(get_transit_poi(dbname))
+    sample = pois.sample(min(sample_size, len(pois)), random_state=seed)
+
+    oracle = text("""
+        SELECT
+            node AS node_id,
+            agg_cost AS travel_time
+        FROM
+            pgr_drivingdistance (
+                'SELECT sw.id, sw.source, sw.target, sw.cost FROM network.sw_network sw',
+                :source_node,
+                :cutoff,
+                FALSE
+            );
+    """)
+    engine = create_engine(
+    f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
+
+    mismatches = []
     with engine.connect() as connection:
-        connection.execute(route_me, {
-            'id': poi['id'],
-            'stop_id': poi['stop_id'],
-            'gtfs': poi['gtfs'],
-            'source_node': poi['source_node'],
-            'mode': poi['mode']
-        })
-    connection.close()
+        for poi in sample.to_dict(orient='records'):
+            cutoff = graph.cutoff_for_mode(poi['mode'])
+            expected = pd.read_sql(oracle, connection, params={
+                'source_node': int(poi['source_node']), 'cutoff': cutoff})
+            expected = expected.set_index('node_id')['travel_time']
+
+            source = sw_graph.index_of([poi['source_node']])
+            actual = pd.Series(dtype=float)
+            if source[0] >= 0:
+                for _, nodes, costs in graph.drive_distance(sw_graph, source, cutoff):
+                    actual = pd.Series(costs, index=sw_graph.node_ids[nodes])
+
+            same_nodes = set(expected.index) == set(actual.index)
+            max_diff = (expected - actual.reindex(expected.index)).abs().max() if same_nodes else None
+            if not same_nodes or (len(expected) and max_diff > tolerance):
+                mismatches.append(poi['id'])
+                print(f"\t \t -> POI {poi['id']} differs: pgRouting {len(expected)} nodes, CSR {len(actual)} nodes")
+
     engine.dispose()
-    print(f"Processed POI {poi['id']}")
+    print(f"\t \t -> {len(sample) - len(mismatches)} of {len(sample)} pois match")
+    return mismatches
 
 
 def polys(dbname):
     """
-    create the polygons for the walkshed paths
+    create the polygons for the walkshed paths, only needed when the walksheds
+    were routed with paths=True and the polygons have to be rebuilt from them
     """
     engine = create_engine(
     f"postgresql://{user}:{password}@{host}:{port}/{dbname}")
 
     iso = text("""
+        DROP TABLE IF EXISTS network.transit_poi_isochrones CASCADE;
         CREATE TABLE
             network.transit_poi_isochrones AS
         SELECT